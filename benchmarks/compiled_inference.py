@@ -0,0 +1,60 @@
+"""
+Benchmark of a trained presence model: the sklearn estimator compared
+to its compiled representation, for single rows and for a batch.
+The model is trained on synthetic signals of 6 rooms and 8 scanners.
+
+    python -m benchmarks.compiled_inference
+"""
+import time
+
+import numpy as np
+import pandas as pd
+
+from server.compiled import compile_estimator
+from server.learn import threaded_train_model
+
+
+def measure(predict, rows, repeat):
+    predict(rows[0])
+    started = time.perf_counter()
+    for i in range(repeat):
+        predict(rows[i % len(rows)])
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def train(n_rooms=6, n_scanners=8):
+    """
+    A model trained on synthetic signals and rows to predict with it
+    """
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-95, -50, (n_rooms, n_scanners))
+    y = rng.integers(0, n_rooms, 3000)
+    X = pd.DataFrame(np.round(centers[y] + rng.normal(0, 6, (len(y), n_scanners)), 1))
+    np.random.seed(0)
+    _, estimator, _ = threaded_train_model.__wrapped__(X, y + 1)
+
+    X_test = np.round(centers[rng.integers(0, n_rooms, 500)] + rng.normal(0, 10, (500, n_scanners)), 1)
+    return estimator, X_test
+
+
+def main():
+    estimator, X_test = train()
+
+    started = time.perf_counter()
+    compiled = compile_estimator(estimator)
+    print('Compiled {} trees in {:.1f} ms'.format(len(compiled.roots), (time.perf_counter() - started) * 1000))
+
+    rows = [X_test[i:i + 1] for i in range(len(X_test))]
+    print('Max score difference {:.2e}'.format(np.abs(estimator.scores(X_test) - compiled.scores(X_test)).max()))
+
+    print('sklearn   {:>9.3f} ms/row'.format(measure(estimator.predict_proba, rows, 20)))
+    print('compiled  {:>9.3f} ms/row'.format(measure(compiled.predict_proba, rows, 500)))
+
+    started = time.perf_counter()
+    compiled.predict_proba_batch(X_test)
+    print('compiled  {:>9.3f} ms/row in a batch of {}'.format(
+        (time.perf_counter() - started) * 1000 / len(X_test), len(X_test)))
+
+
+if __name__ == '__main__':
+    main()
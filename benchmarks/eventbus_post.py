@@ -0,0 +1,107 @@
+"""
+Micro-benchmark of EventBus.post: posts/sec of the precompiled dispatch
+compared to the previous implementation, which wrapped the result of
+every subscriber in a future and gathered them on each post.
+
+    python -m benchmarks.eventbus_post
+"""
+import asyncio
+import logging
+import time
+from asyncio.coroutines import iscoroutine
+from collections import namedtuple
+
+from server.eventbus import EventBus, EventBusSubscriber, subscribe
+
+
+class LegacyEventBus(EventBus):
+    def post(self, event):
+        self.print_debug_message(event)
+
+        results = []
+        methods = self.event_method.get(event.__class__, {})
+        for method, decriptor in methods.items():
+            instances, with_instance = decriptor
+
+            if not with_instance:
+                results.append(self.call(method=method, with_event=event, subscriber=None))
+            else:
+                for instance in instances:
+                    results.append(self.call(method=method, with_event=event, subscriber=instance))
+
+        return_fut = asyncio.get_running_loop().create_future()
+        results_fut = asyncio.gather(*results)
+        results_fut.add_done_callback(lambda x: return_fut.set_result(True))
+        return return_fut
+
+    def call(self, method, with_event, subscriber):
+        result = method(subscriber, with_event) if subscriber else method(with_event)
+        if iscoroutine(result):
+            return result
+        else:
+            fut = asyncio.get_running_loop().create_future()
+            fut.set_result(result)
+            return fut
+
+    def print_debug_message(self, event):
+        event_log_level = getattr(event, 'log_level', None)
+        if event_log_level is not None and event_log_level >= logging.root.level:
+            logging.log(event_log_level, str(event))
+
+
+class SyncEvent(namedtuple('SyncEvent', 'device, signal')):
+    log_level = logging.DEBUG
+
+
+class MixedEvent(namedtuple('MixedEvent', 'device, signal')):
+    log_level = logging.DEBUG
+
+
+class Subscriber(EventBusSubscriber):
+    def __init__(self):
+        super().__init__()
+        self.received = 0
+
+    @subscribe(SyncEvent)
+    def handle_sync(self, event):
+        self.received += 1
+
+    @subscribe(MixedEvent)
+    def handle_mixed(self, event):
+        self.received += 1
+
+
+@subscribe(SyncEvent)
+def count_sync(event):
+    pass
+
+
+@subscribe(MixedEvent)
+async def count_mixed(event):
+    pass
+
+
+async def measure(bus, event, posts):
+    started = time.perf_counter()
+    for i in range(posts):
+        bus.post(event)
+        # Give the scheduled subscribers a chance to run, as the loop would
+        if i % 1000 == 0:
+            await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    return posts / (time.perf_counter() - started)
+
+
+async def main(posts=100000):
+    subscribers = [Subscriber() for _ in range(3)]
+    for name, event in [('sync subscribers', SyncEvent(1, {})), ('sync + async', MixedEvent(1, {}))]:
+        legacy = await measure(LegacyEventBus(), event, posts)
+        current = await measure(EventBus(), event, posts)
+        print('{:<18} legacy {:>10.0f} posts/s   current {:>10.0f} posts/s   x{:.1f}'.format(
+            name, legacy, current, current / legacy))
+
+    return subscribers
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,43 @@
+"""
+Benchmark of loading a trained presence model: unpickling the sklearn
+estimator (and compiling it, as the registry does) compared to memory
+mapping its model file.
+
+    python -m benchmarks.model_store
+"""
+import pickle
+import tempfile
+import time
+
+from benchmarks.compiled_inference import train
+from server.compiled import compile_estimator
+from server.modelstore import ModelStore
+
+
+def measure(load, repeat):
+    load()
+    started = time.perf_counter()
+    for _ in range(repeat):
+        load()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def main():
+    estimator, _ = train()
+    data = pickle.dumps(estimator)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = ModelStore(directory)
+        name = store.save(compile_estimator(estimator))
+        with open(store.path(name), 'rb') as f:
+            size = len(f.read())
+
+        print('pickle          {:>8.1f} KiB'.format(len(data) / 1024))
+        print('model file      {:>8.1f} KiB'.format(size / 1024))
+        print('pickle.loads    {:>8.2f} ms'.format(measure(lambda: pickle.loads(data), 10)))
+        print('  + compile     {:>8.2f} ms'.format(measure(lambda: compile_estimator(pickle.loads(data)), 10)))
+        print('model file load {:>8.2f} ms'.format(measure(lambda: store.load(name), 100)))
+
+
+if __name__ == '__main__':
+    main()
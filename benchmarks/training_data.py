@@ -0,0 +1,101 @@
+"""
+Benchmark of the training dataset generation: the row by row loop
+compared to the array based generator, on the recorded signals of
+research/data/signals-long.csv (or the given CSV file).
+
+    python -m benchmarks.training_data [signals.csv]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from server.constants import KALMAN_Q, KALMAN_R, LONG_DELAY_PENALTY_SEC, TURN_OFF_DEVICE_SEC
+from server.kalman import KalmanBank
+from server.learn import generate_training_data, session_frequencies, training_frame
+
+
+def generate_training_data_loop(used_data_df):
+    """
+    The original row by row dataset generator, the reference
+    of `generate_training_data`
+    """
+    sorted_rooms = sorted(used_data_df['room'].unique())
+    sorted_scanners = sorted(used_data_df['scanner'].unique())
+    session_dur_df = session_frequencies(used_data_df)
+    scanner_slots = dict((s, i) for i, s in enumerate(sorted_scanners))
+    filters = KalmanBank(len(sorted_scanners), R=KALMAN_R, Q=KALMAN_Q)
+    off_signals_history = np.zeros(len(sorted_scanners))
+    delay_signals_history = np.zeros(len(sorted_scanners))
+    result_data = []
+
+    for _ in range(10):
+        for room in np.random.choice(sorted_rooms, len(sorted_rooms), replace=False):
+            room_init = False
+            seconds_passed = 0
+            positions = used_data_df[used_data_df['room'] == room]['position'].unique()
+            for _ in range(3):
+                for position in np.random.choice(positions, len(positions), replace=False):
+                    signals_per_sec = session_dur_df.loc[(room, position), 'frequency']
+                    signals = used_data_df[(used_data_df['room'] == room) & (used_data_df['position'] == position)]
+                    signals = signals.sample(n=min(len(signals), 300), replace=True)
+
+                    for _, row in signals.iterrows():
+                        seconds_passed += 1 / signals_per_sec
+                        slot = scanner_slots[row['scanner']]
+                        off_signals_history[slot] = 0
+                        delay_signals_history[slot] = 0
+                        filters.filter([slot], [row['rssi']])
+                        data_row = np.round(filters.measurements(-100), decimals=1).tolist()
+
+                        off_signals_history += 1
+                        delay_signals_history += 1
+                        turned_off = off_signals_history > (TURN_OFF_DEVICE_SEC / signals_per_sec)
+                        off_signals_history[turned_off] = 0
+                        filters.set_state(np.flatnonzero(turned_off), -100)
+                        delayed = ~turned_off & (delay_signals_history > (LONG_DELAY_PENALTY_SEC / signals_per_sec))
+                        delay_signals_history[delayed] = 0
+                        filters.filter(np.flatnonzero(delayed), np.full(delayed.sum(), -100.0))
+
+                        if room_init:
+                            result_data.append(data_row + [room])
+                        elif seconds_passed > 60:
+                            room_init = True
+
+    return training_frame(pd.DataFrame(columns=sorted_scanners + ['room'], data=result_data))
+
+
+def load(path):
+    """
+    Recorded signals with the names replaced by ids, as in the database
+    """
+    df = pd.read_csv(path, parse_dates=['when'])
+    for column in ('scanner', 'room', 'position'):
+        df[column] = df[column].astype('category').cat.codes
+    return df
+
+
+def measure(generate):
+    started = time.perf_counter()
+    X, y = generate()
+    return X, y, time.perf_counter() - started
+
+
+def main(path='research/data/signals-long.csv'):
+    df = load(path)
+    print('{} signals, {} rooms, {} scanners, {} sessions'.format(
+        len(df), df['room'].nunique(), df['scanner'].nunique(), df['position'].nunique()))
+
+    X, y, vectorized = measure(lambda: generate_training_data(df, seed=0))
+    np.random.seed(0)
+    X_loop, y_loop, loop = measure(lambda: generate_training_data_loop(df))
+
+    print('loop       {:>8.2f} s  {} rows'.format(loop, len(X_loop)))
+    print('vectorized {:>8.2f} s  {} rows  {:.1f}x faster'.format(vectorized, len(X), loop / vectorized))
+    difference = (X.groupby(y).mean() - X_loop.groupby(y_loop).mean()).abs().values
+    print('Max difference of the mean RSSI of a scanner in a room {:.2f} dB'.format(difference.max()))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
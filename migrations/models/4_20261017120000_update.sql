@@ -0,0 +1,4 @@
+-- upgrade --
+ALTER TABLE "predictionmodel" ADD "model_file" VARCHAR(100);
+-- downgrade --
+ALTER TABLE "predictionmodel" DROP COLUMN "model_file";
@@ -1,8 +1,9 @@
 from datetime import datetime
 import dateutil
 from tortoise.exceptions import DoesNotExist, IntegrityError
-from server.eventbus import eventbus
+from server.eventbus import OVERFLOW_COALESCE, eventbus
 from server.events import DeviceSignalEvent, LearntDeviceSignalEvent, RoomStateChangeEvent, StartRecordingSignalsEvent, StopRecordingSignalsEvent, TrainPredictionModelEvent, TrainingProgressEvent
+from server.metrics import registry
 from server.models import Device, DeviceSignal, PredictionModel, Room, Scanner
 from ariadne import (
     ObjectType, ScalarType, MutationType, SubscriptionType,
@@ -226,6 +227,11 @@ async def resolve_prediction_models(_, info):
     return await PredictionModel.all().order_by('-created_at')
 
 
+@query.field("metrics")
+def resolve_metrics(_, info):
+    return registry.as_dict()
+
+
 @mutation.field("removePredictionModel")
 async def resolve_remove_prediction_model(_, info, id):
     try:
@@ -275,7 +281,9 @@ async def resolve_start_model_training(_, info, device):
 
 @subscription.source("deviceSignal")
 async def source_device_signal(_, info, device=None, scanner=None):
-    async with eventbus.subscribe(DeviceSignalEvent) as subscriber:
+    async with eventbus.subscribe(
+        DeviceSignalEvent, overflow=OVERFLOW_COALESCE, key=lambda e: (e.device.id, e.scanner_uuid)
+    ) as subscriber:
         async for event in subscriber:
             try:
                 scanner_obj = await Scanner.get(uuid=event.scanner_uuid)
@@ -315,7 +323,9 @@ async def resolve_model_training_progress_sub(_, info, device):
 
 @subscription.source("roomState")
 async def resolve_room_state_sub(_, info, room):
-    async with eventbus.subscribe(RoomStateChangeEvent) as subscriber:
+    async with eventbus.subscribe(
+        RoomStateChangeEvent, overflow=OVERFLOW_COALESCE, key=lambda e: e.room.id
+    ) as subscriber:
         async for event in subscriber:
             if not room or event.room.id == int(room):
                 yield event
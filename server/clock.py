@@ -0,0 +1,124 @@
+"""
+The time source of the tracking pipeline. Everything that needs the
+current time or has to wait for it goes through this module, so the
+pipeline can be driven by a replay or a virtual clock instead of the system one.
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime
+
+
+class SystemClock:
+    def timestamp(self):
+        return time.time()
+
+    def monotonic(self):
+        return time.monotonic()
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay)
+
+
+class ReplayClock:
+    """
+    Starts at the `start` timestamp and runs `speed` times faster
+    than the real time
+    """
+    def __init__(self, start, speed=1.0):
+        self.start = start
+        self.speed = speed
+        self.started_at = time.monotonic()
+
+    def timestamp(self):
+        return self.start + self.monotonic()
+
+    def monotonic(self):
+        return (time.monotonic() - self.started_at) * self.speed
+
+    async def sleep(self, delay):
+        await asyncio.sleep(delay / self.speed)
+
+
+class VirtualClock:
+    """
+    Starts at the `start` timestamp and stands still until it is advanced.
+    Sleepers wake up in the order of their deadlines, so a replay driven
+    by this clock does not depend on how fast the machine is
+    """
+    def __init__(self, start=0.0):
+        self.start = start
+        self.time = 0.0
+        self.sleepers = []
+        self.sleeping = {}
+        self.counter = itertools.count()
+
+    def timestamp(self):
+        return self.start + self.time
+
+    def monotonic(self):
+        return self.time
+
+    async def sleep(self, delay):
+        # Even a sleep without a delay waits for the clock to step, so a task
+        # catching up on missed deadlines cannot run ahead of the harness
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.sleepers, (self.time + max(delay, 0), next(self.counter), future))
+        task = asyncio.current_task()
+        self.sleeping[task] = future
+        try:
+            await future
+        finally:
+            self.sleeping.pop(task, None)
+
+    def is_sleeping(self, task):
+        future = self.sleeping.get(task)
+        return future is not None and not future.done()
+
+    def next_deadline(self):
+        while self.sleepers and self.sleepers[0][2].done():
+            heapq.heappop(self.sleepers)
+        return self.sleepers[0][0] if self.sleepers else None
+
+    def step(self, until):
+        """
+        Move to the earliest deadline not later than `until` and wake up
+        its sleepers, or move to `until` when there is none. Returns
+        False once the clock has got to `until`
+        """
+        deadline = self.next_deadline()
+        if deadline is None or deadline > until:
+            self.time = max(self.time, until)
+            return False
+
+        self.time = max(self.time, deadline)
+        while self.sleepers and self.sleepers[0][0] <= deadline:
+            _, _, future = heapq.heappop(self.sleepers)
+            if not future.done():
+                future.set_result(None)
+        return True
+
+
+source = SystemClock()
+
+
+def set_clock(clock):
+    global source
+    source = clock
+
+
+def timestamp():
+    return source.timestamp()
+
+
+def now():
+    return datetime.fromtimestamp(source.timestamp())
+
+
+def monotonic():
+    return source.monotonic()
+
+
+def sleep(delay):
+    return source.sleep(delay)
@@ -0,0 +1,212 @@
+"""
+Compiled representation of trained presence models.
+
+A model trained by `server.learn` is a OneVsOneClassifier of pipelines
+(SelectHighestMean → StandardScaler → RandomForestClassifier), one pipeline
+per pair of rooms. Evaluating it with sklearn costs input validation and
+a joblib round per pairwise forest, which dominates the time of a single
+row prediction. `compile_estimator` flattens all the trees of all the
+pairs into a few NumPy arrays, with the selected columns and the scaler
+folded in, and `CompiledEstimator` evaluates them for a matrix of rows
+at once, producing the same scores as the original estimator.
+"""
+import numpy as np
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.multiclass import OneVsOneClassifier
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler
+
+
+def ovo_scores(decision, n_classes):
+    """
+    Scores in [0, 1] of the decision function of OneVsOneClassifier: the
+    share of its pairs a class wins, i.e. its votes plus their squashed
+    confidences divided by the `n_classes - 1` pairs of the class. The
+    binary decision function only has the second class, the first one
+    is its complement. The best class stays the best.
+    """
+    decision = np.asarray(decision, dtype=np.float64)
+    if decision.ndim == 1:
+        decision = np.column_stack([1 - decision, decision])
+    return np.clip(decision / max(n_classes - 1, 1), 0, 1)
+
+
+class CompiledEstimator:
+    """
+    Drop-in replacement of `PresenceEstimator` evaluating flattened trees.
+
+    Trees are stored as one array of nodes. Every node has the column of
+    the transformed input it compares, the threshold, both children and
+    the normalized class values. Leaves point to themselves, so walking
+    all the trees for `depth` steps always ends in their leaves.
+    """
+    chunk_size = 64
+
+    def __init__(self, classes, columns, means, scales, pairs, n_trees, roots,
+                 features, thresholds, children, values, depth):
+        self.classes_ = classes
+        self.columns = columns
+        self.means = means
+        self.scales = scales
+        self.pairs = pairs
+        self.n_trees = n_trees
+        self.roots = roots
+        self.features = features
+        self.thresholds = thresholds
+        self.children = children
+        self.values = values
+        self.depth = depth
+
+        pairs = np.array(pairs, dtype=np.intp).reshape(-1, 2)
+        self.pair_classes = pairs.ravel()
+        self.first_classes = np.eye(len(classes))[pairs[:, 0]]
+        self.second_classes = np.eye(len(classes))[pairs[:, 1]]
+        self.flat_children = children.ravel()
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in (
+            'columns', 'means', 'scales', 'roots', 'features', 'thresholds', 'children', 'values'))
+
+    def transform(self, X):
+        """
+        Select and scale the columns of every pair, the same way as the pipelines
+        do, and cast them to float32 like the forests do before comparing
+        """
+        return ((X[:, self.columns] - self.means) / self.scales).astype(np.float32)
+
+    def apply(self, X):
+        """
+        Leaf index of every tree for every row. The trees are ordered
+        by their index in the forest first and by the pair then
+        """
+        return np.concatenate([
+            self.apply_chunk(X[start:start + self.chunk_size]) for start in range(0, len(X), self.chunk_size)
+        ]) if len(X) else np.zeros((0, len(self.roots)), dtype=np.intp)
+
+    def apply_chunk(self, X):
+        # Compare the inputs with the thresholds of all nodes at once,
+        # walking the trees is then only a lookup of the next node
+        Z = self.transform(X)
+        go_right = (np.take(Z, self.features, axis=1) > self.thresholds).ravel()
+        offsets = (np.arange(len(X)) * len(self.features))[:, np.newaxis]
+        nodes = np.tile(self.roots, (len(X), 1))
+        for _ in range(self.depth):
+            nodes = self.flat_children.take(nodes * 2 + go_right.take(nodes + offsets))
+        return nodes
+
+    def pair_proba(self, X):
+        """
+        Probabilities of both classes of every pairwise forest,
+        shape (rows, pairs, 2)
+        """
+        nodes = self.apply(X).reshape(len(X), self.n_trees, len(self.pairs))
+        # Sum over the first axis adds the trees one by one, as the forest does
+        leaves = self.values.take(nodes.transpose(1, 0, 2), axis=0)
+        return leaves.sum(axis=0) / self.n_trees
+
+    def decision_function(self, X):
+        """
+        The decision function of OneVsOneClassifier: the votes of the pairs plus
+        their confidences summed in the same order and squashed to (-1/3, 1/3)
+        """
+        proba = self.pair_proba(X)
+        predictions = (proba[:, :, 1] > proba[:, :, 0]).astype(np.float64)
+        confidences = proba[:, :, 1]
+
+        votes = (1 - predictions) @ self.first_classes + predictions @ self.second_classes
+        sum_of_confidences = np.zeros((len(X), len(self.classes_)))
+        signed_confidences = np.repeat(confidences, 2, axis=1)
+        signed_confidences[:, 0::2] *= -1
+        np.add.at(sum_of_confidences, (slice(None), self.pair_classes), signed_confidences)
+
+        return votes + sum_of_confidences / (3 * (np.abs(sum_of_confidences) + 1))
+
+    def scores(self, data):
+        return ovo_scores(self.decision_function(np.asarray(data, dtype=np.float64)), len(self.classes_))
+
+    def predict_proba(self, data_row):
+        pred_result = list(zip(self.classes_, self.scores(data_row)[0]))
+        max_pred_result = [max(pred_result, key=lambda x: x[1])]
+        return [dict(max_pred_result)]
+
+    def predict_proba_batch(self, data):
+        scores = self.scores(data)
+        best = np.argmax(scores, axis=1)
+        return [{self.classes_[i]: row[i]} for i, row in zip(best, scores)]
+
+
+def get_pair_steps(pipeline):
+    """
+    Column indexes, scaler and forest of a pairwise pipeline
+    """
+    if not isinstance(pipeline, Pipeline) or len(pipeline.steps) != 3:
+        raise ValueError('Unsupported pairwise estimator {!r}'.format(pipeline))
+
+    select, scale, forest = [step for _, step in pipeline.steps]
+    if not isinstance(scale, StandardScaler) or not isinstance(forest, RandomForestClassifier):
+        raise ValueError('Unsupported pairwise pipeline {!r}'.format(pipeline))
+    if forest.n_outputs_ != 1 or len(forest.classes_) != 2:
+        raise ValueError('Only binary single output forests are supported')
+
+    columns = np.flatnonzero(select.get_support())
+    means = scale.mean_ if scale.with_mean and scale.mean_ is not None else np.zeros(len(columns))
+    scales = scale.scale_ if scale.with_std and scale.scale_ is not None else np.ones(len(columns))
+    return columns, means, scales, forest
+
+
+def compile_estimator(estimator):
+    """
+    Compile a trained `PresenceEstimator` into a `CompiledEstimator`.
+    Raises ValueError when the model has a structure we cannot compile.
+    """
+    ovo = getattr(estimator, 'estimator', estimator)
+    if not isinstance(ovo, OneVsOneClassifier) or ovo.pairwise_indices_ is not None:
+        raise ValueError('Unsupported estimator {!r}'.format(ovo))
+
+    n_classes = len(ovo.classes_)
+    pairs = [(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)]
+    steps = [get_pair_steps(pipeline) for pipeline in ovo.estimators_]
+    n_trees = len(steps[0][3].estimators_)
+    if any(len(forest.estimators_) != n_trees for _, _, _, forest in steps):
+        raise ValueError('All pairwise forests must have the same number of trees')
+
+    offsets = np.cumsum([0] + [len(columns) for columns, _, _, _ in steps])
+    roots, features, thresholds, children, values = [], [], [], [], []
+    nodes_count, depth = 0, 0
+
+    for index in range(n_trees):
+        for pair, (_, _, _, forest) in enumerate(steps):
+            tree = forest.estimators_[index].tree_
+            leaves = tree.children_left == -1
+            node_ids = np.arange(tree.node_count) + nodes_count
+
+            value = tree.value[:, 0, :2].astype(np.float64)
+            normalizer = value.sum(axis=1)[:, np.newaxis]
+            normalizer[normalizer == 0.0] = 1.0
+
+            roots.append(nodes_count)
+            features.append(np.where(leaves, 0, tree.feature) + offsets[pair])
+            thresholds.append(np.where(leaves, np.inf, tree.threshold))
+            children.append(np.column_stack([
+                np.where(leaves, node_ids, tree.children_left + nodes_count),
+                np.where(leaves, node_ids, tree.children_right + nodes_count),
+            ]))
+            values.append(value / normalizer)
+            nodes_count += tree.node_count
+            depth = max(depth, tree.max_depth)
+
+    return CompiledEstimator(
+        classes=ovo.classes_,
+        columns=np.concatenate([columns for columns, _, _, _ in steps]),
+        means=np.concatenate([means for _, means, _, _ in steps]),
+        scales=np.concatenate([scales for _, _, scales, _ in steps]),
+        pairs=pairs,
+        n_trees=n_trees,
+        roots=np.array(roots, dtype=np.intp),
+        features=np.concatenate(features).astype(np.intp),
+        thresholds=np.concatenate(thresholds),
+        children=np.concatenate(children).astype(np.intp),
+        values=np.concatenate(values),
+        depth=depth,
+    )
@@ -9,6 +9,21 @@ MQTT_BROKER_PORT = config('MQTT_BROKER_PORT', cast=int, default=1883)
 MQTT_USERNAME = config('MQTT_USERNAME', cast=str)
 MQTT_PASSWORD = config('MQTT_PASSWORD', cast=Secret)
 DATABASE_URI = config('DATABASE_URI', cast=Secret, default='sqlite://data.sqlite3')
+MQTT_BATCH_INGEST = config('MQTT_BATCH_INGEST', cast=bool, default=False)
+TRACKING_WORKERS = config('TRACKING_WORKERS', cast=int, default=0)
+MODEL_STORE_DIR = config('MODEL_STORE_DIR', cast=str, default='models')
+MODEL_REGISTRY_MEMORY_MB = config('MODEL_REGISTRY_MEMORY_MB', cast=int, default=512)
+INFERENCE_THREADS = config('INFERENCE_THREADS', cast=int, default=2)
+TRAINING_THREADS = config('TRAINING_THREADS', cast=int, default=1)
+TRAINING_N_JOBS = config('TRAINING_N_JOBS', cast=int, default=-2)
+PREDICT_BATCH_WINDOW_SEC = config('PREDICT_BATCH_WINDOW_SEC', cast=float, default=0.05)
+PREDICTION_CACHE_SIZE = config('PREDICTION_CACHE_SIZE', cast=int, default=0)
+PREDICTION_CACHE_RSSI_RESOLUTION = config('PREDICTION_CACHE_RSSI_RESOLUTION', cast=float, default=1.0)
+MQTT_PUBLISH_QOS = config('MQTT_PUBLISH_QOS', cast=int, default=0)
+MQTT_PUBLISH_RETAIN = config('MQTT_PUBLISH_RETAIN', cast=bool, default=False)
+MQTT_PUBLISH_CONCURRENCY = config('MQTT_PUBLISH_CONCURRENCY', cast=int, default=8)
+MQTT_PUBLISH_RATE = config('MQTT_PUBLISH_RATE', cast=float, default=0)
+MQTT_DISCOVERY_RETAIN = config('MQTT_DISCOVERY_RETAIN', cast=bool, default=False)
 
 TORTOISE_ORM = {
     "connections": {
@@ -21,3 +36,16 @@ TORTOISE_ORM = {
         },
     },
 }
+
+# An in-memory database for replays and tests
+MEMORY_TORTOISE_ORM = {
+    "connections": {
+        "default": "sqlite://:memory:"
+    },
+    "apps": {
+        "models": {
+            "models": ["server.models"],
+            "default_connection": "default",
+        },
+    },
+}
@@ -6,3 +6,23 @@ DEVICE_CHANGE_STATE_BEATS = 10
 DEVICE_CHANGE_STATE_SECONDS = 15
 KALMAN_R = 0.15
 KALMAN_Q = 10.0
+MQTT_BATCH_MAX_SIZE = 500
+MQTT_BATCH_MAX_DELAY_SEC = 0.05
+MQTT_INGEST_STATS_WINDOW_SEC = 10
+MQTT_BATCH_QUEUE_SIZE = 10000
+MQTT_PUBLISH_RETRY_DELAY_SEC = 0.5
+MQTT_PUBLISH_MAX_RETRY_DELAY_SEC = 30
+ROUTING_CACHE_SIZE = 4096
+HEARTBEAT_SCHEDULER_SLOTS = 8
+SUBSCRIPTION_QUEUE_SIZE = 1000
+HEARTBEAT_CHANGE_DELTA = 0.5
+HEARTBEAT_CHANGE_QUANTUM = None
+HEARTBEAT_MAX_SILENCE_SEC = 30
+PREDICT_BATCH_MAX_SIZE = 256
+LEARN_FLUSH_MAX_SIZE = 500
+LEARN_FLUSH_INTERVAL_SEC = 1.0
+LEARN_LOAD_CHUNK_SIZE = 10000
+SHARD_QUEUE_SIZE = 1000
+SHARD_STOP_TIMEOUT_SEC = 5
+MODEL_STORE_GC_GRACE_SEC = 3600
+EXECUTOR_MAX_YIELD_SEC = 2.0
@@ -2,52 +2,90 @@ import asyncio
 from asyncio.coroutines import iscoroutine
 from asyncio.events import AbstractEventLoop
 from asyncio.futures import Future
-from asyncio.queues import Queue
-from collections import namedtuple
+from collections import deque, namedtuple
 import inspect
 import logging
+from types import MethodType
+
+from server.constants import SUBSCRIPTION_QUEUE_SIZE
+
+OVERFLOW_DROP_OLDEST = 'drop_oldest'
+OVERFLOW_DROP_NEWEST = 'drop_newest'
+OVERFLOW_COALESCE = 'coalesce'
 
 
 class EventBus:
     event_method = {}
+    dispatch_tables = {}
+    subscriptions = set()
 
     def post(self, event):
-        self.print_debug_message(event)
-
-        results = []
-        methods = self.event_method.get(event.__class__, {})
-        for method, decriptor in methods.items():
-            instances, with_instance = decriptor
-
+        """
+        Run the subscribers of the event. Sync subscribers are called
+        inline, coroutine subscribers are scheduled and the returned
+        future completes when all of them are done (None when there
+        was nothing to schedule).
+        """
+        handlers = self.dispatch_tables.get(event.__class__)
+        if handlers is None:
+            handlers = self.compile_dispatch_table(event.__class__)
+
+        log_level = getattr(event, 'log_level', None)
+        if log_level is not None and logging.root.isEnabledFor(log_level):
+            logging.log(log_level, '%s', event)
+
+        coroutines = None
+        for handler in handlers:
+            result = handler(event)
+            if iscoroutine(result):
+                if coroutines is None:
+                    coroutines = [result]
+                else:
+                    coroutines.append(result)
+
+        if coroutines is None:
+            return None
+
+        results_fut = asyncio.ensure_future(coroutines[0]) if len(coroutines) == 1 else asyncio.gather(*coroutines)
+        results_fut.add_done_callback(self.log_handler_errors)
+        return results_fut
+
+    def compile_dispatch_table(self, on_event):
+        handlers = []
+        for method, descriptor in self.event_method.get(on_event, {}).items():
+            instances, with_instance = descriptor
+            function = getattr(method, '__wrapped__', method)
             if not with_instance:
-                results.append(self.call(method=method, with_event=event, subscriber=None))
+                handlers.append(function)
             else:
-                for instance in instances:
-                    results.append(self.call(method=method, with_event=event, subscriber=instance))
-
-        return_fut = asyncio.get_running_loop().create_future()
-        results_fut = asyncio.gather(*results)
-        results_fut.add_done_callback(lambda x: return_fut.set_result(True))
-        return return_fut
-
-    def call(self, method, with_event, subscriber):
-        result = method(subscriber, with_event) if subscriber else method(with_event)
-        if iscoroutine(result):
-            return result
-        else:
-            fut = asyncio.get_running_loop().create_future()
-            fut.set_result(result)
-            return fut
+                handlers.extend(MethodType(function, instance) for instance in instances)
+
+        handlers = tuple(handlers)
+        self.dispatch_tables[on_event] = handlers
+        return handlers
+
+    def invalidate_dispatch_table(self, on_event):
+        self.dispatch_tables.pop(on_event, None)
+
+    def log_handler_errors(self, results_fut):
+        if results_fut.cancelled():
+            return
+
+        error = results_fut.exception()
+        if error is not None and not isinstance(error, asyncio.CancelledError):
+            logging.error('Event subscriber failed: %r', error)
 
     def register_instance_subscribers(self, instance, methods, on_event=None):
         for method in methods:
             method_event = method._subscriber if not on_event else on_event
             self.event_method[method_event][method][0].add(instance)
+            self.invalidate_dispatch_table(method_event)
 
     def remove_instance_subscribers(self, instance, methods, on_event=None):
         for method in methods:
             method_event = method._subscriber if not on_event else on_event
-            self.event_method[method_event][method][0].remove(instance)
+            self.event_method[method_event][method][0].discard(instance)
+            self.invalidate_dispatch_table(method_event)
 
     def add_subscriber_method(self, on_event, method, with_instance):
         descriptor = (set(), with_instance)
@@ -55,18 +93,88 @@ class EventBus:
             self.event_method[on_event][method] = descriptor
         else:
             self.event_method[on_event] = {method: descriptor}
+        self.invalidate_dispatch_table(on_event)
 
     def remove_subscriber_method(self, on_event, method):
         if on_event in self.event_method:
             self.event_method[on_event].pop(method)
+            self.invalidate_dispatch_table(on_event)
+
+    def subscribe(self, on_event, maxsize=SUBSCRIPTION_QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST, key=None):
+        return AsyncEventsIterator(self, on_event, maxsize=maxsize, overflow=overflow, key=key)
+
+    def subscriptions_stats(self):
+        return [s.stats() for s in self.subscriptions]
+
+
+class EventsQueue():
+    """
+    A single consumer queue of events with an optional size limit.
+    When the queue is full the overflow policy decides what is lost:
+    the oldest event, the newest event, or – when coalescing – only
+    the events with the same key are merged into the latest one and
+    the oldest key is dropped when there is still no room.
+    """
+    def __init__(self, maxsize=0, overflow=OVERFLOW_DROP_OLDEST, key=None):
+        if overflow == OVERFLOW_COALESCE and key is None:
+            raise ValueError('Coalescing queue requires a key function')
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.key = key
+        self.items = {} if overflow == OVERFLOW_COALESCE else deque()
+        self.waiter = None
+        self.closed = False
+        self.dropped = 0
+        self.coalesced = 0
+        self.high_water = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def is_full(self):
+        return self.maxsize > 0 and len(self.items) >= self.maxsize
+
+    def put_nowait(self, item):
+        if self.overflow == OVERFLOW_COALESCE:
+            item_key = self.key(item)
+            if item_key in self.items:
+                self.coalesced += 1
+            elif self.is_full():
+                del self.items[next(iter(self.items))]
+                self.dropped += 1
+            self.items[item_key] = item
+        elif self.is_full():
+            self.dropped += 1
+            if self.overflow == OVERFLOW_DROP_NEWEST:
+                return
+            self.items.popleft()
+            self.items.append(item)
+        else:
+            self.items.append(item)
+
+        self.high_water = max(self.high_water, len(self.items))
+        self.wakeup()
 
-    def subscribe(self, on_event):
-        return AsyncEventsIterator(self, on_event)
+    def close(self):
+        self.closed = True
+        self.wakeup()
 
-    def print_debug_message(self, event):
-        event_log_level = getattr(event, 'log_level', None)
-        if event_log_level is not None and event_log_level >= logging.root.level:
-            logging.log(event_log_level, str(event))
+    def wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def get(self):
+        while not self.items:
+            if self.closed:
+                return None
+            self.waiter = asyncio.get_running_loop().create_future()
+            await self.waiter
+            self.waiter = None
+
+        if self.overflow == OVERFLOW_COALESCE:
+            return self.items.pop(next(iter(self.items)))
+        return self.items.popleft()
 
 
 class AsyncEventsIterator():
@@ -75,14 +183,14 @@ class AsyncEventsIterator():
     loop: AbstractEventLoop
     future_event: Future
 
-    def __init__(self, eventbus, on_event):
+    def __init__(self, eventbus, on_event, maxsize=SUBSCRIPTION_QUEUE_SIZE, overflow=OVERFLOW_DROP_OLDEST, key=None):
         self.on_event = on_event
         self.eventbus = eventbus
         self.loop = asyncio.get_running_loop()
-        self.queue = Queue()
+        self.queue = EventsQueue(maxsize=maxsize, overflow=overflow, key=key)
         self.stopped = False
 
-    async def event_receiver(self, event):
+    def event_receiver(self, event):
         if not self.stopped:
             self.queue.put_nowait(event)
 
@@ -98,6 +206,7 @@ class AsyncEventsIterator():
 
     async def __aenter__(self):
         self.eventbus.add_subscriber_method(self.on_event, self.event_receiver, False)
+        self.eventbus.subscriptions.add(self)
         return self
 
     async def __aexit__(self, exc_type, exc, tb):
@@ -107,7 +216,19 @@ class AsyncEventsIterator():
         if not self.stopped:
             self.stopped = True
             self.eventbus.remove_subscriber_method(self.on_event, self.event_receiver)
-            self.queue.put_nowait(None)
+            self.eventbus.subscriptions.discard(self)
+            self.queue.close()
+
+    def stats(self):
+        return {
+            'event': self.on_event.__name__,
+            'overflow': self.queue.overflow,
+            'size': len(self.queue),
+            'maxsize': self.queue.maxsize,
+            'dropped': self.queue.dropped,
+            'coalesced': self.queue.coalesced,
+            'high_water': self.queue.high_water,
+        }
 
 
 class EventBusMetaclass(type):
@@ -131,6 +252,7 @@ def subscribe(on_event):
             return function(*args, **kwargs)
 
         wrapper._subscriber = on_event
+        wrapper.__wrapped__ = function
         spec = inspect.signature(function)
         with_instance = len(spec.parameters) == 2
 
@@ -18,14 +18,16 @@ class LearntDeviceSignalEvent(namedtuple(
 
 class HeartbeatEvent(namedtuple(
     'HeartbeatEvent',
-    'device, signals, timestamp'
+    'device, signals, timestamp, significant, trace',
+    defaults=(True, None)
 )):
     log_level = logging.DEBUG
 
 
 class OccupancyEvent(namedtuple(
     'OccupancyEvent',
-    'device, room_occupancy, signals'
+    'device, room_occupancy, signals, trace',
+    defaults=(None,)
 )):
     log_level = logging.INFO
 
@@ -46,7 +48,16 @@ class MQTTDisconnectedEvent(namedtuple(
 
 class MQTTMessageEvent(namedtuple(
     'MQTTMessage',
-    'topic, payload'
+    'topic, payload, received',
+    defaults=(None,)
+)):
+    log_level = logging.DEBUG
+
+
+class MQTTMessageBatchEvent(namedtuple(
+    'MQTTMessageBatch',
+    'messages, received',
+    defaults=(None,)
 )):
     log_level = logging.DEBUG
 
@@ -79,6 +90,17 @@ class RoomRemovedEvent(namedtuple(
     log_level = logging.INFO
 
 
+class TopologyChangedEvent():
+    log_level = logging.INFO
+
+
+class PredictionModelChangedEvent(namedtuple(
+    'PredictionModelChangedEvent',
+    'model_id'
+)):
+    log_level = logging.INFO
+
+
 class RoomStateChangeEvent(namedtuple(
     'RoomStateChangeEvent',
     'room, state, devices'
@@ -1,14 +1,20 @@
 import asyncio
 import logging
+import sys
+
+import numpy as np
 
 from server.events import (
-    DeviceAddedEvent, DeviceRemovedEvent, DeviceSignalEvent, HeartbeatEvent, MQTTConnectedEvent, MQTTMessageEvent,
-    StartRecordingSignalsEvent)
+    DeviceAddedEvent, DeviceRemovedEvent, DeviceSignalEvent, HeartbeatEvent, MQTTConnectedEvent, MQTTMessageBatchEvent,
+    MQTTMessageEvent, StartRecordingSignalsEvent)
 from server.eventbus import EventBusSubscriber, eventbus, subscribe
-from server.kalman import KalmanRSSI
-from datetime import datetime
+from server.kalman import KalmanBank
+from server import clock
+from server.metrics import Trace
 from server.constants import (
-    SCANNERS_TOPIC, LONG_DELAY_PENALTY_SEC, HEARTBEAT_COLLECT_PERIOD_SEC, KALMAN_R, KALMAN_Q, TURN_OFF_DEVICE_SEC)
+    SCANNERS_TOPIC, LONG_DELAY_PENALTY_SEC, HEARTBEAT_COLLECT_PERIOD_SEC, KALMAN_R, KALMAN_Q, TURN_OFF_DEVICE_SEC,
+    ROUTING_CACHE_SIZE, HEARTBEAT_SCHEDULER_SLOTS, HEARTBEAT_CHANGE_DELTA, HEARTBEAT_CHANGE_QUANTUM,
+    HEARTBEAT_MAX_SILENCE_SEC)
 
 
 def normalize_uuid(uuid: str):
@@ -16,89 +22,304 @@ def normalize_uuid(uuid: str):
 
 
 def normalize_scanner_payload(payload):
+    when = payload.get('when')
     return {
         'name': payload.get('name', ''),
         'uuid': normalize_uuid(payload.get('uuid', '')),
         'rssi': int(payload.get('rssi', '-100')),
-        'when': payload.get('when', datetime.now().timestamp()),
+        'when': when if when is not None else clock.timestamp(),
     }
 
 
-class UnfilteredRSSI():
-    def __init__(self) -> None:
-        self.x = -100
+def cache_put(cache, key, value, max_size):
+    if len(cache) >= max_size:
+        del cache[next(iter(cache))]
+    cache[key] = value
+
+
+class MessageRouter:
+    """
+    Resolves scanner messages to device trackers without normalizing
+    the payloads of advertisers nobody tracks. Topics are resolved to
+    interned scanner ids once, and raw uuid/name pairs are cached
+    together with the tracker they belong to (or None for unknown
+    advertisers). Both caches are bounded and the advertisers cache
+    is dropped every time the set of trackers changes.
+    """
+    def __init__(self, cache_size=ROUTING_CACHE_SIZE):
+        self.cache_size = cache_size
+        self.trackers = {}
+        self.scanners = {}
+        self.advertisers = {}
+
+    def rebuild(self, trackers):
+        self.trackers = dict(trackers)
+        self.advertisers = {}
+
+    def route_topic(self, topic):
+        try:
+            return self.scanners[topic]
+        except KeyError:
+            scanner = sys.intern(topic.split('/')[1]) if topic.startswith(SCANNERS_TOPIC) else None
+            cache_put(self.scanners, topic, scanner, self.cache_size)
+            return scanner
+
+    def route_advertiser(self, payload):
+        key = (payload.get('uuid', ''), payload.get('name', ''))
+        try:
+            return self.advertisers[key]
+        except KeyError:
+            tracker = (
+                self.trackers.get(normalize_uuid(key[0]))
+                or self.trackers.get(key[1])
+            )
+            cache_put(self.advertisers, key, tracker, self.cache_size)
+            return tracker
+
+    def route(self, topic, payload):
+        scanner = self.route_topic(topic)
+        if scanner is None:
+            return None, None
 
-    def filter(self, x):
-        self.x = x
-        return x
+        return scanner, self.route_advertiser(payload)
 
 
 class HeratbeatGenerator:
+    """
+    Keeps the per-scanner state of a device in arrays indexed by a fixed
+    scanner slot. A scanner gets its slot when it is seen for the first
+    time, so the penalty, turn-off and long-delay rules can be applied
+    to all scanners at once as boolean masks.
+    """
     def __init__(
         self, scanners=None, kalman=None, silent_scanner_penalty=None, long_delay=None,
         turn_off_delay=None, device=None
     ) -> None:
-        scanners = scanners or []
-        self.values = dict(zip(scanners, [-100] * len(scanners)))
-        self.last_change = dict(zip(scanners, [0] * len(scanners)))
-        self.last_signal = dict(zip(scanners, [0] * len(scanners)))
-        self.appeared = dict(zip(scanners, [True] * len(scanners)))
+        self.slots = {}
+        self.scanners = []
+        self.values = np.empty(0)
+        self.last_change = np.empty(0)
+        self.last_signal = np.empty(0)
+        self.filters = KalmanBank(R=kalman[0], Q=kalman[1]) if kalman else None
         self.silent_scanner_penalty = silent_scanner_penalty
         self.turn_off_delay = turn_off_delay
         self.long_delay = long_delay
-        self.filters = {} if kalman is not None else None
-        self.kalman = kalman
         self.device = device
 
-    def process(self, signals, time, period):
-        silent_scanners = set(self.values.keys())
+        for scanner in scanners or []:
+            self.add_scanner(scanner)
+
+    def add_scanner(self, scanner):
+        slot = len(self.scanners)
+        self.slots[scanner] = slot
+        self.scanners.append(scanner)
+        self.values = np.append(self.values, -100.0)
+        self.last_change = np.append(self.last_change, 0.0)
+        self.last_signal = np.append(self.last_signal, 0.0)
+        if self.filters is not None:
+            self.filters.resize(len(self.scanners))
+        return slot
+
+    def filter(self, slots, rssi):
+        if self.filters is None:
+            return np.asarray(rssi, dtype=float)
+        return self.filters.filter(slots, rssi)
+
+    def log_penalty(self, mask, penalty):
+        if logging.root.isEnabledFor(logging.INFO):
+            for slot in np.flatnonzero(mask):
+                logging.info('%s scanner %s %s penalty', repr(self.device), self.scanners[slot], penalty)
 
+    def process(self, signals, time, period):
+        # Split the signals into rounds where every scanner appears at
+        # most once, so each round steps the filters in a single call
+        # while signals of the same scanner are still applied in order.
+        rounds = []
+        counts = {}
         for s in signals:
-            scanner = s['scanner']
-            silent_scanners -= set([scanner])
-
-            if scanner not in self.filters:
-                if self.kalman:
-                    self.filters[scanner] = KalmanRSSI(R=self.kalman[0], Q=self.kalman[1])
-                else:
-                    self.filters[scanner] = UnfilteredRSSI()
-
-            self.values[scanner] = self.filters[scanner].filter(s['rssi'])
-            self.appeared[scanner] = True
-            self.last_change[scanner] = s['when']
-            self.last_signal[scanner] = s['when']
-
-        for scanner in self.values.keys():
-            last_change_delay = time - self.last_change[scanner]
-            last_signal_delay = time - self.last_signal[scanner]
-
-            if self.silent_scanner_penalty is not None and scanner in silent_scanners:
-                penalty_signal = max(self.values.get(scanner, -100) - self.silent_scanner_penalty, -100)
-                self.values[scanner] = self.filters[scanner].filter(penalty_signal)
-                self.last_change[scanner] = time
-                logging.info('%s scanner %s silent scanner penalty', repr(self.device), scanner)
-
-            if self.turn_off_delay is not None and last_signal_delay >= self.turn_off_delay:
-                self.values[scanner] = -100
-                self.last_change[scanner] = time
-                self.last_signal[scanner] = time
-                logging.info('%s scanner %s turn off penalty', repr(self.device), scanner)
-
-            elif self.long_delay is not None and last_change_delay >= self.long_delay:
-                self.values[scanner] = self.filters[scanner].filter(-100)
-                self.last_change[scanner] = time
-                logging.info('%s scanner %s long delay penalty', repr(self.device), scanner)
+            slot = self.slots.get(s['scanner'])
+            if slot is None:
+                slot = self.add_scanner(s['scanner'])
+
+            n = counts.get(slot, 0)
+            counts[slot] = n + 1
+            if n == len(rounds):
+                rounds.append(([], []))
+            rounds[n][0].append(slot)
+            rounds[n][1].append(s['rssi'])
+            self.last_change[slot] = s['when']
+            self.last_signal[slot] = s['when']
+
+        for slots, rssi in rounds:
+            self.values[slots] = self.filter(slots, rssi)
+
+        seen = list(counts)
+        last_change_delay = time - self.last_change
+        last_signal_delay = time - self.last_signal
+
+        if self.silent_scanner_penalty is not None:
+            silent = np.ones(len(self.scanners), dtype=bool)
+            silent[seen] = False
+            penalty_signals = np.maximum(self.values[silent] - self.silent_scanner_penalty, -100)
+            self.values[silent] = self.filter(np.flatnonzero(silent), penalty_signals)
+            self.last_change[silent] = time
+            self.log_penalty(silent, 'silent scanner')
+
+        turned_off = np.zeros(len(self.scanners), dtype=bool)
+        if self.turn_off_delay is not None:
+            turned_off = last_signal_delay >= self.turn_off_delay
+            self.values[turned_off] = -100
+            self.last_change[turned_off] = time
+            self.last_signal[turned_off] = time
+            self.log_penalty(turned_off, 'turn off')
+
+        if self.long_delay is not None:
+            delayed = ~turned_off & (last_change_delay >= self.long_delay)
+            self.values[delayed] = self.filter(np.flatnonzero(delayed), np.full(delayed.sum(), -100.0))
+            self.last_change[delayed] = time
+            self.log_penalty(delayed, 'long delay')
 
         return self.create_heartbeat(signals, time)
 
     def create_heartbeat(self, signals, time):
-        return dict(self.values)
+        return dict(zip(self.scanners, self.values.tolist()))
+
+
+class HeartbeatScheduler:
+    """
+    Ticks all device trackers from a single task. The collect period
+    is split into the slots of a timer wheel and every tracker is bound
+    to the least loaded slot, so the heartbeats (and the predictions
+    behind them) of different devices are spread over the period
+    instead of firing all at once.
+    """
+    def __init__(self, period=HEARTBEAT_COLLECT_PERIOD_SEC, slots=HEARTBEAT_SCHEDULER_SLOTS):
+        self.period = period
+        self.tick_interval = period / slots
+        self.slots = [{} for _ in range(slots)]
+        self.tracker_slots = {}
+        self.task = None
+        self.ticks = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def add(self, tracker):
+        self.remove(tracker)
+        slot = min(range(len(self.slots)), key=lambda i: len(self.slots[i]))
+        self.slots[slot][tracker] = None
+        self.tracker_slots[tracker] = slot
+        self.start()
+
+    def remove(self, tracker):
+        slot = self.tracker_slots.pop(tracker, None)
+        if slot is not None:
+            del self.slots[slot][tracker]
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def run(self):
+        slot = 0
+        next_tick = clock.monotonic() + self.tick_interval
+
+        while True:
+            await clock.sleep(max(next_tick - clock.monotonic(), 0))
+            now = clock.monotonic()
+            self.record_lag(now - next_tick)
+            self.tick(slot)
+
+            slot = (slot + 1) % len(self.slots)
+            next_tick += self.tick_interval
+
+            # Too far behind to catch up, skip the missed ticks
+            if now - next_tick > self.period:
+                next_tick = now + self.tick_interval
+
+    def tick(self, slot):
+        timestamp = clock.timestamp()
+        for tracker in list(self.slots[slot]):
+            try:
+                tracker.create_heartbeat(timestamp)
+            except Exception as e:
+                logging.error(e)
+
+    def record_lag(self, lag):
+        self.ticks += 1
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        self.total_lag += lag
+
+    def stats(self):
+        return {
+            'trackers': len(self.tracker_slots),
+            'ticks': self.ticks,
+            'last_lag': self.last_lag,
+            'max_lag': self.max_lag,
+            'avg_lag': self.total_lag / self.ticks if self.ticks else 0.0,
+        }
+
+
+class HeartbeatChangeDetector:
+    """
+    Decides whether a heartbeat differs enough from the last significant
+    one to be worth a new prediction. Values are compared either with
+    a per-scanner delta or, when a quantum is given, after rounding
+    them to that step. A heartbeat is always significant when the set
+    of scanners or the device presence changes, or when nothing
+    significant was emitted for `max_silence` seconds.
+    """
+    def __init__(
+        self, delta=HEARTBEAT_CHANGE_DELTA, quantum=HEARTBEAT_CHANGE_QUANTUM,
+        max_silence=HEARTBEAT_MAX_SILENCE_SEC
+    ):
+        self.delta = delta
+        self.quantum = quantum
+        self.max_silence = max_silence
+        self.last_heartbeat = None
+        self.last_timestamp = None
+        self.significant = 0
+        self.skipped = 0
+
+    def quantize(self, value):
+        return round(value / self.quantum)
+
+    def values_changed(self, heartbeat):
+        last = self.last_heartbeat
+        if self.quantum:
+            return any(self.quantize(v) != self.quantize(last[k]) for k, v in heartbeat.items())
+        return any(abs(v - last[k]) > self.delta for k, v in heartbeat.items())
+
+    def is_significant(self, heartbeat, timestamp):
+        last = self.last_heartbeat
+        significant = (
+            last is None
+            or heartbeat.keys() != last.keys()
+            or (max(heartbeat.values()) > -99.0) != (max(last.values()) > -99.0)
+            or (self.max_silence is not None and timestamp - self.last_timestamp >= self.max_silence)
+            or self.values_changed(heartbeat)
+        )
+
+        if significant:
+            self.last_heartbeat = heartbeat
+            self.last_timestamp = timestamp
+            self.significant += 1
+        else:
+            self.skipped += 1
+
+        return significant
 
 
 class DeviceTracker:
-    def __init__(self, device):
+    def __init__(self, device, scheduler):
         self.device = device
-        self.coroutine = None
+        self.scheduler = scheduler
         self.reset_generator()
 
     @subscribe(StartRecordingSignalsEvent)
@@ -106,15 +327,18 @@ class DeviceTracker:
         self.reset_generator()
 
     def stop(self):
-        if self.coroutine:
-            self.coroutine.cancel()
-            self.coroutine = None
+        self.scheduler.remove(self)
         self.reset_generator()
 
     def track(self):
-        self.coroutine = asyncio.create_task(self.next_cycle())
+        self.scheduler.add(self)
+
+    def process_signal(self, scanner_uuid, signal, received=None):
+        # The heartbeat is traced from the oldest signal it is made of,
+        # the later signals of the same heartbeat are not traced
+        if self.trace is None:
+            self.trace = Trace(received=received).mark('processed')
 
-    def process_signal(self, scanner_uuid, signal):
         self.collected_signals.append({
             'scanner': scanner_uuid,
             'rssi': signal['rssi'],
@@ -124,23 +348,17 @@ class DeviceTracker:
 
     def reset_generator(self):
         self.collected_signals = []
+        self.trace = None
         self.last_heartbeat = None
+        self.change_detector = HeartbeatChangeDetector()
         self.gen = HeratbeatGenerator(
             long_delay=LONG_DELAY_PENALTY_SEC, kalman=(KALMAN_R, KALMAN_Q),
             turn_off_delay=TURN_OFF_DEVICE_SEC, device=self.device)
 
-    async def next_cycle(self):
-        try:
-            await asyncio.sleep(HEARTBEAT_COLLECT_PERIOD_SEC)
-            self.create_heartbeat()
-            self.track()
-        except Exception as e:
-            logging.error(e)
-
     def create_heartbeat(self, timestamp=None):
-        timestamp = timestamp or datetime.now().timestamp()
-        signals = self.collected_signals
-        self.collected_signals = []
+        timestamp = timestamp or clock.timestamp()
+        signals, trace = self.collected_signals, self.trace
+        self.collected_signals, self.trace = [], None
         heartbeat = self.gen.process(
             signals, timestamp, HEARTBEAT_COLLECT_PERIOD_SEC)
 
@@ -148,7 +366,9 @@ class DeviceTracker:
             self.last_heartbeat = heartbeat
             final_heartbeat = heartbeat if max(heartbeat.values()) > -99.0 else None
             self.send_heartbeat_event(HeartbeatEvent(
-                device=self.device, signals=final_heartbeat, timestamp=timestamp))
+                device=self.device, signals=final_heartbeat, timestamp=timestamp,
+                significant=self.change_detector.is_significant(heartbeat, timestamp),
+                trace=(trace or Trace()).mark('heartbeat')))
 
     def send_heartbeat_event(self, event):
         eventbus.post(event)
@@ -161,14 +381,17 @@ class Heartbeat(EventBusSubscriber):
     def __init__(self):
         super().__init__()
         self.device_trackers = {}
+        self.router = MessageRouter()
+        self.scheduler = HeartbeatScheduler()
 
     @subscribe(DeviceAddedEvent)
     def handle_device_added(self, event):
         if event.device.identifier in self.device_trackers:
             self.device_trackers[event.device.identifier].stop()
 
-        tracker = DeviceTracker(event.device)
+        tracker = DeviceTracker(event.device, self.scheduler)
         self.device_trackers[event.device.identifier] = tracker
+        self.router.rebuild(self.device_trackers)
         tracker.track()
 
     @subscribe(DeviceRemovedEvent)
@@ -176,6 +399,7 @@ class Heartbeat(EventBusSubscriber):
         if event.device.identifier in self.device_trackers:
             self.device_trackers[event.device.identifier].stop()
             del self.device_trackers[event.device.identifier]
+            self.router.rebuild(self.device_trackers)
 
     @subscribe(MQTTConnectedEvent)
     async def handle_mqtt_connect(self, event):
@@ -183,17 +407,14 @@ class Heartbeat(EventBusSubscriber):
 
     @subscribe(MQTTMessageEvent)
     def handle_mqtt_message(self, event):
-        if not event.topic.startswith(SCANNERS_TOPIC):
-            return
+        self.process_message(event.topic, event.payload, event.received)
 
-        payload = normalize_scanner_payload(event.payload)
-        tracker = (
-            self.device_trackers.get(payload['uuid'])
-            or self.device_trackers.get(payload['name'])
-        )
+    @subscribe(MQTTMessageBatchEvent)
+    def handle_mqtt_message_batch(self, event):
+        for topic, payload in event.messages:
+            self.process_message(topic, payload, event.received)
 
+    def process_message(self, topic, payload, received=None):
+        scanner, tracker = self.router.route(topic, payload)
         if tracker:
-            tracker.process_signal(
-                event.topic.split('/')[1],
-                payload
-            )
+            tracker.process_signal(scanner, normalize_scanner_payload(payload), received)
@@ -1,3 +1,6 @@
+import numpy as np
+
+
 class KalmanRSSI:
     def __init__(self, R=1, Q=1, A=1, B=0, C=1) -> None:
         self.R = R  # noise power desirable
@@ -41,3 +44,72 @@ class KalmanRSSI:
 
     def setProcessNoise(self, noise):
         self.R = noise
+
+
+class KalmanBank:
+    """
+    A bank of independent KalmanRSSI filters sharing the same parameters.
+    The state and the covariance of every filter are kept in arrays, so
+    any subset of the filters can be stepped with a single call.
+    """
+    def __init__(self, size=0, R=1, Q=1, A=1, B=0, C=1) -> None:
+        self.R = R  # noise power desirable
+        self.Q = Q  # noise power estimated
+
+        self.A = A
+        self.C = C
+        self.B = B
+        self.x = np.zeros(size)
+        self.cov = np.zeros(size)
+        self.initialized = np.zeros(size, dtype=bool)
+
+    def __len__(self):
+        return len(self.x)
+
+    def resize(self, size):
+        grow = size - len(self.x)
+        if grow > 0:
+            self.x = np.append(self.x, np.zeros(grow))
+            self.cov = np.append(self.cov, np.zeros(grow))
+            self.initialized = np.append(self.initialized, np.zeros(grow, dtype=bool))
+
+    def filter(self, index, z, u=0):
+        """
+        Step the filters at the given (unique) indexes with
+        the measurements `z` and return their new states.
+        """
+        index = np.asarray(index, dtype=np.intp)
+        z = np.asarray(z, dtype=float)
+        initialized = self.initialized[index]
+
+        # Compute prediction
+        predX = self.predict(index, u)
+        predCov = self.uncertainty(index)
+
+        # Kalman gain
+        K = predCov * self.C * (1 / ((self.C * predCov * self.C) + self.Q))
+
+        # Correction, or the initial state for the filters seen for the first time
+        x = np.where(initialized, predX + K * (z - (self.C * predX)), (1 / self.C) * z)
+        cov = np.where(initialized, predCov - (K * self.C * predCov), (1 / self.C) * self.Q * (1 / self.C))
+
+        self.x[index] = x
+        self.cov[index] = cov
+        self.initialized[index] = True
+        return x
+
+    def predict(self, index, u=0):
+        return (self.A * self.x[index]) + (self.B * u)
+
+    def uncertainty(self, index):
+        return ((self.A * self.cov[index]) * self.A) + self.R
+
+    def set_state(self, index, x):
+        index = np.asarray(index, dtype=np.intp)
+        self.cov[index] = np.where(
+            self.initialized[index], self.cov[index], (1 / self.C) * self.Q * (1 / self.C))
+        self.x[index] = x
+        self.initialized[index] = True
+
+    def measurements(self, default=-100):
+        return np.where(self.initialized, self.x, default)
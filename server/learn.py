@@ -1,11 +1,18 @@
+import asyncio
+import logging
+import time
 from datetime import datetime
-import pickle
 
 import pandas as pd
 import numpy as np
+from server import config
+from server.compiled import ovo_scores
 from server.eventbus import eventbus
-from server.kalman import KalmanRSSI
-from server.constants import KALMAN_Q, KALMAN_R, LONG_DELAY_PENALTY_SEC, TURN_OFF_DEVICE_SEC
+from server.kalman import KalmanBank
+from server.modelstore import store_estimator
+from server.constants import (
+    KALMAN_Q, KALMAN_R, LEARN_FLUSH_INTERVAL_SEC, LEARN_FLUSH_MAX_SIZE, LEARN_LOAD_CHUNK_SIZE, LONG_DELAY_PENALTY_SEC,
+    TURN_OFF_DEVICE_SEC)
 
 from server.utils import calculate_inputs_hash, run_in_executor
 
@@ -16,84 +23,166 @@ from sklearn.ensemble import RandomForestClassifier
 from sklearn.preprocessing import StandardScaler
 from sklearn.feature_selection import SelectorMixin
 from sklearn.base import BaseEstimator
+from tortoise.transactions import in_transaction
 
 from server.eventbus import EventBusSubscriber, subscribe
 from server.events import (
     DeviceRemovedEvent, DeviceSignalEvent, LearntDeviceSignalEvent, RoomRemovedEvent, StartRecordingSignalsEvent,
-    StopRecordingSignalsEvent, TrainPredictionModelEvent, TrainingProgressEvent)
+    StopRecordingSignalsEvent, TopologyChangedEvent, TrainPredictionModelEvent, TrainingProgressEvent)
 from server.models import (
     DeviceSignal, PredictionModel, Scanner, LearningSession, get_rooms_scanners)
 
 
-@run_in_executor
-def threaded_prepare_training_data(signals):
-    used_data_df = pd.DataFrame([{
-        'rssi': x.rssi,
-        'scanner': x.scanner.id,
-        'room': x.room.id,
-        'when': np.datetime64(x.created_at),
-        'position': x.learning_session.id,
-    } for x in signals])
+@run_in_executor('training')
+def threaded_prepare_training_data(used_data_df, seed=None):
+    return generate_training_data(used_data_df, seed=seed)
 
-    sorted_rooms = sorted(used_data_df['room'].unique())
-    sorted_scanners = sorted(used_data_df['scanner'].unique())
+
+async def load_training_signals(device_id, chunk_size=LEARN_LOAD_CHUNK_SIZE):
+    """
+    The recorded signals of the device as a frame of the columns used for
+    training. The rows are fetched in chunks by id, as tuples of only those
+    columns, and copied into arrays allocated for all the signals up front.
+    Signals recorded while loading are left out.
+    """
+    count = await DeviceSignal.filter(device_id=device_id).count()
+    columns = {
+        'rssi': np.empty(count),
+        'scanner': np.empty(count, dtype=np.int64),
+        'room': np.empty(count, dtype=np.int64),
+        'when': np.empty(count, dtype='datetime64[ns]'),
+        'position': np.empty(count, dtype=np.int64),
+    }
+
+    loaded, last_id = 0, 0
+    while loaded < count:
+        rows = await DeviceSignal.filter(device_id=device_id, id__gt=last_id).order_by('id').limit(chunk_size)\
+            .values_list('id', 'rssi', 'scanner_id', 'room_id', 'created_at', 'learning_session_id')
+        if not rows:
+            break
+
+        rows = rows[:count - loaded]
+        ids, rssi, scanners, rooms, when, positions = zip(*rows)
+        chunk = slice(loaded, loaded + len(rows))
+        columns['rssi'][chunk] = rssi
+        columns['scanner'][chunk] = scanners
+        columns['room'][chunk] = rooms
+        columns['when'][chunk] = pd.to_datetime(when).values
+        # Signals recorded without a learning session make one position of their room
+        columns['position'][chunk] = [-1 if p is None else p for p in positions]
+        loaded, last_id = loaded + len(rows), ids[-1]
+
+    return pd.DataFrame(dict((name, array[:loaded]) for name, array in columns.items()))
+
+
+def session_frequencies(used_data_df):
+    """
+    Signals per second of every (room, position) recording session
+    """
     session_dur_df = used_data_df.groupby(['room', 'position'])\
         .agg(when_min=('when', 'min'), when_max=('when', 'max'), signals=('when', 'count'))
     session_dur_df['when_diff'] = np.round(
         (session_dur_df['when_max'] - session_dur_df['when_min']) / np.timedelta64(1, 's'))
     session_dur_df['frequency'] = session_dur_df['signals'] / session_dur_df['when_diff']
-    filters = dict([(s, KalmanRSSI(R=KALMAN_R, Q=KALMAN_Q)) for s in sorted_scanners])
-    off_signals_history = dict([(s, 0) for s in sorted_scanners])
-    delay_signals_history = dict([(s, 0) for s in sorted_scanners])
-    result_data = []
-
-    for _ in range(10):
-        for room in np.random.choice(sorted_rooms, len(sorted_rooms), replace=False):
-            room_init = False
-            seconds_passed = 0
-            positions = used_data_df[used_data_df['room'] == room]['position'].unique()
-            for _ in range(3):
-                for position in np.random.choice(positions, len(positions), replace=False):
-                    signals_per_sec = session_dur_df.loc[(room, position), 'frequency']
-                    signals = used_data_df[(used_data_df['room'] == room) & (used_data_df['position'] == position)]
-                    signals = signals.sample(n=min(len(signals), 300), replace=True)
-
-                    for _, row in signals.iterrows():
-                        seconds_passed += 1 / signals_per_sec
-                        off_signals_history[row['scanner']] = 0
-                        delay_signals_history[row['scanner']] = 0
-                        filters[row['scanner']].filter(row['rssi'])
-                        data_row = [np.round(filters[s].lastMeasurement() or -100, decimals=1) for s in sorted_scanners]
-
-                        for s in sorted_scanners:
-                            off_signals_history[s] += 1
-                            delay_signals_history[s] += 1
-                            if off_signals_history[s] > (TURN_OFF_DEVICE_SEC / signals_per_sec):
-                                off_signals_history[s] = 0
-                                filters[s].x = -100
-                            elif delay_signals_history[s] > (LONG_DELAY_PENALTY_SEC / signals_per_sec):
-                                delay_signals_history[s] = 0
-                                filters[s].filter(-100)
-
-                        if room_init:
-                            result_data.append(data_row + [room])
-                        elif seconds_passed > 60:
-                            room_init = True
-
-    result_data = pd.DataFrame(columns=sorted_scanners + ['room'], data=result_data)
-    result_data.drop_duplicates(inplace=True)
+    return session_dur_df
+
+
+def training_frame(result_data):
+    result_data = result_data.drop_duplicates()
     X, y = (result_data.iloc[:, :-1], result_data.room.values)
     return X, y
 
 
-@run_in_executor
+def generate_training_data(used_data_df, seed=None, repetitions=10, passes=3, max_samples=300, warm_up_sec=60):
+    """
+    The dataset of the row by row generator it has replaced, generated
+    with arrays. Every repetition is a stream of resampled sessions of
+    the rooms in a random order, and all the streams are stepped at once
+    through one bank of Kalman filters. Unlike the row by row generator,
+    the filters start afresh at every repetition instead of carrying
+    over from the last room of the previous one, which only changes the
+    first room of a repetition.
+    """
+    rng = np.random.default_rng(seed)
+    sorted_rooms = sorted(used_data_df['room'].unique())
+    sorted_scanners = sorted(used_data_df['scanner'].unique())
+    frequencies = session_frequencies(used_data_df)['frequency']
+    n_scanners = len(sorted_scanners)
+
+    slots = np.searchsorted(sorted_scanners, used_data_df['scanner'].values)
+    rssi = used_data_df['rssi'].values.astype(float)
+    sessions = used_data_df.groupby(['room', 'position']).indices
+    room_positions = dict((room, used_data_df.loc[used_data_df['room'] == room, 'position'].unique())
+                          for room in sorted_rooms)
+
+    # The sequence of signals of every stream, with the session frequency of each
+    streams = []
+    for _ in range(repetitions):
+        rows, periods, rooms, emitted = [], [], [], []
+        for room in rng.permutation(sorted_rooms):
+            room_rows, room_periods = [], []
+            for _ in range(passes):
+                for position in rng.permutation(room_positions[room]):
+                    session = sessions[(room, position)]
+                    size = min(len(session), max_samples)
+                    room_rows.append(session[rng.integers(0, len(session), size)])
+                    room_periods.append(np.full(size, 1 / frequencies[(room, position)]))
+
+            room_periods = np.concatenate(room_periods)
+            seconds_passed = np.cumsum(room_periods)
+            rows.append(np.concatenate(room_rows))
+            periods.append(room_periods)
+            rooms.append(np.full(len(room_periods), room))
+            # A room is emitted after the first signal past the warm up
+            emitted.append(np.concatenate([[False], seconds_passed[:-1] > warm_up_sec]))
+        streams.append([np.concatenate(x) for x in (rows, periods, rooms, emitted)])
+
+    rows, periods, rooms, emitted = (np.stack(x) for x in zip(*streams))
+    n_streams, n_steps = rows.shape
+    stream_slots, stream_rssi = slots[rows], rssi[rows]
+    off_limits = TURN_OFF_DEVICE_SEC * periods
+    delay_limits = LONG_DELAY_PENALTY_SEC * periods
+
+    filters = KalmanBank(n_streams * n_scanners, R=KALMAN_R, Q=KALMAN_Q)
+    offsets = np.arange(n_streams) * n_scanners
+    off_signals_history = np.zeros(n_streams * n_scanners)
+    delay_signals_history = np.zeros(n_streams * n_scanners)
+    measurements = np.empty((n_steps, n_streams * n_scanners))
+
+    for step in range(n_steps):
+        index = offsets + stream_slots[:, step]
+        off_signals_history[index] = 0
+        delay_signals_history[index] = 0
+        filters.filter(index, stream_rssi[:, step])
+        measurements[step] = filters.measurements(-100)
+
+        off_signals_history += 1
+        delay_signals_history += 1
+        turned_off = off_signals_history > np.repeat(off_limits[:, step], n_scanners)
+        if turned_off.any():
+            off_signals_history[turned_off] = 0
+            filters.set_state(np.flatnonzero(turned_off), -100)
+        delayed = ~turned_off & (delay_signals_history > np.repeat(delay_limits[:, step], n_scanners))
+        if delayed.any():
+            delay_signals_history[delayed] = 0
+            filters.filter(np.flatnonzero(delayed), np.full(delayed.sum(), -100.0))
+
+    # Stream by stream, in the order of the loop
+    measurements = measurements.reshape(n_steps, n_streams, n_scanners).transpose(1, 0, 2)[emitted]
+    result_data = pd.DataFrame(np.round(measurements, decimals=1), columns=sorted_scanners)
+    result_data['room'] = rooms[emitted]
+    return training_frame(result_data)
+
+
+@run_in_executor('training')
 def threaded_train_model(X, y):
     try:
         estimator = OneVsOneClassifier(Pipeline([
             ('select', SelectHighestMean()),
             ('scale', StandardScaler()),
-            ('classification', RandomForestClassifier(n_estimators=100, class_weight='balanced', n_jobs=-1))
-        ]), n_jobs=-1)
+            ('classification', RandomForestClassifier(
+                n_estimators=100, class_weight='balanced', n_jobs=config.TRAINING_N_JOBS))
+        ]), n_jobs=config.TRAINING_N_JOBS)
         estimator.fit(X, y)
         accuracy = metrics.recall_score(y, estimator.predict(X), average='micro')
         estimator = PresenceEstimator(estimator)
@@ -103,6 +192,11 @@ def threaded_train_model(X, y):
     return accuracy, estimator, None
 
 
+@run_in_executor('training')
+def threaded_store_estimator(estimator):
+    return store_estimator(estimator)
+
+
 def report_training_progress(**kwargs):
     eventbus.post(TrainingProgressEvent(**{
         "is_final": False,
@@ -112,15 +206,15 @@ def report_training_progress(**kwargs):
     }))
 
 
-async def prepare_training_data(device):
+async def prepare_training_data(device, seed=None):
     report_training_progress(
         device=device,
         status_code="generating_dataset",
         message="Prepearing the training dataset"
     )
 
-    signals = await DeviceSignal.filter(device_id=device.id).prefetch_related('room', 'scanner', 'learning_session')
-    X, y = await threaded_prepare_training_data(signals)
+    used_data_df = await load_training_signals(device.id)
+    X, y = await threaded_prepare_training_data(used_data_df, seed)
 
     report_training_progress(
         device=device,
@@ -152,11 +246,30 @@ class PresenceEstimator:
     def __init__(self, estimator) -> None:
         self.estimator = estimator
 
+    def scores(self, data):
+        """
+        Class probabilities when the estimator provides them, otherwise
+        the decision function normalized to [0, 1] (OneVsOneClassifier has
+        no predict_proba), so they can be reported as the `proba` of rooms
+        """
+        if hasattr(self.estimator, 'predict_proba'):
+            return self.estimator.predict_proba(data)
+
+        return ovo_scores(self.estimator.decision_function(data), len(self.estimator.classes_))
+
     def predict_proba(self, data_row):
-        pred_result = list(zip(self.estimator.classes_, self.estimator.predict_proba(data_row)[0]))
+        pred_result = list(zip(self.estimator.classes_, self.scores(data_row)[0]))
         max_pred_result = [max(pred_result, key=lambda x: x[1])]
         return [dict(max_pred_result)]
 
+    def predict_proba_batch(self, data):
+        """
+        Same as `predict_proba`, but for every row of the matrix at once
+        """
+        scores = self.scores(data)
+        best = np.argmax(scores, axis=1)
+        return [{self.estimator.classes_[i]: row[i]} for i, row in zip(best, scores)]
+
 
 class SelectHighestMean(SelectorMixin, BaseEstimator):
     """
@@ -179,12 +292,102 @@ class SelectHighestMean(SelectorMixin, BaseEstimator):
         return mask
 
 
+class SignalWriter:
+    """
+    Write-behind buffer of recorded signals. The signals are inserted
+    with a single bulk insert in a transaction when the buffer is full
+    or `interval` seconds after the first buffered signal.
+    """
+    def __init__(self, max_size=LEARN_FLUSH_MAX_SIZE, interval=LEARN_FLUSH_INTERVAL_SEC):
+        self.max_size = max_size
+        self.interval = interval
+        self.buffer = []
+        self.timer = None
+        self.lock = asyncio.Lock()
+        self.tasks = set()
+        self.rows = 0
+        self.batches = 0
+        self.failed_rows = 0
+        self.write_time = 0.0
+        self.last_batch_size = 0
+
+    def add(self, signal):
+        self.buffer.append(signal)
+        if len(self.buffer) >= self.max_size:
+            self.write_later(self.take())
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.interval, self.schedule_flush)
+
+    def take(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        batch, self.buffer = self.buffer, []
+        return batch
+
+    def schedule_flush(self):
+        self.timer = None
+        self.write_later(self.take())
+
+    def write_later(self, batch):
+        task = asyncio.ensure_future(self.write(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def flush(self):
+        """
+        Write the buffered signals and wait for the writes started before,
+        returns the written ones of the buffer
+        """
+        task = self.write_later(self.take())
+        await asyncio.wait(set(self.tasks))
+        return task.result()
+
+    async def write(self, batch):
+        # Batches are written in the order they were buffered, a flush waits for the earlier ones
+        async with self.lock:
+            if not batch:
+                return []
+
+            started = time.perf_counter()
+            try:
+                async with in_transaction():
+                    await DeviceSignal.bulk_create(batch)
+            except Exception:
+                self.failed_rows += len(batch)
+                logging.exception('Cannot write %s recorded signals', len(batch))
+                return []
+
+            self.write_time += time.perf_counter() - started
+            self.rows += len(batch)
+            self.batches += 1
+            self.last_batch_size = len(batch)
+
+        for signal in batch:
+            eventbus.post(LearntDeviceSignalEvent(device_signal=signal))
+        return batch
+
+    def stats(self):
+        return {
+            'rows': self.rows,
+            'batches': self.batches,
+            'failed_rows': self.failed_rows,
+            'buffered': len(self.buffer),
+            'last_batch_size': self.last_batch_size,
+            'rows_per_sec': self.rows / self.write_time if self.write_time else 0.0,
+        }
+
+
 class Learn(EventBusSubscriber):
-    def __init__(self):
+    def __init__(self, writer=None):
         super().__init__()
         self.recording_room = None
         self.recording_device = None
         self.learning_session = None
+        self.writer = writer or SignalWriter()
+        self.scanner_ids = {}
 
     @subscribe(StartRecordingSignalsEvent)
     async def handle_start_recording(self, event):
@@ -193,24 +396,43 @@ class Learn(EventBusSubscriber):
         self.learning_session = await LearningSession.create(
             room_id=event.room.id, device_id=event.device.id)
 
-    @subscribe(StopRecordingSignalsEvent)
-    def handle_stop_recording(self, event):
+    def stop_recording(self):
         self.recording_room = None
         self.recording_device = None
         self.learning_session = None
 
+    @subscribe(StopRecordingSignalsEvent)
+    async def handle_stop_recording(self, event):
+        self.stop_recording()
+        await self.writer.flush()
+
     @subscribe(DeviceRemovedEvent)
     def handle_device_removed(self, event):
         if event.device == self.recording_device:
-            self.handle_stop_recording(None)
+            self.stop_recording()
             eventbus.post(StopRecordingSignalsEvent())
 
     @subscribe(RoomRemovedEvent)
     def handle_room_removed(self, event):
         if event.room == self.recording_room:
-            self.handle_stop_recording(None)
+            self.stop_recording()
             eventbus.post(StopRecordingSignalsEvent())
 
+    @subscribe(TopologyChangedEvent)
+    def handle_topology_changed(self, event):
+        self.scanner_ids = {}
+
+    async def get_scanner_id(self, uuid):
+        """
+        The id of the scanner with the UUID, None for unknown scanners.
+        Cached until a room or a scanner is changed.
+        """
+        # A lookup racing with a change ends up in the dropped cache
+        scanner_ids = self.scanner_ids
+        if uuid not in scanner_ids:
+            scanner_ids[uuid] = await Scanner.filter(uuid=uuid).first().values_list('id', flat=True)
+        return scanner_ids[uuid]
+
     def is_learning_started(self, device):
         return self.recording_room and self.recording_device == device
 
@@ -219,28 +441,28 @@ class Learn(EventBusSubscriber):
         if not self.is_learning_started(event.device):
             return
 
-        scanner = await Scanner.filter(uuid=event.scanner_uuid).first()
-        if not scanner:
+        room, learning_session = self.recording_room, self.learning_session
+        scanner_id = await self.get_scanner_id(event.scanner_uuid)
+        if scanner_id is None:
             # TODO: notify the client about it somehow
             print('There is no scanner in the database with UUID: {}'.format(event.scanner_uuid))
             return
 
         signal_datetime = datetime.fromtimestamp(event.signal['when'])
-        device_signal = await DeviceSignal.create(
+        self.writer.add(DeviceSignal(
             device=event.device,
-            room=self.recording_room,
-            learning_session=self.learning_session,
-            scanner=scanner,
+            room=room,
+            learning_session=learning_session,
+            scanner_id=scanner_id,
             rssi=event.signal['rssi'],
             created_at=signal_datetime,
             updated_at=signal_datetime,
-        )
-
-        eventbus.post(LearntDeviceSignalEvent(device_signal=device_signal))
+        ))
 
     @subscribe(TrainPredictionModelEvent)
     async def handle_train_model(self, event):
         device = event.device
+        await self.writer.flush()
 
         report_training_progress(
             device=device,
@@ -264,8 +486,8 @@ class Learn(EventBusSubscriber):
         else:
             result = await PredictionModel.create(
                 accuracy=accuracy,
-                model=pickle.dumps(model),
                 inputs_hash=inputs_hash,
+                **(await threaded_store_estimator(model))
             )
             await result.devices.add(device)
 
@@ -0,0 +1,205 @@
+"""
+Latency histograms of the tracking pipeline and the statistics of its
+components, exposed to GraphQL and as Prometheus text.
+
+The oldest scanner message of every heartbeat gets a `Trace` which follows
+it through the pipeline:
+
+    received → processed → heartbeat → predicted → promoted → published
+
+Each step observes the time since the previous one in a histogram
+of the step, and publishing a room state observes the whole way too.
+"""
+import bisect
+import time
+from collections import OrderedDict, namedtuple
+
+PREFIX = 'mqtt_room_presence'
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+STAGES = OrderedDict([
+    ('processed', ('signal_dispatch', 'MQTT receive to DeviceTracker.process_signal')),
+    ('heartbeat', ('heartbeat_emission', 'The oldest signal of a heartbeat to the heartbeat emission')),
+    ('predicted', ('prediction', 'Heartbeat emission to the occupancy prediction')),
+    ('promoted', ('device_state', 'Occupancy prediction to the device state promotion')),
+    ('published', ('room_publish', 'Device state promotion to the room state published to MQTT')),
+])
+END_TO_END = ('end_to_end', 'MQTT receive to the room state published to MQTT')
+
+
+def now():
+    """
+    Monotonic time shared by all processes of the machine
+    """
+    return time.monotonic()
+
+
+class Histogram:
+    def __init__(self, name, description, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative_counts(self):
+        result, total = [], 0
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+    def quantile(self, q):
+        """
+        Estimate of the quantile, interpolated within its bucket
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        lower, previous = 0.0, 0
+        for upper, total in zip(self.buckets, self.cumulative_counts()):
+            if total >= rank:
+                return lower + (upper - lower) * (rank - previous) / max(total - previous, 1)
+            lower, previous = upper, total
+        return self.buckets[-1]
+
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'description': self.description,
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': [{'le': le, 'count': count} for le, count in zip(
+                list(self.buckets) + [None], self.cumulative_counts())],
+        }
+
+
+Collector = namedtuple('Collector', 'name, collect, description, counters')
+
+
+class MetricsRegistry:
+    """
+    Histograms plus collectors – functions returning the (nested) stats
+    dict of a component, which are flattened to samples on every read.
+    Samples are gauges unless their stats key is one of the counters
+    of the collector.
+    """
+    def __init__(self):
+        self.histograms = OrderedDict()
+        self.collectors = OrderedDict()
+
+    def histogram(self, name, description=''):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram(name, description)
+        return self.histograms[name]
+
+    def register_collector(self, name, collect, description='', counters=()):
+        self.collectors[name] = Collector(name, collect, description or name, frozenset(counters))
+
+    def samples(self):
+        """
+        (name, labels, value) of every number reported by the collectors
+        """
+        for collector in self.collectors.values():
+            yield from flatten(collector.collect(), (collector.name,), ())
+
+    def as_dict(self):
+        return {
+            'histograms': [h.as_dict() for h in self.histograms.values()],
+            'samples': [{
+                'name': name,
+                'labels': [{'name': k, 'value': v} for k, v in labels],
+                'value': value,
+            } for name, labels, value in self.samples()],
+        }
+
+    def prometheus_text(self):
+        lines = []
+        for histogram in self.histograms.values():
+            name = '{}_{}_seconds'.format(PREFIX, histogram.name)
+            lines.append('# HELP {} {}'.format(name, histogram.description))
+            lines.append('# TYPE {} histogram'.format(name))
+            for le, count in zip(histogram.buckets, histogram.cumulative_counts()):
+                lines.append('{}_bucket{{le="{}"}} {}'.format(name, le, count))
+            lines.append('{}_bucket{{le="+Inf"}} {}'.format(name, histogram.count))
+            lines.append('{}_sum {}'.format(name, histogram.sum))
+            lines.append('{}_count {}'.format(name, histogram.count))
+
+        for collector in self.collectors.values():
+            # The samples of a metric must be grouped below its HELP and TYPE
+            metrics = OrderedDict()
+            for name, labels, value in flatten(collector.collect(), (collector.name,), ()):
+                metrics.setdefault(name, []).append((labels, value))
+
+            for name, samples in metrics.items():
+                counter = any(name.endswith('_' + key) for key in collector.counters)
+                name = '{}_{}'.format(PREFIX, name)
+                lines.append('# HELP {} {}'.format(name, collector.description))
+                lines.append('# TYPE {} {}'.format(name, 'counter' if counter else 'gauge'))
+                for labels, value in samples:
+                    labels = ','.join('{}="{}"'.format(k, v.replace('"', '\\"')) for k, v in labels)
+                    lines.append('{}{} {}'.format(name, '{' + labels + '}' if labels else '', value))
+
+        return '\n'.join(lines) + '\n'
+
+
+def flatten(value, path, labels):
+    """
+    Numbers of nested stats as samples. Identifier keys make the name,
+    other keys (ids) and string values become labels
+    """
+    if isinstance(value, dict):
+        labels = labels + tuple((k, v) for k, v in value.items() if isinstance(v, str))
+        for key, item in value.items():
+            if isinstance(key, str) and key.isidentifier():
+                yield from flatten(item, path + (key,), labels)
+            else:
+                depth = sum(1 for k, _ in labels if k.startswith('key'))
+                label = 'key{}'.format(depth + 1) if depth else 'key'
+                yield from flatten(item, path, labels + ((label, str(key)),))
+    elif isinstance(value, (list, tuple)):
+        for index, item in enumerate(value):
+            yield from flatten(item, path, labels + (('index', str(index)),))
+    elif isinstance(value, (bool, int, float)):
+        yield '_'.join(path), labels, float(value)
+
+
+registry = MetricsRegistry()
+for stage_name, stage_description in list(STAGES.values()) + [END_TO_END]:
+    registry.histogram(stage_name, stage_description)
+
+
+class Trace(namedtuple(
+    'Trace',
+    'received, processed, heartbeat, predicted, promoted, published',
+    defaults=(None,) * 6
+)):
+    def mark(self, stage, timestamp=None):
+        """
+        Record the stage of the trace, observing the time since the previous one
+        """
+        timestamp = now() if timestamp is None else timestamp
+        previous = self[self._fields.index(stage) - 1]
+        if previous is not None:
+            registry.histogram(*STAGES[stage]).observe(timestamp - previous)
+        if stage == 'published' and self.received is not None:
+            registry.histogram(*END_TO_END).observe(timestamp - self.received)
+        return self._replace(**{stage: timestamp})
+
+    def observe(self):
+        """
+        Observe the recorded stages again, for traces marked in another process
+        """
+        for stage, (previous, timestamp) in zip(self._fields[1:], zip(self, self[1:])):
+            if previous is not None and timestamp is not None:
+                registry.histogram(*STAGES[stage]).observe(timestamp - previous)
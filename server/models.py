@@ -1,5 +1,7 @@
 from server import config
-from server.events import DeviceAddedEvent, DeviceRemovedEvent, RoomAddedEvent, RoomRemovedEvent
+from server.events import (
+    DeviceAddedEvent, DeviceRemovedEvent, PredictionModelChangedEvent, RoomAddedEvent, RoomRemovedEvent,
+    TopologyChangedEvent)
 from server.eventbus import eventbus
 from tortoise.signals import Signals, post_delete, post_save
 from tortoise.models import Model
@@ -72,6 +74,7 @@ class PredictionModel(Base, TimestampMixin):
     inputs_hash = fields.CharField(max_length=100)
     accuracy = fields.FloatField(default=0)
     model = fields.BinaryField(null=True)
+    model_file = fields.CharField(max_length=100, null=True)
     devices = fields.ManyToManyField(
         'models.Device', related_name='used_by_models', through='model_device')
 
@@ -85,6 +88,7 @@ async def get_rooms_scanners():
 
 async def clear_rooms_scanners_cache(sender, instance, created, using_db=None, update_fields=None):
     get_rooms_scanners.cache_clear()
+    eventbus.post(TopologyChangedEvent())
 
 
 Room.register_listener(Signals.post_save, clear_rooms_scanners_cache)
@@ -113,9 +117,20 @@ async def emit_room_removed(sender, instance, using_db):
     eventbus.post(RoomRemovedEvent(room=instance))
 
 
-async def init_db():
+@post_save(PredictionModel)
+async def emit_prediction_model_saved(sender, instance, created, using_db, update_fields):
+    eventbus.post(PredictionModelChangedEvent(model_id=instance.id))
+
+
+@post_delete(PredictionModel)
+async def emit_prediction_model_removed(sender, instance, using_db):
+    eventbus.post(PredictionModelChangedEvent(model_id=instance.id))
+
+
+async def init_db(generate_schemas=True):
     await Tortoise.init(config.TORTOISE_ORM)
-    await Tortoise.generate_schemas()
+    if generate_schemas:
+        await Tortoise.generate_schemas()
 
 
 async def close_db():
@@ -0,0 +1,217 @@
+"""
+Storage of compiled prediction models.
+
+A model file is a small JSON header followed by the raw arrays of
+a `CompiledEstimator`, each aligned to 64 bytes, so a model is loaded
+by memory mapping the file without copying or unpickling anything:
+
+    MRPM | format version (u32) | header size (u32) | header | arrays
+
+Files are named by the SHA-256 of their content, the same model is
+stored only once. Models which cannot be compiled stay pickled in
+`PredictionModel.model`. Existing pickled models are converted with
+
+    python -m server.modelstore migrate
+
+and the files no prediction model refers to any more are removed with
+
+    python -m server.modelstore gc
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import tempfile
+import time
+
+import numpy as np
+
+from server import config
+from server.compiled import CompiledEstimator, compile_estimator
+from server.constants import MODEL_STORE_GC_GRACE_SEC
+from server.models import PredictionModel, close_db, init_db
+
+MAGIC = b'MRPM'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+PREAMBLE = struct.Struct('<4sII')
+ARRAYS = ('columns', 'means', 'scales', 'roots', 'features', 'thresholds', 'children', 'values')
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def dump_estimator(estimator):
+    """
+    Serialize a `CompiledEstimator` to bytes of the model file format
+    """
+    arrays = [np.ascontiguousarray(getattr(estimator, name)) for name in ARRAYS]
+    header = {
+        'classes': np.asarray(estimator.classes_).tolist(),
+        'n_trees': estimator.n_trees,
+        'depth': estimator.depth,
+        'arrays': {},
+    }
+
+    offsets, size = [], 0
+    for name, array in zip(ARRAYS, arrays):
+        header['arrays'][name] = {'dtype': array.dtype.str, 'shape': array.shape, 'offset': size}
+        offsets.append(size)
+        size = align(size + array.nbytes)
+
+    header = json.dumps(header, sort_keys=True).encode()
+    start = align(PREAMBLE.size + len(header))
+    data = bytearray(start + size)
+    data[:PREAMBLE.size] = PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header))
+    data[PREAMBLE.size:PREAMBLE.size + len(header)] = header
+    for offset, array in zip(offsets, arrays):
+        data[start + offset:start + offset + array.nbytes] = array.tobytes()
+    return bytes(data)
+
+
+def parse_estimator(buffer):
+    """
+    Create a `CompiledEstimator` with the arrays backed by the buffer
+    """
+    magic, version, header_size = PREAMBLE.unpack_from(buffer)
+    if magic != MAGIC:
+        raise ValueError('Not a model file')
+    if version != FORMAT_VERSION:
+        raise ValueError('Unsupported model file version {}'.format(version))
+
+    header = json.loads(bytes(buffer[PREAMBLE.size:PREAMBLE.size + header_size]))
+    start = align(PREAMBLE.size + header_size)
+    arrays = {}
+    for name, spec in header['arrays'].items():
+        dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+        count = int(np.prod(shape))
+        arrays[name] = np.frombuffer(buffer, dtype, count, start + spec['offset']).reshape(shape)
+
+    classes = np.array(header['classes'])
+    n_classes = len(classes)
+    return CompiledEstimator(
+        classes=classes,
+        pairs=[(i, j) for i in range(n_classes) for j in range(i + 1, n_classes)],
+        n_trees=header['n_trees'],
+        depth=header['depth'],
+        **arrays
+    )
+
+
+class ModelStore:
+    """
+    Content addressed model files in a directory
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or config.MODEL_STORE_DIR
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def save(self, estimator):
+        """
+        Store the compiled estimator, returns the name of its file
+        """
+        data = dump_estimator(estimator)
+        name = '{}.mrpm'.format(hashlib.sha256(data).hexdigest())
+        if os.path.exists(self.path(name)):
+            return name
+
+        os.makedirs(self.directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(temp_path, self.path(name))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return name
+
+    def load(self, name):
+        with open(self.path(name), 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return parse_estimator(buffer)
+
+
+def store_estimator(estimator, store=None):
+    """
+    Compile and store the estimator, returns the fields of a PredictionModel:
+    the model file or, when the estimator cannot be compiled, its pickle
+    """
+    try:
+        compiled = compile_estimator(estimator)
+    except ValueError:
+        logging.warning('Cannot compile the prediction model, storing it pickled', exc_info=True)
+        return {'model': pickle.dumps(estimator), 'model_file': None}
+
+    return {'model': None, 'model_file': (store or ModelStore()).save(compiled)}
+
+
+async def migrate(store=None):
+    """
+    Convert the pickled prediction models to model files
+    """
+    converted = 0
+    for model in await PredictionModel.filter(model_file=None, model__not_isnull=True):
+        try:
+            fields = store_estimator(pickle.loads(model.model), store)
+        except Exception:
+            logging.exception('Cannot convert the prediction model %s', model.id)
+            continue
+
+        if fields['model_file'] is not None:
+            model.model, model.model_file = fields['model'], fields['model_file']
+            await model.save(update_fields=['model', 'model_file'])
+            converted += 1
+
+    return converted
+
+
+async def collect_garbage(store=None, grace=MODEL_STORE_GC_GRACE_SEC):
+    """
+    Remove the model files no prediction model refers to. Files younger
+    than `grace` seconds are kept, they may belong to a model which is
+    still being trained or saved
+    """
+    store = store or ModelStore()
+    if not os.path.isdir(store.directory):
+        return 0
+
+    referenced = set(await PredictionModel.filter(model_file__not_isnull=True).values_list('model_file', flat=True))
+    created_before = time.time() - grace
+    removed = 0
+    for name in os.listdir(store.directory):
+        path = store.path(name)
+        if name in referenced or not name.endswith(('.mrpm', '.tmp')) or os.path.getmtime(path) > created_before:
+            continue
+        os.unlink(path)
+        removed += 1
+
+    return removed
+
+
+async def main(args):
+    await init_db(generate_schemas=False)
+    try:
+        if args.command == 'migrate':
+            print('Converted {} prediction models'.format(await migrate(ModelStore(args.directory))))
+        elif args.command == 'gc':
+            print('Removed {} model files'.format(await collect_garbage(ModelStore(args.directory))))
+    finally:
+        await close_db()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Manage the stored prediction models')
+    parser.add_argument(
+        'command', choices=['migrate', 'gc'],
+        help='migrate: convert pickled models to model files, gc: remove unused model files')
+    parser.add_argument('--directory', help='Directory of the model files')
+    asyncio.run(main(parser.parse_args()))
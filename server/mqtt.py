@@ -1,12 +1,65 @@
 import asyncio
+import json
+import logging
+import time
 import jsons
 from asyncio_mqtt import Client, MqttError
-from server import config
+from server import config, metrics
+from server.constants import (
+    MQTT_BATCH_MAX_DELAY_SEC, MQTT_BATCH_MAX_SIZE, MQTT_BATCH_QUEUE_SIZE, MQTT_INGEST_STATS_WINDOW_SEC)
 from server.eventbus import eventbus
-from server.events import MQTTConnectedEvent, MQTTDisconnectedEvent, MQTTMessageEvent
+from server.events import MQTTConnectedEvent, MQTTDisconnectedEvent, MQTTMessageBatchEvent, MQTTMessageEvent
 from contextlib import AsyncExitStack
 
 
+class IngestStats:
+    def __init__(self, window=MQTT_INGEST_STATS_WINDOW_SEC):
+        self.window = window
+        self.messages = 0
+        self.batches = 0
+        self.dropped = 0
+        self.malformed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.messages_per_sec = 0.0
+        self.window_started = time.monotonic()
+        self.window_messages = 0
+
+    def record_batch(self, size, malformed=0):
+        self.messages += size
+        self.batches += 1
+        self.malformed += malformed
+        self.last_batch_size = size
+        self.max_batch_size = max(self.max_batch_size, size)
+        self.window_messages += size
+
+        now = time.monotonic()
+        elapsed = now - self.window_started
+        if elapsed >= self.window:
+            self.messages_per_sec = self.window_messages / elapsed
+            self.window_started = now
+            self.window_messages = 0
+
+    @property
+    def avg_batch_size(self):
+        return self.messages / self.batches if self.batches else 0.0
+
+    def as_dict(self):
+        return {
+            'messages': self.messages,
+            'batches': self.batches,
+            'dropped': self.dropped,
+            'malformed': self.malformed,
+            'messages_per_sec': self.messages_per_sec,
+            'last_batch_size': self.last_batch_size,
+            'max_batch_size': self.max_batch_size,
+            'avg_batch_size': self.avg_batch_size,
+        }
+
+
+ingest_stats = IngestStats()
+
+
 async def connect_mqtt():
     async with AsyncExitStack() as stack:
         tasks = set()
@@ -21,8 +74,13 @@ async def connect_mqtt():
 
         # Take all messages and emit them to the event bus
         messages = await stack.enter_async_context(client.unfiltered_messages())
-        task = asyncio.create_task(emit_messages(messages))
-        tasks.add(task)
+        if config.MQTT_BATCH_INGEST:
+            queue = asyncio.Queue(MQTT_BATCH_QUEUE_SIZE)
+            tasks.add(asyncio.create_task(enqueue_messages(messages, queue)))
+            tasks.add(asyncio.create_task(emit_message_batches(queue)))
+        else:
+            task = asyncio.create_task(emit_messages(messages))
+            tasks.add(task)
 
         # Subscribe to topic(s)
         # Note that we subscribe *after* starting the message
@@ -36,12 +94,74 @@ async def connect_mqtt():
 
 async def emit_messages(messages):
     async for message in messages:
+        ingest_stats.record_batch(1)
         eventbus.post(MQTTMessageEvent(
             topic=message.topic,
-            payload=jsons.loads(message.payload.decode())
+            payload=jsons.loads(message.payload.decode()),
+            received=metrics.now(),
         ))
 
 
+async def enqueue_messages(messages, queue, stats=ingest_stats):
+    async for message in messages:
+        try:
+            queue.put_nowait((metrics.now(), message))
+        except asyncio.QueueFull:
+            # The batches are not processed fast enough, drop the newest
+            stats.dropped += 1
+
+
+def drain_queue(queue, batch, max_size):
+    while len(batch) < max_size and not queue.empty():
+        batch.append(queue.get_nowait())
+
+
+async def collect_batch(queue, max_size=MQTT_BATCH_MAX_SIZE, max_delay=MQTT_BATCH_MAX_DELAY_SEC):
+    """
+    Wait for the first message, take what is already queued and, unless
+    the batch is full, sleep until the delay since the first message is
+    exceeded and take what has arrived in the meantime.
+    """
+    batch = [await queue.get()]
+    deadline = asyncio.get_running_loop().time() + max_delay
+    drain_queue(queue, batch, max_size)
+
+    if len(batch) < max_size:
+        await asyncio.sleep(max(deadline - asyncio.get_running_loop().time(), 0))
+        drain_queue(queue, batch, max_size)
+
+    return batch
+
+
+def decode_batch(batch):
+    """
+    The topics and payloads of the messages, skipping the payloads
+    which are not a JSON object
+    """
+    decoded = []
+    for message in batch:
+        try:
+            payload = json.loads(message.payload)
+        except ValueError:
+            payload = None
+
+        if isinstance(payload, dict):
+            decoded.append((message.topic, payload))
+        else:
+            logging.warning('Skip MQTT message with malformed payload on %s', message.topic)
+
+    return decoded
+
+
+async def emit_message_batches(queue):
+    while True:
+        batch = await collect_batch(queue)
+        messages = decode_batch([message for _, message in batch])
+        ingest_stats.record_batch(len(messages), malformed=len(batch) - len(messages))
+        if messages:
+            eventbus.post(MQTTMessageBatchEvent(messages=messages, received=batch[0][0]))
+
+
 async def cancel_tasks(tasks):
     for task in tasks:
         if task.done():
@@ -1,39 +1,161 @@
-import pickle
-import pandas as pd
+import asyncio
+import logging
+from collections import OrderedDict
+
+import numpy as np
+from server import config
+from server.constants import PREDICT_BATCH_MAX_SIZE
 from server.eventbus import eventbus
 from server.models import get_rooms_scanners
+from server.registry import ModelRegistry
 from server.utils import calculate_inputs_hash, run_in_executor
 from server.eventbus import EventBusSubscriber, subscribe
-from server.events import DeviceAddedEvent, DeviceRemovedEvent, HeartbeatEvent, OccupancyEvent
+from server.events import (
+    DeviceAddedEvent, DeviceRemovedEvent, HeartbeatEvent, OccupancyEvent, PredictionModelChangedEvent,
+    TopologyChangedEvent)
+
+
+@run_in_executor('inference')
+def predict_presence(estimator, data):
+    """
+    Predict presence for every row of the matrix with one call
+    of the estimator when it supports it
+    """
+    if hasattr(estimator, 'predict_proba_batch'):
+        return estimator.predict_proba_batch(data)
+    return [estimator.predict_proba(data[i:i + 1])[0] for i in range(len(data))]
+
+
+class ModelBinding:
+    """
+    Inputs of a prediction model bound to the current rooms and scanners:
+    the column of every scanner, the rooms by id and the row of a heartbeat
+    without signals. Valid only when the rooms and scanners are the ones
+    the model has been trained with
+    """
+    def __init__(self, inputs_hash, curr_inputs_hash, rooms, scanners):
+        self.inputs_hash = inputs_hash
+        self.valid = inputs_hash == curr_inputs_hash
+        self.scanner_uuids = tuple(s.uuid for s in scanners)
+        self.columns = dict((uuid, i) for i, uuid in enumerate(self.scanner_uuids))
+        self.rooms_map = dict((r.id, r) for r in rooms)
+        self.default_row = np.full(len(self.scanner_uuids), -100.0)
+
+    def create_row(self, signals):
+        row = self.default_row.copy()
+        for uuid, rssi in signals.items():
+            column = self.columns.get(uuid)
+            if column is not None:
+                row[column] = rssi
+        return row
+
+
+class PredictionCache:
+    """
+    LRU cache of the predictions of a model, keyed by the heartbeat row
+    quantized to `resolution` dBm. Stationary devices send almost the
+    same heartbeat for hours, so most of their predictions are repeated
+    """
+    def __init__(self, max_size, resolution):
+        self.max_size = max_size
+        self.resolution = resolution
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, row):
+        return np.round(row / self.resolution).astype(np.int64).tobytes()
+
+    def get(self, key):
+        result = self.results.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return result
 
+    def put(self, key, result):
+        self.results[key] = result
+        self.results.move_to_end(key)
+        while len(self.results) > self.max_size:
+            self.results.popitem(last=False)
 
-@run_in_executor
-def predict_presence(estimator, data_row):
-    return estimator.predict_proba(data_row)[0]
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.results),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / lookups if lookups else 0.0,
+        }
+
+
+class PredictionRequest:
+    def __init__(self, device, row, trace=None, cache=None, cache_key=None):
+        self.device = device
+        self.row = row
+        self.trace = trace
+        self.cache = cache
+        self.cache_key = cache_key
 
 
 class Predict(EventBusSubscriber):
+    """
+    Predicts the rooms of devices from their heartbeats. Heartbeats are
+    collected for `batch_window` seconds and grouped by the prediction
+    model, so devices sharing a model are predicted with one call.
+    With a `cache_size`, predictions of every model are cached by the
+    heartbeat quantized to `cache_resolution` dBm
+    """
 
-    def __init__(self):
+    def __init__(self, batch_window=None, batch_max_size=PREDICT_BATCH_MAX_SIZE, registry=None,
+                 cache_size=None, cache_resolution=None):
         super().__init__()
+        self.registry = registry or ModelRegistry()
+        self.cache_size = config.PREDICTION_CACHE_SIZE if cache_size is None else cache_size
+        self.cache_resolution = cache_resolution or config.PREDICTION_CACHE_RSSI_RESOLUTION
+        self.caches = {}
+        self.batch_window = config.PREDICT_BATCH_WINDOW_SEC if batch_window is None else batch_window
+        self.batch_max_size = batch_max_size
         self.prediction_models = {}
+        self.bindings = {}
+        self.topology_version = 0
+        self.last_occupancy = {}
+        self.pending = {}
+        self.pending_size = 0
+        self.flush_handle = None
+        self.predictions = 0
+        self.skipped_predictions = 0
+        self.invalid_inputs = 0
+        self.batches = 0
+        self.max_batch_size = 0
 
     @subscribe(DeviceAddedEvent)
-    async def handle_device_added(self, event):
-        if not event.device.prediction_model:
-            return
-
-        model = await event.device.prediction_model
-
-        if not model and event.device.id in self.prediction_models:
-            del self.prediction_models[event.device.id]
+    def handle_device_added(self, event):
+        self.last_occupancy.pop(event.device.id, None)
+        if event.device.prediction_model_id is None:
+            self.prediction_models.pop(event.device.id, None)
         else:
-            self.prediction_models[event.device.id] = (pickle.loads(model.model), model.inputs_hash)
+            self.prediction_models[event.device.id] = event.device.prediction_model_id
 
     @subscribe(DeviceRemovedEvent)
     def handle_device_removed(self, event):
         if event.device.id in self.prediction_models:
             del self.prediction_models[event.device.id]
+        self.last_occupancy.pop(event.device.id, None)
+
+    def stats(self):
+        return {
+            'predictions': self.predictions,
+            'skipped_predictions': self.skipped_predictions,
+            'invalid_inputs': self.invalid_inputs,
+            'batches': self.batches,
+            'avg_batch_size': self.predictions / self.batches if self.batches else 0.0,
+            'max_batch_size': self.max_batch_size,
+            'pending': self.pending_size,
+            'caches': dict((model_id, cache.stats()) for model_id, cache in self.caches.items()),
+        }
 
     @subscribe(HeartbeatEvent)
     async def handle_device_heartbeat(self, event):
@@ -43,36 +165,136 @@ class Predict(EventBusSubscriber):
 
         # No signals provided – the device is out
         if not event.signals:
+            self.last_occupancy.pop(event.device.id, None)
             eventbus.post(OccupancyEvent(
                 device=event.device,
                 room_occupancy=[],
                 signals=None,
+                trace=event.trace and event.trace.mark('predicted'),
             ))
             return
 
-        estimator, inputs_hash = self.prediction_models[event.device.id]
-        rooms, scanners = await get_rooms_scanners()
-        curr_inputs_hash = await calculate_inputs_hash(rooms=rooms, scanners=scanners)
-        rooms_map = dict((r.id, r) for r in rooms)
+        # The heartbeat is almost the same as the last predicted one,
+        # repeat the last result to keep the device state beating
+        if not event.significant and event.device.id in self.last_occupancy:
+            self.skipped_predictions += 1
+            eventbus.post(self.last_occupancy[event.device.id]._replace(
+                trace=event.trace and event.trace.mark('predicted')))
+            return
+
+        model = await self.registry.get(self.prediction_models[event.device.id])
+        if model is None:
+            return
+
+        binding = self.bindings.get(model.id)
+        if binding is None or binding.inputs_hash != model.inputs_hash:
+            binding = await self.create_binding(model.id, model.inputs_hash)
 
         # The inputs are different than expected by the model
-        if inputs_hash != curr_inputs_hash:
+        if not binding.valid:
             # TODO: rise some visible error for this
+            self.invalid_inputs += 1
+            return
+
+        request = PredictionRequest(event.device, binding.create_row(event.signals), event.trace)
+        if self.cache_size:
+            request.cache = self.caches.get(model.id)
+            if request.cache is None:
+                request.cache = self.caches[model.id] = PredictionCache(self.cache_size, self.cache_resolution)
+
+            request.cache_key = request.cache.key(request.row)
+            result = request.cache.get(request.cache_key)
+            if result is not None:
+                self.post_occupancy(binding, request, result)
+                return
+
+        self.enqueue(binding, model.estimator, request)
+
+    @subscribe(TopologyChangedEvent)
+    def handle_topology_changed(self, event):
+        self.topology_version += 1
+        self.bindings.clear()
+        self.caches.clear()
+        # The last results name the rooms of the previous topology
+        self.last_occupancy.clear()
+
+    @subscribe(PredictionModelChangedEvent)
+    def handle_prediction_model_changed(self, event):
+        self.caches.pop(event.model_id, None)
+        for device_id, model_id in self.prediction_models.items():
+            if model_id == event.model_id:
+                self.last_occupancy.pop(device_id, None)
+
+    async def create_binding(self, model_id, inputs_hash):
+        version = self.topology_version
+        rooms, scanners = await get_rooms_scanners()
+        curr_inputs_hash = await calculate_inputs_hash(rooms=rooms, scanners=scanners)
+        binding = ModelBinding(inputs_hash, curr_inputs_hash, rooms, scanners)
+
+        # Do not keep the binding if the topology has changed meanwhile
+        if version == self.topology_version:
+            self.bindings[model_id] = binding
+        return binding
+
+    def enqueue(self, binding, estimator, request):
+        """
+        Add the request to the batch of its model binding. A newer heartbeat
+        of a device replaces the one still waiting in the batch
+        """
+        _, requests = self.pending.setdefault(binding, (estimator, {}))
+        if request.device.id not in requests:
+            self.pending_size += 1
+        requests[request.device.id] = request
+
+        if self.pending_size >= self.batch_max_size:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_event_loop()
+            self.flush_handle = loop.call_later(self.batch_window, self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+
+        pending, self.pending, self.pending_size = self.pending, {}, 0
+        for binding, (estimator, requests) in pending.items():
+            task = asyncio.ensure_future(self.predict_batch(estimator, binding, list(requests.values())))
+            task.add_done_callback(self.log_batch_errors)
+
+    @staticmethod
+    def log_batch_errors(task):
+        if not task.cancelled() and task.exception() is not None:
+            logging.error('Batch prediction failed', exc_info=task.exception())
+
+    async def predict_batch(self, estimator, binding, requests):
+        # Predict presence of all devices in a separate thread
+        data = np.stack([r.row for r in requests])
+        results = await predict_presence(estimator, data)
+
+        self.batches += 1
+        self.predictions += len(requests)
+        self.max_batch_size = max(self.max_batch_size, len(requests))
+
+        for request, result in zip(requests, results):
+            if request.cache is not None:
+                request.cache.put(request.cache_key, result)
+            self.post_occupancy(binding, request, result)
+
+    def post_occupancy(self, binding, request, result):
+        # The device has been removed while it was predicted
+        if request.device.id not in self.prediction_models:
             return
 
-        # Predict presence in a separate thread
-        scanner_uuids = [s.uuid for s in scanners]
-        default_heartbeat = dict(zip(scanner_uuids, [-100] * len(scanner_uuids)))
-        data = pd.DataFrame([{**default_heartbeat, **event.signals}])
-        result = await predict_presence(estimator, data)
-        result = [{
-            "room": rooms_map[k],
-            "state": True,
-            "proba": result[k],
-        } for k in result.keys()]
-
-        eventbus.post(OccupancyEvent(
-            device=event.device,
-            room_occupancy=result,
-            signals=data.iloc[0].to_dict(),
-        ))
+        occupancy = OccupancyEvent(
+            device=request.device,
+            room_occupancy=[{
+                "room": binding.rooms_map[k],
+                "state": True,
+                "proba": result[k],
+            } for k in result.keys()],
+            signals=dict(zip(binding.scanner_uuids, request.row.tolist())),
+            trace=request.trace and request.trace.mark('predicted'),
+        )
+        self.last_occupancy[request.device.id] = occupancy
+        eventbus.post(occupancy)
@@ -0,0 +1,176 @@
+import asyncio
+import logging
+from collections import OrderedDict, namedtuple
+
+from server import config, metrics
+from server.constants import MQTT_PUBLISH_MAX_RETRY_DELAY_SEC, MQTT_PUBLISH_RETRY_DELAY_SEC
+from server.eventbus import EventBusSubscriber, subscribe
+from server.events import MQTTConnectedEvent, MQTTDisconnectedEvent
+
+PendingPublish = namedtuple('PendingPublish', 'payload, qos, retain, enqueued, trace')
+
+publish_latency = metrics.registry.histogram('mqtt_publish', 'Room state queued to published to MQTT')
+
+
+class MQTTPublisher(EventBusSubscriber):
+    """
+    Outbound MQTT messages, published without blocking the tracking.
+    Every topic has a single slot with its latest payload, so rapid
+    changes of a topic are coalesced to the last one, and a payload
+    already published to the topic is not published again. Up to
+    `concurrency` messages are in flight, at most `rate` per second.
+    A topic which failed to publish is retried after `retry_delay`,
+    doubled with every failure in a row up to `max_retry_delay`.
+    """
+    def __init__(self, qos=None, retain=None, concurrency=None, rate=None,
+                 retry_delay=MQTT_PUBLISH_RETRY_DELAY_SEC, max_retry_delay=MQTT_PUBLISH_MAX_RETRY_DELAY_SEC):
+        super().__init__()
+        self.qos = config.MQTT_PUBLISH_QOS if qos is None else qos
+        self.retain = config.MQTT_PUBLISH_RETAIN if retain is None else retain
+        self.concurrency = concurrency or config.MQTT_PUBLISH_CONCURRENCY
+        self.rate = config.MQTT_PUBLISH_RATE if rate is None else rate
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.pending = OrderedDict()
+        self.in_flight = set()
+        self.last_published = {}
+        self.backoff = {}
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.idle.set()
+        self.worker = None
+        self.published = 0
+        self.coalesced = 0
+        self.unchanged = 0
+        self.failed = 0
+
+    def publish(self, topic, payload, qos=None, retain=None, trace=None):
+        if topic in self.pending:
+            self.coalesced += 1
+        self.pending[topic] = PendingPublish(
+            payload=payload,
+            qos=self.qos if qos is None else qos,
+            retain=self.retain if retain is None else retain,
+            enqueued=metrics.now(),
+            trace=trace,
+        )
+        self.idle.clear()
+        self.wakeup.set()
+
+    @subscribe(MQTTConnectedEvent)
+    def handle_mqtt_connect(self, event):
+        self.stop()
+        self.backoff.clear()
+        self.worker = asyncio.ensure_future(self.run(event.client))
+
+    @subscribe(MQTTDisconnectedEvent)
+    def handle_mqtt_disconnect(self, event):
+        self.stop()
+        # Whatever the broker has lost is published again after reconnecting
+        self.last_published.clear()
+
+    def stop(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker = None
+
+    async def join(self):
+        """
+        Wait until everything queued has been published
+        """
+        await self.idle.wait()
+
+    def next_topic(self, now):
+        return next((
+            t for t in self.pending
+            if t not in self.in_flight and (t not in self.backoff or self.backoff[t][1] <= now)
+        ), None)
+
+    def next_retry(self, now):
+        """
+        Seconds until the first pending topic is retried, None without any
+        """
+        retries = [self.backoff[t][1] for t in self.pending if t in self.backoff and t not in self.in_flight]
+        return max(min(retries) - now, 0) if retries else None
+
+    async def run(self, client):
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tokens, refilled_at = max(self.rate, 1), loop.time()
+
+        while True:
+            topic = self.next_topic(loop.time())
+            if topic is None:
+                self.wakeup.clear()
+                retry = self.next_retry(loop.time())
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), retry)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            item = self.pending[topic]
+            if item.payload == self.last_published.get(topic):
+                del self.pending[topic]
+                self.backoff.pop(topic, None)
+                self.unchanged += 1
+                self.update_idle()
+                continue
+
+            if self.rate > 0:
+                now = loop.time()
+                tokens = min(tokens + (now - refilled_at) * self.rate, max(self.rate, 1))
+                refilled_at = now
+                if tokens < 1:
+                    await asyncio.sleep((1 - tokens) / self.rate)
+                    continue
+                tokens -= 1
+
+            await semaphore.acquire()
+            # The slot may have changed while waiting, publish the latest payload
+            item = self.pending.pop(topic, None)
+            if item is None:
+                semaphore.release()
+                continue
+
+            self.in_flight.add(topic)
+            asyncio.ensure_future(self.send(client, topic, item, semaphore))
+
+    async def send(self, client, topic, item, semaphore):
+        try:
+            await client.publish(topic, item.payload, qos=item.qos, retain=item.retain)
+        except Exception as e:
+            self.failed += 1
+            logging.warning('Cannot publish to %s: %s', topic, e)
+            delay = min(self.backoff[topic][0] * 2, self.max_retry_delay) if topic in self.backoff else self.retry_delay
+            self.backoff[topic] = (delay, asyncio.get_running_loop().time() + delay)
+            # Retry unless there is a newer payload already
+            if topic not in self.pending:
+                self.pending[topic] = item
+        else:
+            self.backoff.pop(topic, None)
+            self.published += 1
+            self.last_published[topic] = item.payload
+            publish_latency.observe(metrics.now() - item.enqueued)
+            if item.trace is not None:
+                item.trace.mark('published')
+        finally:
+            self.in_flight.discard(topic)
+            semaphore.release()
+            self.update_idle()
+            self.wakeup.set()
+
+    def update_idle(self):
+        if not self.pending and not self.in_flight:
+            self.idle.set()
+
+    def stats(self):
+        return {
+            'published': self.published,
+            'coalesced': self.coalesced,
+            'unchanged': self.unchanged,
+            'failed': self.failed,
+            'pending': len(self.pending),
+            'in_flight': len(self.in_flight),
+            'backing_off': len(self.backoff),
+        }
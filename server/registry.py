@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import pickle
+import time
+from collections import OrderedDict
+
+from server import config
+from server.compiled import compile_estimator
+from server.eventbus import EventBusSubscriber, subscribe
+from server.events import PredictionModelChangedEvent
+from server.models import PredictionModel
+from server.modelstore import ModelStore
+from server.utils import run_in_executor
+
+
+def load_estimator(data):
+    """
+    Unpickle the model and compile it for fast predictions,
+    models we cannot compile are used as they are
+    """
+    estimator = pickle.loads(data)
+    try:
+        return compile_estimator(estimator)
+    except ValueError:
+        logging.warning('Cannot compile the prediction model, using it as is', exc_info=True)
+        return estimator
+
+
+@run_in_executor('inference')
+def threaded_load_estimator(data):
+    return load_estimator(data)
+
+
+@run_in_executor('inference')
+def threaded_read_estimator(store, name):
+    return store.load(name)
+
+
+class LoadedModel:
+    def __init__(self, id, estimator, inputs_hash, size, load_time):
+        self.id = id
+        self.estimator = estimator
+        self.inputs_hash = inputs_hash
+        self.size = size
+        self.load_time = load_time
+        self.hits = 0
+
+
+class ModelRegistry(EventBusSubscriber):
+    """
+    Prediction models loaded on the first use and shared by all devices
+    using them. The least recently used models are evicted when the size
+    of the loaded models exceeds the memory budget, the most recent one
+    always stays loaded. A model is dropped when it is saved or deleted.
+    """
+    def __init__(self, memory_budget=None, store=None):
+        super().__init__()
+        self.store = store or ModelStore()
+        self.memory_budget = (config.MODEL_REGISTRY_MEMORY_MB * 2 ** 20) if memory_budget is None else memory_budget
+        self.models = OrderedDict()
+        self.loading = {}
+        self.loads = 0
+        self.evictions = 0
+
+    @property
+    def resident_size(self):
+        return sum(m.size for m in self.models.values())
+
+    async def get(self, model_id):
+        """
+        The loaded model, or None if there is no such model
+        """
+        model = self.models.get(model_id)
+        if model is not None:
+            self.models.move_to_end(model_id)
+            model.hits += 1
+            return model
+
+        # Devices using the same model wait for the same load
+        task = self.loading.get(model_id)
+        if task is None:
+            task = self.loading[model_id] = asyncio.ensure_future(self.load(model_id))
+
+        try:
+            model = await asyncio.shield(task)
+        except Exception:
+            model = None
+            if self.loading.get(model_id) is task:
+                logging.exception('Cannot load the prediction model %s', model_id)
+
+        # Keep the model unless it has been changed while it was loading
+        if self.loading.get(model_id) is task:
+            del self.loading[model_id]
+            if model is not None:
+                self.models[model_id] = model
+                self.evict()
+        return model
+
+    async def load(self, model_id):
+        record = await PredictionModel.filter(id=model_id).first().values('inputs_hash', 'model_file')
+        if record is None:
+            return None
+
+        started = time.perf_counter()
+        if record['model_file']:
+            estimator = await threaded_read_estimator(self.store, record['model_file'])
+            size = estimator.nbytes
+        else:
+            # Fetch the pickle only for models not converted to model files
+            data = await PredictionModel.filter(id=model_id).first().values_list('model', flat=True)
+            if data is None:
+                return None
+            estimator = await threaded_load_estimator(data)
+            size = getattr(estimator, 'nbytes', len(data))
+
+        self.loads += 1
+        return LoadedModel(
+            id=model_id,
+            estimator=estimator,
+            inputs_hash=record['inputs_hash'],
+            size=size,
+            load_time=time.perf_counter() - started,
+        )
+
+    def evict(self):
+        while len(self.models) > 1 and self.resident_size > self.memory_budget:
+            model_id, _ = self.models.popitem(last=False)
+            self.evictions += 1
+            logging.info('Evicted the prediction model %s from memory', model_id)
+
+    def invalidate(self, model_id):
+        self.models.pop(model_id, None)
+        self.loading.pop(model_id, None)
+
+    @subscribe(PredictionModelChangedEvent)
+    def handle_prediction_model_changed(self, event):
+        self.invalidate(event.model_id)
+
+    def stats(self):
+        return {
+            'loads': self.loads,
+            'evictions': self.evictions,
+            'resident_size': self.resident_size,
+            'memory_budget': self.memory_budget,
+            'models': dict((m.id, {
+                'size': m.size,
+                'load_time': m.load_time,
+                'hits': m.hits,
+            }) for m in self.models.values()),
+        }
@@ -0,0 +1,348 @@
+"""
+Replays recorded signals through Heartbeat → Predict → Sensor at N×
+real time, to measure throughput and latency of the pipeline offline.
+
+Every CSV file (columns: scanner, rssi, when, position, room) becomes
+a separate device. Its signals are stored in an in-memory database,
+a prediction model is trained on them and then the same signals are
+published as MQTT messages following a replay clock, while the room
+states are collected from a fake MQTT client.
+
+    python -m server.replay signals.csv research/data/signals-long.csv --speed 100
+
+With --virtual the signals are replayed on a virtual clock advanced by
+the harness instead, so the same signals always give the same room
+states. The inference then runs inline and the prediction batches are
+flushed at every step of the clock, the stage latencies are not
+measured in this mode.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+from tortoise import Tortoise
+
+from server import clock, config
+from server.constants import SCANNERS_TOPIC
+from server.eventbus import EventBusSubscriber, eventbus, subscribe
+from server.events import (
+    DeviceAddedEvent, HeartbeatEvent, MQTTConnectedEvent, MQTTMessageEvent, OccupancyEvent, RoomAddedEvent,
+    RoomStateChangeEvent)
+from server.heartbeat import Heartbeat
+from server.learn import prepare_training_data, train_model
+from server.models import Device, DeviceSignal, LearningSession, PredictionModel, Room, Scanner
+from server.modelstore import ModelStore, store_estimator
+from server.predict import Predict
+from server.registry import ModelRegistry
+from server.sensor import Sensor, get_room_state_topic
+from server.utils import calculate_inputs_hash, executors
+
+class FakeMQTTClient:
+    def __init__(self):
+        self.published = []
+
+    async def subscribe(self, topic):
+        pass
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        self.published.append((clock.timestamp(), topic, payload))
+
+
+class ReplayRecorder(EventBusSubscriber):
+    """
+    Counts the events of every stage and measures (in wall time) how long
+    it takes a device to get from one stage to the next one
+    """
+    def __init__(self):
+        super().__init__()
+        self.counts = defaultdict(int)
+        self.latencies = defaultdict(list)
+        self.pending_messages = {}
+        self.heartbeats = {}
+        self.occupancies = {}
+        self.room_devices = {}
+
+    def observe(self, stage, started):
+        if started is not None:
+            self.latencies[stage].append(time.perf_counter() - started)
+
+    @subscribe(MQTTMessageEvent)
+    def handle_mqtt_message(self, event):
+        self.counts['messages'] += 1
+        self.pending_messages.setdefault(event.payload['uuid'], time.perf_counter())
+
+    @subscribe(HeartbeatEvent)
+    def handle_heartbeat(self, event):
+        self.counts['heartbeats'] += 1
+        self.observe('mqtt_to_heartbeat', self.pending_messages.pop(event.device.uuid, None))
+        self.heartbeats[event.device.id] = time.perf_counter()
+
+    @subscribe(OccupancyEvent)
+    def handle_occupancy(self, event):
+        self.counts['occupancy'] += 1
+        self.observe('heartbeat_to_occupancy', self.heartbeats.pop(event.device.id, None))
+        self.occupancies[event.device.id] = time.perf_counter()
+
+    @subscribe(RoomStateChangeEvent)
+    def handle_room_state(self, event):
+        self.counts['room_state_changes'] += 1
+        # Measured from the occupancy of the device which has entered or left the room
+        devices = set(d.id for d in event.devices)
+        changed = devices ^ self.room_devices.get(event.room.id, set())
+        self.room_devices[event.room.id] = devices
+        started = [self.occupancies[d] for d in changed if d in self.occupancies]
+        self.observe('occupancy_to_room_state', min(started) if started else None)
+
+
+def load_signals(path, max_gap):
+    df = pd.read_csv(path, parse_dates=['when'])
+    df['timestamp'] = df['when'].values.astype('datetime64[ns]').astype('int64') / 1e9
+    df = df.sort_values('timestamp').reset_index(drop=True)
+
+    # Squash the idle periods between recording sessions
+    gaps = np.minimum(np.diff(df['timestamp'].values, prepend=df['timestamp'].values[0]), max_gap)
+    df['offset'] = np.cumsum(gaps)
+    return df
+
+
+async def create_device(name, uuid, df, rooms, scanners, store):
+    device = await Device.create(name=name, uuid=uuid)
+    sessions = {}
+    for position, room in df[['position', 'room']].drop_duplicates().itertuples(index=False):
+        sessions[position] = await LearningSession.create(device=device, room=rooms[room])
+
+    await DeviceSignal.bulk_create([DeviceSignal(
+        device=device,
+        room=rooms[row.room],
+        scanner=scanners[row.scanner],
+        learning_session=sessions[row.position],
+        rssi=row.rssi,
+        created_at=row.when.to_pydatetime(),
+        updated_at=row.when.to_pydatetime(),
+    ) for row in df.itertuples()])
+
+    # Seeded by --seed through the global random state, like the model
+    X, y = await prepare_training_data(device, seed=np.random.randint(2 ** 31))
+    accuracy, estimator, error = await train_model(device, X, y)
+    if error is not None:
+        raise error
+
+    model = await PredictionModel.create(
+        accuracy=accuracy,
+        inputs_hash=await calculate_inputs_hash(),
+        **store_estimator(estimator, store)
+    )
+    device.prediction_model = model
+    await device.save()
+    return device
+
+
+async def setup(datasets, store):
+    await Tortoise.init(config.MEMORY_TORTOISE_ORM)
+    await Tortoise.generate_schemas()
+
+    frames = list(datasets.values())
+    room_names = sorted(set().union(*(set(df['room']) for df in frames)))
+    scanner_names = sorted(set().union(*(set(df['scanner']) for df in frames)))
+    rooms = dict([(name, await Room.create(name=name)) for name in room_names])
+    scanners = dict([(name, await Scanner.create(name=name, uuid=name)) for name in scanner_names])
+
+    devices = {}
+    for name, df in datasets.items():
+        started = time.perf_counter()
+        devices[name] = await create_device(name, 'replay-{}'.format(len(devices)), df, rooms, scanners, store)
+        print('Trained the model of {} in {:.1f}s'.format(name, time.perf_counter() - started))
+
+    return devices, rooms
+
+
+class InlineExecutor:
+    """
+    Runs the inference on the loop, so the predictions started by a step
+    of the clock always finish in the same order
+    """
+    async def run(self, f, *args, **kwargs):
+        return f(*args, **kwargs)
+
+    def stats(self):
+        return {}
+
+
+async def settle(pipeline):
+    """
+    Run the loop until the pipeline has worked off everything started by the
+    last step of the clock. The batch window of Predict is in the real time,
+    so its batches are flushed here once all heartbeats of the step are in
+    """
+    predict, sensor = pipeline[1], pipeline[2]
+    while True:
+        await asyncio.sleep(0)
+        busy = [t for t in asyncio.all_tasks() if not clock.source.is_sleeping(t)
+                and t is not asyncio.current_task() and t is not sensor.publisher.worker]
+        if busy:
+            await asyncio.wait(busy)
+        elif predict.pending:
+            predict.flush()
+        elif sensor.evaluation_scheduled:
+            continue
+        elif not sensor.publisher.idle.is_set():
+            await sensor.publisher.join()
+        else:
+            return
+
+
+async def advance(pipeline, until):
+    """
+    Step the clock through every deadline up to `until`, letting the
+    pipeline settle after each of them
+    """
+    while clock.source.step(until):
+        await settle(pipeline)
+    await settle(pipeline)
+
+
+async def replay(datasets, devices, rooms, store, tail, speed=None):
+    """
+    Replay the signals `speed` times faster than the real time, or on
+    a virtual clock when no speed is given
+    """
+    messages = pd.concat([
+        pd.DataFrame({
+            'offset': df['offset'],
+            'topic': SCANNERS_TOPIC + df['scanner'],
+            'uuid': devices[name].uuid,
+            'rssi': df['rssi'],
+        }) for name, df in datasets.items()
+    ]).sort_values('offset', kind='mergesort')
+
+    start = min(df['timestamp'].iloc[0] for df in datasets.values())
+    client = FakeMQTTClient()
+    recorder = ReplayRecorder()
+    if speed:
+        clock.set_clock(clock.ReplayClock(start, speed))
+        predict = Predict(registry=ModelRegistry(store=store))
+    else:
+        clock.set_clock(clock.VirtualClock(start))
+        executors['inference'] = InlineExecutor()
+        predict = Predict(registry=ModelRegistry(store=store), batch_window=float('inf'))
+    pipeline = [Heartbeat(), predict, Sensor()]
+
+    try:
+        for device in devices.values():
+            eventbus.post(DeviceAddedEvent(device=device))
+        for room in rooms.values():
+            eventbus.post(RoomAddedEvent(room=room))
+        eventbus.post(MQTTConnectedEvent(client=client))
+        await asyncio.sleep(0)
+
+        started = time.perf_counter()
+        if speed:
+            await replay_in_real_time(pipeline, messages, start, tail)
+        else:
+            await replay_on_virtual_clock(pipeline, messages, tail)
+        duration = time.perf_counter() - started
+    finally:
+        pipeline[0].scheduler.stop()
+        pipeline[2].publisher.stop()
+        subscribers = pipeline + [recorder, pipeline[1].registry, pipeline[2].publisher]
+        for subscriber in subscribers:
+            eventbus.remove_instance_subscribers(subscriber, subscriber._subscribers)
+        executors.pop('inference', None)
+        clock.set_clock(clock.SystemClock())
+
+    return recorder, client, duration, start
+
+
+async def replay_in_real_time(pipeline, messages, start, tail):
+    for offset, topic, uuid, rssi in messages.itertuples(index=False):
+        delay = start + offset - clock.timestamp()
+        if delay > 0:
+            await clock.sleep(delay)
+
+        eventbus.post(MQTTMessageEvent(topic=topic, payload={
+            'uuid': uuid, 'rssi': int(rssi), 'when': clock.timestamp()
+        }))
+
+    await clock.sleep(tail)
+    pipeline[0].scheduler.stop()
+
+    # Let the pipeline work off the backlog of predictions and publishes
+    pending = asyncio.all_tasks() - {asyncio.current_task(), pipeline[2].publisher.worker}
+    if pending:
+        await asyncio.wait(pending)
+    await pipeline[2].publisher.join()
+
+
+async def replay_on_virtual_clock(pipeline, messages, tail):
+    await settle(pipeline)
+    for offset, topic, uuid, rssi in messages.itertuples(index=False):
+        await advance(pipeline, offset)
+        eventbus.post(MQTTMessageEvent(topic=topic, payload={
+            'uuid': uuid, 'rssi': int(rssi), 'when': clock.timestamp()
+        }))
+        await settle(pipeline)
+
+    await advance(pipeline, clock.monotonic() + tail)
+
+
+def print_report(recorder, client, duration, start, rooms, show_timeline, show_latency):
+    print('\nReplayed in {:.1f}s of wall time'.format(duration))
+    for name, count in recorder.counts.items():
+        print('  {:<20} {:>8} {:>10.1f}/s'.format(name, count, count / duration))
+
+    if show_latency:
+        print_latency(recorder)
+
+    state_topics = dict((get_room_state_topic(r), r.name) for r in rooms.values())
+    states = [(t, state_topics[topic], payload) for t, topic, payload in client.published if topic in state_topics]
+    print('\nPublished {} room states'.format(len(states)))
+    if show_timeline:
+        for timestamp, room, payload in states:
+            print('  {:>10.1f}s  {:<12} {}'.format(timestamp - start, room, payload))
+
+
+def print_latency(recorder):
+    print('\nStage latency, ms       count      mean       p50       p95       max')
+    for stage, values in recorder.latencies.items():
+        values = np.array(values) * 1000
+        print('  {:<20} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            stage, len(values), values.mean(), np.percentile(values, 50), np.percentile(values, 95), values.max()))
+
+
+async def main(args):
+    np.random.seed(args.seed)
+    datasets = dict(
+        (os.path.splitext(os.path.basename(path))[0], load_signals(path, args.max_gap)) for path in args.files)
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = ModelStore(directory)
+        devices, rooms = await setup(datasets, store)
+        try:
+            speed = None if args.virtual else args.speed
+            recorder, client, duration, start = await replay(datasets, devices, rooms, store, args.tail, speed)
+            print_report(recorder, client, duration, start, rooms, args.timeline, show_latency=speed is not None)
+        finally:
+            await Tortoise.close_connections()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay recorded signals through the tracking pipeline')
+    parser.add_argument('files', nargs='+', help='CSV files with signals, one device per file')
+    parser.add_argument('--speed', type=float, default=50, help='How many times faster than the real time')
+    parser.add_argument(
+        '--virtual', action='store_true',
+        help='Replay on a virtual clock as fast as possible: the same room states every time, but no latencies')
+    parser.add_argument('--max-gap', type=float, default=300, help='Longest pause between signals, seconds')
+    parser.add_argument('--tail', type=float, default=60, help='Replay time to wait after the last signal')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the training dataset and the model')
+    parser.add_argument('--timeline', action='store_true', help='Print every published room state')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -1,11 +1,13 @@
 import asyncio
+import numpy as np
 from server.constants import DEVICE_CHANGE_STATE_BEATS, DEVICE_CHANGE_STATE_SECONDS
 import jsons
-from datetime import datetime
+from server import clock, config
 from server.eventbus import EventBusSubscriber, subscribe, eventbus
 from server.events import (
     DeviceAddedEvent, DeviceRemovedEvent, MQTTConnectedEvent, MQTTDisconnectedEvent,
     OccupancyEvent, RoomAddedEvent, RoomRemovedEvent, RoomStateChangeEvent)
+from server.publisher import MQTTPublisher
 
 
 def get_room_topic(room):
@@ -21,103 +23,105 @@ def get_room_state_topic(room):
     return '{}/state'.format(get_room_topic(room))
 
 
-class MQTTClientHolder(EventBusSubscriber):
-    def __init__(self):
-        super().__init__()
-        self.create_mqtt_future()
-
-    def create_mqtt_future(self):
-        loop = asyncio.get_running_loop()
-        self.mqtt_client = loop.create_future()
-
-    @subscribe(MQTTConnectedEvent)
-    def handle_mqtt_connect(self, event):
-        self.mqtt_client.set_result(event.client)
-
-    @subscribe(MQTTDisconnectedEvent)
-    def handle_mqtt_disconnect(self, event):
-        self.create_mqtt_future()
-
-    def __call__(self, *args, **kwds):
-        return self.mqtt_client
-
-
-class DeviceState:
-    def __init__(self, device):
-        self.device = device
-        self.in_rooms = {}
-        self.maybe_in_rooms = None
-
-    async def update_room(self, room_id, room_state):
-        now_timestamp = datetime.now().timestamp()
-        current_maybe_state = self.maybe_in_rooms.get(room_id, {
-            'last_state': room_state,
-            'appeared_at': datetime.now().timestamp(),
-            'appeared_times': 0,
-        })
-        self.maybe_in_rooms[room_id] = current_maybe_state
-        current_maybe_state['appeared_times'] += 1
-
-        # State is different, start measuring the state staleness
-        if current_maybe_state['last_state'] != room_state:
-            self.maybe_in_rooms[room_id] = {
-                'last_state': room_state,
-                'appeared_at': now_timestamp,
-                'appeared_times': 0,
-            }
-
-        # The state is not changed for X seconds – make the state as active
-        elif all([
-            current_maybe_state['last_state'] == room_state,
-            (now_timestamp - current_maybe_state['appeared_at']) >= DEVICE_CHANGE_STATE_SECONDS,
-            current_maybe_state['appeared_times'] >= DEVICE_CHANGE_STATE_BEATS,
-        ]):
-            current_maybe_state['appeared_at'] = now_timestamp
-            current_maybe_state['appeared_times'] = 0
-            self.in_rooms[room_id] = room_state
-
-    async def update(self, room_occupancy):
-        # When the device is not detected in any rooms – clear the state
-        if not room_occupancy or self.maybe_in_rooms is None:
-            self.maybe_in_rooms = {}
-            self.in_rooms = {}
-        else:
-            merged_occupancy = dict((r, False) for r, _ in self.in_rooms.items())
-            merged_occupancy.update(dict((r, False) for r, _ in self.maybe_in_rooms.items()))
-            merged_occupancy.update(dict((o['room'].id, o['state']) for o in room_occupancy))
-            results = (self.update_room(r, s) for r, s in merged_occupancy.items())
-            await asyncio.gather(*results)
+class DeviceStateBank:
+    """
+    The states of many devices in arrays of devices × rooms. A room state
+    reported for a device has to stay the same for `seconds` and `beats`
+    before the device is moved to (or out of) the room. Any subset of
+    the devices is updated with a single call.
+    """
+    def __init__(self, devices=0, rooms=0, seconds=DEVICE_CHANGE_STATE_SECONDS, beats=DEVICE_CHANGE_STATE_BEATS):
+        self.seconds = seconds
+        self.beats = beats
+        self.initialized = np.zeros(devices, dtype=bool)
+        self.known = np.zeros((devices, rooms), dtype=bool)
+        self.last_state = np.zeros((devices, rooms), dtype=bool)
+        self.appeared_at = np.zeros((devices, rooms))
+        self.appeared_times = np.zeros((devices, rooms), dtype=np.int64)
+        self.in_room = np.zeros((devices, rooms), dtype=bool)
+
+    @property
+    def shape(self):
+        return self.known.shape
+
+    def resize(self, devices, rooms):
+        devices, rooms = max(devices, self.shape[0]), max(rooms, self.shape[1])
+        if (devices, rooms) == self.shape:
+            return
 
-    def is_in_room(self, room_id):
-        return self.in_rooms.get(room_id, False)
+        self.initialized = np.append(self.initialized, np.zeros(devices - len(self.initialized), dtype=bool))
+        for name in ('known', 'last_state', 'appeared_at', 'appeared_times', 'in_room'):
+            array = getattr(self, name)
+            grown = np.zeros((devices, rooms), dtype=array.dtype)
+            grown[:array.shape[0], :array.shape[1]] = array
+            setattr(self, name, grown)
+
+    def reset(self, index):
+        self.initialized[index] = False
+        self.known[index] = False
+        self.in_room[index] = False
+
+    def update(self, index, observed, state, now):
+        """
+        Update the devices at the given (unique) indexes with the occupancy
+        of the rooms where they are `observed`. The first update of
+        a device and an update without any rooms clear it.
+        """
+        index = np.asarray(index, dtype=np.intp)
+        observed = np.asarray(observed, dtype=bool)
+        clear = ~self.initialized[index] | ~observed.any(axis=1)
+        self.initialized[index] = True
+        self.known[index[clear]] = False
+        self.in_room[index[clear]] = False
+
+        keep = ~clear
+        rows, observed = index[keep], observed[keep]
+        state = np.asarray(state, dtype=bool)[keep] & observed
+
+        # Rooms seen before and not observed now count as unoccupied
+        known = self.known[rows]
+        merged = known | observed
+        last_state = np.where(known, self.last_state[rows], state)
+        appeared_at = np.where(known, self.appeared_at[rows], now)
+        appeared_times = np.where(known, self.appeared_times[rows], 0) + merged
+
+        changed = merged & (last_state != state)
+        promoted = merged & ~changed & (now - appeared_at >= self.seconds) & (appeared_times >= self.beats)
+        restarted = changed | promoted
+
+        self.known[rows] = merged
+        self.last_state[rows] = state
+        self.appeared_at[rows] = np.where(restarted, now, appeared_at)
+        self.appeared_times[rows] = np.where(restarted, 0, appeared_times)
+        self.in_room[rows] = np.where(promoted, state, self.in_room[rows])
 
 
 class RoomTracker(EventBusSubscriber):
-    def __init__(self, room, mqtt_client):
+    def __init__(self, room, publisher):
         super().__init__()
         self.room = room
-        self.mqtt_client = mqtt_client
+        self.publisher = publisher
         self.state = False
         self.active_devices = []
 
-    async def configure(self):
-        client = await self.mqtt_client()
-        payload = jsons.dumps({
+    def discovery_payload(self):
+        return jsons.dumps({
             'name': '{} Room Occupancy'.format(self.room.name),
             'device_class': 'occupancy',
             'state_topic': get_room_state_topic(self.room),
             'unique_id': 'room_occupancy.{}.{}'.format(
                 self.room.id, self.room.name).replace(' ', '_').lower(),
         })
-        await client.publish(get_room_config_topic(self.room), payload)
 
-    async def remove(self):
-        client = await self.mqtt_client()
-        await client.publish(get_room_config_topic(self.room), '')
+    def configure(self, payload=None):
+        self.publisher.publish(
+            get_room_config_topic(self.room), payload or self.discovery_payload(), retain=config.MQTT_DISCOVERY_RETAIN)
+
+    def remove(self):
+        self.publisher.publish(get_room_config_topic(self.room), '', retain=config.MQTT_DISCOVERY_RETAIN)
 
-    async def recompute_state(self, device_states, force_publish=False):
-        occupied = any(d.is_in_room(self.room.id) for k, d in device_states.items())
-        active_devices = [d.device for k, d in device_states.items() if d.is_in_room(self.room.id)]
+    def recompute_state(self, active_devices, force_publish=False, trace=None):
+        occupied = bool(active_devices)
         state_changed = occupied != self.state
         devices_changed = active_devices != self.active_devices
 
@@ -132,65 +136,182 @@ class RoomTracker(EventBusSubscriber):
             ))
 
         if state_changed or force_publish:
-            client = await self.mqtt_client()
-            payload = 'ON' if occupied else 'OFF'
-            await client.publish(get_room_state_topic(self.room), payload)
+            self.publisher.publish(
+                get_room_state_topic(self.room), 'ON' if occupied else 'OFF', trace=trace if state_changed else None)
 
 
 class Sensor(EventBusSubscriber):
     def __init__(self):
         super().__init__()
         self.room_trackers = {}
-        self.device_states = {}
-        self.mqtt_client = MQTTClientHolder()
+        self.devices = {}
+        # Rows of the devices and columns of the rooms in the device states
+        self.device_states = DeviceStateBank()
+        self.device_slots = {}
+        self.free_device_slots = []
+        self.room_slots = {}
+        self.slot_rooms = []
+        # Room id to the devices in the room, in the order they entered it
+        self.room_devices = {}
+        self.pending_occupancy = {}
+        self.evaluation_scheduled = False
+        self.publisher = MQTTPublisher()
         self.reconfigure_on_connect = False
+        # The last discovery config published for a room
+        self.discovery_payloads = {}
+
+    def room_slot(self, room_id):
+        if room_id not in self.room_slots:
+            self.room_slots[room_id] = len(self.slot_rooms)
+            self.slot_rooms.append(room_id)
+        return self.room_slots[room_id]
+
+    def occupied_rooms(self, slot):
+        return set(self.slot_rooms[i] for i in np.flatnonzero(self.device_states.in_room[slot]))
+
+    def active_devices(self, room_id):
+        return list(self.room_devices.get(room_id, {}).values())
+
+    def update_room_devices(self, device, entered, left):
+        for room_id in left:
+            devices = self.room_devices.get(room_id)
+            if devices is not None:
+                devices.pop(device.id, None)
+                if not devices:
+                    del self.room_devices[room_id]
+        for room_id in entered:
+            self.room_devices.setdefault(room_id, {})[device.id] = device
+
+    def recompute_state(self, room_ids, traces=None):
+        """
+        Re-evaluate only the rooms whose devices have changed
+        """
+        traces = traces or {}
+        for room_id in room_ids:
+            if room_id in self.room_trackers:
+                self.room_trackers[room_id].recompute_state(self.active_devices(room_id), trace=traces.get(room_id))
+
+    def configure_room(self, tracker):
+        """
+        Publish the discovery config of the room, unless the same one has
+        been published retained since the client connected
+        """
+        payload = tracker.discovery_payload()
+        if config.MQTT_DISCOVERY_RETAIN and self.discovery_payloads.get(tracker.room.id) == payload:
+            return
 
-    async def recompute_state(self):
-        update_results = [t.recompute_state(self.device_states) for k, t in self.room_trackers.items()]
-        await asyncio.gather(*update_results)
+        self.discovery_payloads[tracker.room.id] = payload
+        tracker.configure(payload)
 
     @subscribe(MQTTConnectedEvent)
-    async def handle_mqtt_connect(self, event):
+    def handle_mqtt_connect(self, event):
+        # Everything is queued at once, the publisher bounds how much is in flight
         if self.reconfigure_on_connect:
             for _, tracker in self.room_trackers.items():
-                await tracker.configure()
-                await tracker.recompute_state(self.device_states, force_publish=True)
+                self.configure_room(tracker)
+                tracker.recompute_state(self.active_devices(tracker.room.id), force_publish=True)
 
     @subscribe(MQTTDisconnectedEvent)
     def handle_mqtt_disconnect(self, event):
         self.reconfigure_on_connect = True
+        # The broker may come back without the retained configs, reassert them all
+        self.discovery_payloads.clear()
 
     @subscribe(DeviceAddedEvent)
-    async def handle_device_added(self, event):
-        self.device_states[event.device.id] = DeviceState(event.device)
-        await self.recompute_state()
+    def handle_device_added(self, event):
+        # A re-added device starts over with no rooms
+        slot = self.device_slots.get(event.device.id)
+        if slot is None:
+            slot = self.free_device_slots.pop() if self.free_device_slots else len(self.device_slots)
+            self.device_slots[event.device.id] = slot
+            self.device_states.resize(slot + 1, len(self.slot_rooms))
+
+        left = self.occupied_rooms(slot)
+        self.device_states.reset(slot)
+        self.devices[event.device.id] = event.device
+        self.pending_occupancy.pop(event.device.id, None)
+        self.update_room_devices(event.device, (), left)
+        self.recompute_state(left)
 
     @subscribe(DeviceRemovedEvent)
-    async def handle_device_removed(self, event):
-        if event.device.id in self.device_states:
-            del self.device_states[event.device.id]
-            await self.recompute_state()
+    def handle_device_removed(self, event):
+        if event.device.id in self.devices:
+            del self.devices[event.device.id]
+            self.pending_occupancy.pop(event.device.id, None)
+            slot = self.device_slots.pop(event.device.id)
+            left = self.occupied_rooms(slot)
+            self.device_states.reset(slot)
+            self.free_device_slots.append(slot)
+            self.update_room_devices(event.device, (), left)
+            self.recompute_state(left)
 
     @subscribe(RoomAddedEvent)
-    async def handle_room_added(self, event):
-        tracker = RoomTracker(event.room, self.mqtt_client)
+    def handle_room_added(self, event):
+        tracker = RoomTracker(event.room, self.publisher)
         self.room_trackers[event.room.id] = tracker
-        await tracker.configure()
-        await tracker.recompute_state(self.device_states, force_publish=True)
+        self.configure_room(tracker)
+        tracker.recompute_state(self.active_devices(event.room.id), force_publish=True)
 
     @subscribe(RoomRemovedEvent)
-    async def handle_room_removed(self, event):
+    def handle_room_removed(self, event):
         if event.room.id in self.room_trackers:
             tracker = self.room_trackers[event.room.id]
             del self.room_trackers[event.room.id]
         else:
-            tracker = RoomTracker(event.room, self.mqtt_client)
-        await tracker.remove()
+            tracker = RoomTracker(event.room, self.publisher)
+        self.discovery_payloads.pop(event.room.id, None)
+        tracker.remove()
 
     @subscribe(OccupancyEvent)
-    async def handle_device_occupancy(self, event):
-        if event.device.id not in self.device_states:
+    def handle_device_occupancy(self, event):
+        if event.device.id not in self.devices:
             return
 
-        await self.device_states[event.device.id].update(event.room_occupancy)
-        await self.recompute_state()
+        # A device is updated once per evaluation, an earlier occupancy goes first
+        if event.device.id in self.pending_occupancy:
+            self.evaluate_occupancy()
+
+        self.pending_occupancy[event.device.id] = event
+        if not self.evaluation_scheduled:
+            self.evaluation_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush_occupancy)
+
+    def flush_occupancy(self):
+        self.evaluation_scheduled = False
+        self.evaluate_occupancy()
+
+    def evaluate_occupancy(self):
+        """
+        Update the states of all devices with a pending occupancy at once and
+        recompute the rooms they entered or left
+        """
+        events = list(self.pending_occupancy.values())
+        self.pending_occupancy = {}
+
+        columns = [[self.room_slot(o['room'].id) for o in e.room_occupancy] for e in events]
+        slots = [self.device_slots[e.device.id] for e in events]
+        self.device_states.resize(len(self.device_slots), len(self.slot_rooms))
+        observed = np.zeros((len(events), len(self.slot_rooms)), dtype=bool)
+        state = np.zeros_like(observed)
+        for i, (event, event_columns) in enumerate(zip(events, columns)):
+            observed[i, event_columns] = True
+            state[i, event_columns] = [o['state'] for o in event.room_occupancy]
+
+        before = self.device_states.in_room[slots]
+        self.device_states.update(slots, observed, state, clock.timestamp())
+        after = self.device_states.in_room[slots]
+
+        room_ids, traces = set(), {}
+        for i in np.flatnonzero((before != after).any(axis=1)):
+            entered = [self.slot_rooms[c] for c in np.flatnonzero(after[i] & ~before[i])]
+            left = [self.slot_rooms[c] for c in np.flatnonzero(before[i] & ~after[i])]
+            self.update_room_devices(self.devices[events[i].device.id], entered, left)
+
+            # Trace only the occupancy which has changed the rooms of the device
+            trace = events[i].trace.mark('promoted') if events[i].trace is not None else None
+            for room_id in entered + left:
+                room_ids.add(room_id)
+                if trace is not None:
+                    traces.setdefault(room_id, trace)
+
+        self.recompute_state(room_ids, traces)
@@ -1,13 +1,22 @@
 from ariadne.asgi import GraphQL
 from starlette.applications import Starlette
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+from server.metrics import registry
 from server.mqtt import setup_mqtt
-from server.service import start_service
+from server.service import start_service, stop_service
 from server.models import init_db, close_db
 from server.api import schema
 
+
+async def prometheus_metrics(request):
+    return PlainTextResponse(registry.prometheus_text(), media_type='text/plain; version=0.0.4')
+
+
 app = Starlette(
+    routes=[Route('/metrics', prometheus_metrics)],
     on_startup=[init_db, setup_mqtt, start_service],
-    on_shutdown=[close_db],
+    on_shutdown=[stop_service, close_db],
     debug=True
 )
 app.mount("/graphql", GraphQL(schema, debug=True))
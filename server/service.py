@@ -1,18 +1,62 @@
+from server import config, metrics
 from server.eventbus import eventbus
 from server.events import DeviceAddedEvent, RoomAddedEvent
 from server.heartbeat import Heartbeat
 from server.learn import Learn
 from server.models import Device, Room
+from server.mqtt import ingest_stats
 from server.predict import Predict
 from server.sensor import Sensor
+from server.shard import ShardedTracking
+from server.utils import executors_stats
 
 
 class Service:
     def __init__(self) -> None:
-        self.hearbeat = Heartbeat()
+        if config.TRACKING_WORKERS > 0:
+            self.tracking = ShardedTracking(config.TRACKING_WORKERS)
+            self.tracking.start()
+        else:
+            self.hearbeat = Heartbeat()
+            self.predict = Predict()
         self.learn = Learn()
-        self.predict = Predict()
         self.sensor = Sensor()
+        self.register_metrics()
+
+    def register_metrics(self):
+        registry = metrics.registry
+        registry.register_collector(
+            'mqtt_ingest', ingest_stats.as_dict, 'Scanner messages received from MQTT',
+            counters=('messages', 'batches', 'dropped', 'malformed'))
+        registry.register_collector(
+            'executors', executors_stats, 'Thread pools of inference and training',
+            counters=('completed', 'yield_timeouts'))
+        registry.register_collector(
+            'subscriptions', eventbus.subscriptions_stats, 'Queues of the event bus subscriptions',
+            counters=('dropped', 'coalesced'))
+        registry.register_collector(
+            'mqtt_publish', self.sensor.publisher.stats, 'Room states published to MQTT',
+            counters=('published', 'coalesced', 'unchanged', 'failed'))
+        registry.register_collector(
+            'learn_writes', self.learn.writer.stats, 'Learning signals written to the database',
+            counters=('rows', 'batches', 'failed_rows'))
+        if config.TRACKING_WORKERS > 0:
+            registry.register_collector(
+                'tracking_shards', self.tracking.stats, 'Command queues of the tracking workers',
+                counters=('dropped',))
+        else:
+            registry.register_collector(
+                'scheduler', self.hearbeat.scheduler.stats, 'Heartbeat scheduler ticks', counters=('ticks',))
+            registry.register_collector(
+                'predict', self.predict.stats, 'Occupancy predictions',
+                counters=('predictions', 'invalid_inputs', 'batches', 'hits', 'misses'))
+            registry.register_collector(
+                'model_registry', self.predict.registry.stats, 'Prediction models loaded in memory',
+                counters=('loads', 'evictions', 'hits'))
+
+    async def stop(self):
+        if config.TRACKING_WORKERS > 0:
+            await self.tracking.stop()
 
     async def init_rooms(self):
         rooms = await Room.all()
@@ -25,7 +69,16 @@ class Service:
             eventbus.post(DeviceAddedEvent(device=device))
 
 
+service = None
+
+
 async def start_service():
+    global service
     service = Service()
     await service.init_devices()
     await service.init_rooms()
+
+
+async def stop_service():
+    if service is not None:
+        await service.stop()
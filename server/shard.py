@@ -0,0 +1,334 @@
+import asyncio
+import logging
+import multiprocessing
+import queue
+import threading
+import time
+import zlib
+
+from server import config, metrics
+from server.eventbus import EventBusSubscriber, eventbus, subscribe
+from server.events import (
+    DeviceAddedEvent, DeviceRemovedEvent, DeviceSignalEvent, MQTTConnectedEvent, MQTTMessageBatchEvent,
+    MQTTMessageEvent, OccupancyEvent, PredictionModelChangedEvent, RoomAddedEvent, RoomRemovedEvent,
+    TopologyChangedEvent)
+from server.constants import SCANNERS_TOPIC, SHARD_QUEUE_SIZE, SHARD_STOP_TIMEOUT_SEC
+from server.heartbeat import Heartbeat, MessageRouter, normalize_scanner_payload
+from server.models import Device, get_rooms_scanners, init_db
+from server.predict import Predict
+
+
+def shard_for(identifier, workers):
+    """
+    Stable across processes, unlike the builtin hash of a string
+    """
+    return zlib.crc32(identifier.encode()) % workers
+
+
+class ShardedDevice:
+    def __init__(self, device, shard):
+        self.device = device
+        self.shard = shard
+
+
+class Shard:
+    """
+    The main process end of a worker. Commands are written to the pipe by
+    a thread, so the loop never waits for a busy worker. They wait in a
+    bounded queue and are dropped (and counted) when the worker falls
+    behind by more than `queue_size` commands.
+    """
+    def __init__(self, index, context, queue_size=SHARD_QUEUE_SIZE):
+        self.index = index
+        self.connection, self.worker_connection = context.Pipe()
+        self.process = context.Process(
+            target=run_worker, args=(self.worker_connection,), name='tracking-worker-{}'.format(index), daemon=True)
+        self.commands = queue.Queue(queue_size)
+        self.writer = threading.Thread(target=self.write, name='tracking-writer-{}'.format(index), daemon=True)
+        self.writer.start()
+        self.pending_messages = []
+        self.pending_received = None
+        self.dropped = 0
+
+    def start(self, on_message):
+        self.process.start()
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.connection.fileno(), self.receive, on_message)
+
+    def stop(self):
+        """
+        Ask the writer and the worker to stop, without waiting for them
+        """
+        asyncio.get_running_loop().remove_reader(self.connection.fileno())
+        # Unlike the other commands, these must not be dropped, the oldest
+        # commands make room for them
+        for command in (('stop',), None):
+            while True:
+                try:
+                    self.commands.put_nowait(command)
+                    break
+                except queue.Full:
+                    self.discard()
+
+    def discard(self):
+        try:
+            self.commands.get_nowait()
+            self.dropped += 1
+        except queue.Empty:
+            pass
+
+    def join(self, timeout):
+        """
+        Wait for the writer and the worker to exit, blocking at most `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        self.writer.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.process.is_alive():
+            self.process.join(timeout=max(deadline - time.monotonic(), 0))
+        if self.process.is_alive():
+            logging.error('Tracking worker %s did not stop, terminating it', self.index)
+            self.process.terminate()
+
+    def send(self, command):
+        try:
+            self.commands.put_nowait(command)
+        except queue.Full:
+            self.dropped += 1
+
+    def write(self):
+        while True:
+            command = self.commands.get()
+            if command is None:
+                break
+            try:
+                self.connection.send(command)
+            except (BrokenPipeError, EOFError, OSError) as e:
+                logging.error('Tracking worker %s is not reachable: %s', self.index, e)
+
+    def receive(self, on_message):
+        try:
+            while self.connection.poll():
+                on_message(self.connection.recv())
+        except (EOFError, OSError):
+            logging.error('Tracking worker %s has exited', self.index)
+            asyncio.get_running_loop().remove_reader(self.connection.fileno())
+
+    def flush(self):
+        if self.pending_messages:
+            self.send(('messages', self.pending_messages, self.pending_received))
+            self.pending_messages = []
+            self.pending_received = None
+
+    def stats(self):
+        return {
+            'queued': self.commands.qsize(),
+            'dropped': self.dropped,
+        }
+
+
+class ShardedTracking(EventBusSubscriber):
+    """
+    Runs device tracking and prediction in worker processes. Devices are
+    assigned to a worker by the hash of their identifier and every
+    worker runs its own Heartbeat and Predict. The main process only
+    routes scanner messages to the workers and turns the compact
+    occupancy results they send back into OccupancyEvent.
+    """
+    def __init__(self, workers=None):
+        super().__init__()
+        workers = workers or config.TRACKING_WORKERS
+        context = multiprocessing.get_context('spawn')
+        self.shards = [Shard(i, context) for i in range(workers)]
+        self.devices = {}
+        self.rooms = {}
+        self.router = MessageRouter()
+        self.flush_scheduled = False
+
+    def start(self):
+        for shard in self.shards:
+            shard.start(self.handle_worker_message)
+
+    async def stop(self):
+        """
+        Stop all the workers first and then wait for them together in
+        threads, so the loop is blocked by none of them
+        """
+        for shard in self.shards:
+            shard.stop()
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(*(
+            loop.run_in_executor(None, shard.join, SHARD_STOP_TIMEOUT_SEC) for shard in self.shards))
+
+    def stats(self):
+        return dict((shard.index, shard.stats()) for shard in self.shards)
+
+    def rebuild_router(self):
+        self.router.rebuild(dict((d.device.identifier, d) for d in self.devices.values()))
+
+    def broadcast(self, command):
+        for shard in self.shards:
+            shard.send(command)
+
+    @subscribe(DeviceAddedEvent)
+    def handle_device_added(self, event):
+        previous = self.devices.get(event.device.id)
+        shard = self.shards[shard_for(event.device.identifier, len(self.shards))]
+        if previous and previous.shard is not shard:
+            previous.shard.send(('device_removed', event.device.id))
+
+        self.devices[event.device.id] = ShardedDevice(event.device, shard)
+        self.rebuild_router()
+        shard.send(('device_added', event.device.id))
+
+    @subscribe(DeviceRemovedEvent)
+    def handle_device_removed(self, event):
+        if event.device.id in self.devices:
+            self.devices.pop(event.device.id).shard.send(('device_removed', event.device.id))
+            self.rebuild_router()
+
+    @subscribe(RoomAddedEvent)
+    def handle_room_added(self, event):
+        self.rooms[event.room.id] = event.room
+
+    @subscribe(RoomRemovedEvent)
+    def handle_room_removed(self, event):
+        self.rooms.pop(event.room.id, None)
+
+    @subscribe(TopologyChangedEvent)
+    def handle_topology_changed(self, event):
+        self.broadcast(('topology',))
+
+    @subscribe(PredictionModelChangedEvent)
+    def handle_prediction_model_changed(self, event):
+        self.broadcast(('model_changed', event.model_id))
+
+    @subscribe(MQTTConnectedEvent)
+    async def handle_mqtt_connect(self, event):
+        await event.client.subscribe('{}#'.format(SCANNERS_TOPIC))
+
+    @subscribe(MQTTMessageEvent)
+    def handle_mqtt_message(self, event):
+        self.process_message(event.topic, event.payload, event.received)
+
+    @subscribe(MQTTMessageBatchEvent)
+    def handle_mqtt_message_batch(self, event):
+        for topic, payload in event.messages:
+            self.process_message(topic, payload, event.received)
+
+    def process_message(self, topic, payload, received=None):
+        scanner, sharded_device = self.router.route(topic, payload)
+        if not sharded_device:
+            return
+
+        eventbus.post(DeviceSignalEvent(
+            device=sharded_device.device, signal=normalize_scanner_payload(payload), scanner_uuid=scanner))
+        shard = sharded_device.shard
+        shard.pending_messages.append((topic, payload))
+        if shard.pending_received is None:
+            shard.pending_received = received
+
+        # Forward everything received within one loop iteration at once
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        for shard in self.shards:
+            shard.flush()
+
+    def handle_worker_message(self, message):
+        kind, *args = message
+        if kind == 'occupancy':
+            self.handle_occupancy(*args)
+
+    def handle_occupancy(self, device_id, room_occupancy, signals, trace=None):
+        sharded_device = self.devices.get(device_id)
+        if not sharded_device:
+            return
+
+        # The stages up to the prediction were measured in the worker
+        if trace is not None:
+            trace = metrics.Trace(*trace)
+            trace.observe()
+
+        eventbus.post(OccupancyEvent(
+            device=sharded_device.device,
+            room_occupancy=[{
+                'room': self.rooms[room_id],
+                'state': state,
+                'proba': proba,
+            } for room_id, state, proba in room_occupancy if room_id in self.rooms],
+            signals=signals,
+            trace=trace,
+        ))
+
+
+class ShardWorker(EventBusSubscriber):
+    """
+    The tracking engine of a single worker process
+    """
+    def __init__(self, connection):
+        super().__init__()
+        self.connection = connection
+        self.commands = asyncio.Queue()
+        self.devices = {}
+        self.heartbeat = Heartbeat()
+        self.predict = Predict()
+
+    def receive(self):
+        try:
+            while self.connection.poll():
+                self.commands.put_nowait(self.connection.recv())
+        except (EOFError, OSError):
+            self.commands.put_nowait(('stop',))
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        loop.add_reader(self.connection.fileno(), self.receive)
+
+        while True:
+            kind, *args = await self.commands.get()
+            if kind == 'stop':
+                break
+
+            try:
+                await self.handle_command(kind, *args)
+            except Exception as e:
+                logging.error(e)
+
+        loop.remove_reader(self.connection.fileno())
+
+    async def handle_command(self, kind, *args):
+        if kind == 'messages':
+            eventbus.post(MQTTMessageBatchEvent(messages=args[0], received=args[1]))
+        elif kind == 'device_added':
+            device = await Device.get_or_none(id=args[0])
+            if device:
+                self.devices[device.id] = device
+                eventbus.post(DeviceAddedEvent(device=device))
+        elif kind == 'device_removed':
+            device = self.devices.pop(args[0], None)
+            if device:
+                eventbus.post(DeviceRemovedEvent(device=device))
+        elif kind == 'topology':
+            get_rooms_scanners.cache_clear()
+            eventbus.post(TopologyChangedEvent())
+        elif kind == 'model_changed':
+            eventbus.post(PredictionModelChangedEvent(model_id=args[0]))
+
+    @subscribe(OccupancyEvent)
+    def handle_device_occupancy(self, event):
+        self.connection.send(('occupancy', event.device.id, [
+            (o['room'].id, o['state'], o['proba']) for o in event.room_occupancy
+        ], event.signals, event.trace))
+
+
+async def worker_main(connection):
+    await init_db(generate_schemas=False)
+    worker = ShardWorker(connection)
+    await worker.run()
+
+
+def run_worker(connection):
+    asyncio.run(worker_main(connection))
@@ -1,4 +1,9 @@
 import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from server import config
+from server.constants import EXECUTOR_MAX_YIELD_SEC
 from server.models import get_rooms_scanners
 from sklearn import preprocessing
 import functools
@@ -42,10 +47,133 @@ async def calculate_inputs_hash(rooms=None, scanners=None):
     return id_str
 
 
-def run_in_executor(f):
-    @functools.wraps(f)
-    def inner(*args, **kwargs):
-        loop = asyncio.get_running_loop()
-        return loop.run_in_executor(None, lambda: f(*args, **kwargs))
+class Executor:
+    """
+    Named thread pool measuring how long the functions wait for a worker.
+    Functions are dispatched to the pool only when the executors it yields
+    to have nothing to run, so e.g. predictions don't wait for training,
+    or after `max_yield` seconds so that training is not starved by a
+    steady flow of predictions
+    """
+    def __init__(self, name, max_workers, yield_to=(), max_yield=EXECUTOR_MAX_YIELD_SEC):
+        self.name = name
+        self.max_workers = max_workers
+        self.yield_to = yield_to
+        self.max_yield = max_yield
+        self.pool = ThreadPoolExecutor(max_workers, thread_name_prefix=name)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.yield_timeouts = 0
+        self.idle = None
+
+    async def run(self, f, *args, **kwargs):
+        submitted = time.perf_counter()
+        started = []
+        self.active += 1
+        self.queued += 1
+        try:
+            deadline = time.perf_counter() + self.max_yield
+            for name in self.yield_to:
+                if not await get_executor(name).wait_idle(deadline - time.perf_counter()):
+                    self.yield_timeouts += 1
+                    break
+            return await asyncio.get_running_loop().run_in_executor(
+                self.pool, functools.partial(self.call, submitted, started, f, *args, **kwargs))
+        finally:
+            with self.lock:
+                # Cancelled before a worker took it
+                if not started:
+                    self.queued -= 1
+            self.active -= 1
+            if not self.active and self.idle is not None:
+                self.idle.set()
+                self.idle = None
+
+    def call(self, submitted, started, f, *args, **kwargs):
+        wait_time = time.perf_counter() - submitted
+        with self.lock:
+            started.append(True)
+            self.queued -= 1
+            self.running += 1
+            self.wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+        try:
+            return f(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.running -= 1
+                self.completed += 1
+
+    async def wait_idle(self, timeout=None):
+        """
+        Wait until nothing runs or is queued, at most `timeout` seconds.
+        Returns whether the executor is idle
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while self.active:
+            if self.idle is None:
+                self.idle = asyncio.Event()
+            remaining = None if deadline is None else deadline - time.perf_counter()
+            if remaining is not None and remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(self.idle.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+
+    def stats(self):
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                'workers': self.max_workers,
+                'queue_depth': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'avg_wait_time': self.wait_time / started if started else 0.0,
+                'max_wait_time': self.max_wait_time,
+                'yield_timeouts': self.yield_timeouts,
+            }
+
+
+EXECUTORS = {
+    'inference': lambda: Executor('inference', config.INFERENCE_THREADS),
+    'training': lambda: Executor('training', config.TRAINING_THREADS, yield_to=('inference',)),
+}
+executors = {}
+
+
+def get_executor(name):
+    if name not in executors:
+        executors[name] = EXECUTORS[name]()
+    return executors[name]
+
+
+def executors_stats():
+    return dict((name, executor.stats()) for name, executor in executors.items())
+
+
+def run_in_executor(executor=None):
+    """
+    Run the decorated function in the named executor, or in the default
+    executor of the loop when used without a name
+    """
+    if callable(executor):
+        return run_in_executor()(executor)
+
+    def decorator(f):
+        @functools.wraps(f)
+        def inner(*args, **kwargs):
+            if executor is not None:
+                return asyncio.ensure_future(get_executor(executor).run(f, *args, **kwargs))
+            loop = asyncio.get_running_loop()
+            return loop.run_in_executor(None, lambda: f(*args, **kwargs))
+
+        return inner
 
-    return inner
+    return decorator
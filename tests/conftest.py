@@ -0,0 +1,5 @@
+import os
+
+# server.config requires these settings, the tests never connect anywhere
+for name in ('SECRET_KEY', 'MQTT_BROKER_URL', 'MQTT_USERNAME', 'MQTT_PASSWORD'):
+    os.environ.setdefault(name, 'test')
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from server.compiled import compile_estimator, ovo_scores
+from server.learn import threaded_train_model
+
+
+def train(n_rooms, n_scanners, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-95, -50, (n_rooms, n_scanners))
+    y = rng.integers(0, n_rooms, 600)
+    X = pd.DataFrame(np.round(centers[y] + rng.normal(0, 6, (len(y), n_scanners)), 1))
+    np.random.seed(seed)
+    _, estimator, error = threaded_train_model.__wrapped__(X, y + 1)
+    assert error is None
+
+    X_test = np.round(centers[rng.integers(0, n_rooms, 200)] + rng.normal(0, 10, (200, n_scanners)), 1)
+    return estimator, X_test
+
+
+@pytest.mark.parametrize('n_rooms', [2, 4])
+def test_compiled_estimator_matches_presence_estimator(n_rooms):
+    estimator, X = train(n_rooms, n_scanners=6)
+    compiled = compile_estimator(estimator)
+
+    assert np.allclose(compiled.scores(X), estimator.scores(X), rtol=0, atol=1e-12)
+    assert compiled.predict_proba_batch(X) == pytest.approx(estimator.predict_proba_batch(X))
+    assert compiled.predict_proba(X[:1]) == estimator.predict_proba(X[:1])
+
+    # Scores are normalized, without changing the predicted rooms
+    scores = estimator.scores(X)
+    assert scores.min() >= 0 and scores.max() <= 1
+    assert (estimator.estimator.classes_[scores.argmax(axis=1)] == estimator.estimator.predict(X)).all()
+
+
+def test_ovo_scores_are_the_share_of_won_pairs():
+    assert np.allclose(ovo_scores([[2.2, 0.9, -0.1]], 3), [[1.0, 0.45, 0.0]])
+    assert np.allclose(ovo_scores([0.8, -0.2], 2), [[0.2, 0.8], [1.0, 0.0]])
+
+
+def test_compile_estimator_rejects_unknown_models():
+    with pytest.raises(ValueError):
+        compile_estimator(object())
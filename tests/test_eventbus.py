@@ -0,0 +1,69 @@
+import asyncio
+from collections import namedtuple
+
+import pytest
+
+from server.eventbus import OVERFLOW_COALESCE, OVERFLOW_DROP_NEWEST, OVERFLOW_DROP_OLDEST, EventsQueue, eventbus
+
+SampleEvent = namedtuple('SampleEvent', 'key, value')
+
+
+def drain(queue):
+    async def collect():
+        queue.close()
+        items = []
+        while True:
+            item = await queue.get()
+            if item is None:
+                return items
+            items.append(item)
+
+    return asyncio.run(collect())
+
+
+def test_drop_oldest():
+    queue = EventsQueue(maxsize=2, overflow=OVERFLOW_DROP_OLDEST)
+    for i in range(5):
+        queue.put_nowait(i)
+
+    assert (queue.dropped, queue.high_water) == (3, 2)
+    assert drain(queue) == [3, 4]
+
+
+def test_drop_newest():
+    queue = EventsQueue(maxsize=2, overflow=OVERFLOW_DROP_NEWEST)
+    for i in range(5):
+        queue.put_nowait(i)
+
+    assert (queue.dropped, queue.high_water) == (3, 2)
+    assert drain(queue) == [0, 1]
+
+
+def test_coalesce_by_key():
+    queue = EventsQueue(maxsize=2, overflow=OVERFLOW_COALESCE, key=lambda e: e.key)
+    for event in [SampleEvent('a', 1), SampleEvent('b', 1), SampleEvent('a', 2), SampleEvent('c', 1)]:
+        queue.put_nowait(event)
+
+    assert (queue.dropped, queue.coalesced, queue.high_water) == (1, 1, 2)
+    assert drain(queue) == [SampleEvent('b', 1), SampleEvent('c', 1)]
+
+
+def test_coalesce_requires_key():
+    with pytest.raises(ValueError):
+        EventsQueue(overflow=OVERFLOW_COALESCE)
+
+
+def test_subscription_stats():
+    async def run():
+        async with eventbus.subscribe(SampleEvent, maxsize=1) as subscriber:
+            eventbus.post(SampleEvent('a', 1))
+            eventbus.post(SampleEvent('a', 2))
+            stats = eventbus.subscriptions_stats()
+            assert await subscriber.__anext__() == SampleEvent('a', 2)
+        return stats
+
+    assert asyncio.run(run()) == [{
+        'event': 'SampleEvent', 'overflow': OVERFLOW_DROP_OLDEST, 'size': 1, 'maxsize': 1,
+        'dropped': 1, 'coalesced': 0, 'high_water': 1,
+    }]
+    assert eventbus.subscriptions_stats() == []
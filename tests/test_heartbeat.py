@@ -0,0 +1,323 @@
+import asyncio
+import os
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from server.constants import (
+    HEARTBEAT_COLLECT_PERIOD_SEC, KALMAN_Q, KALMAN_R, LONG_DELAY_PENALTY_SEC, TURN_OFF_DEVICE_SEC)
+from server.events import DeviceAddedEvent, DeviceRemovedEvent
+from server import clock
+from server.heartbeat import (
+    DeviceTracker, Heartbeat, HeartbeatChangeDetector, HeartbeatScheduler, HeratbeatGenerator, MessageRouter, cache_put)
+from server.kalman import KalmanRSSI
+from server.metrics import now as metrics_now, registry
+
+SIGNALS_CSV = os.path.join(os.path.dirname(__file__), '..', 'signals.csv')
+
+
+class UnfilteredRSSI():
+    def __init__(self) -> None:
+        self.x = -100
+
+    def filter(self, x):
+        self.x = x
+        return x
+
+
+class ReferenceHeartbeatGenerator:
+    """
+    The dict based generator the array version has to stay equivalent to.
+    """
+    def __init__(self, kalman=None, silent_scanner_penalty=None, long_delay=None, turn_off_delay=None):
+        self.values = {}
+        self.last_change = {}
+        self.last_signal = {}
+        self.silent_scanner_penalty = silent_scanner_penalty
+        self.turn_off_delay = turn_off_delay
+        self.long_delay = long_delay
+        self.filters = {}
+        self.kalman = kalman
+
+    def process(self, signals, time, period):
+        silent_scanners = set(self.values.keys())
+
+        for s in signals:
+            scanner = s['scanner']
+            silent_scanners -= set([scanner])
+
+            if scanner not in self.filters:
+                if self.kalman:
+                    self.filters[scanner] = KalmanRSSI(R=self.kalman[0], Q=self.kalman[1])
+                else:
+                    self.filters[scanner] = UnfilteredRSSI()
+
+            self.values[scanner] = self.filters[scanner].filter(s['rssi'])
+            self.last_change[scanner] = s['when']
+            self.last_signal[scanner] = s['when']
+
+        for scanner in self.values.keys():
+            last_change_delay = time - self.last_change[scanner]
+            last_signal_delay = time - self.last_signal[scanner]
+
+            if self.silent_scanner_penalty is not None and scanner in silent_scanners:
+                penalty_signal = max(self.values.get(scanner, -100) - self.silent_scanner_penalty, -100)
+                self.values[scanner] = self.filters[scanner].filter(penalty_signal)
+                self.last_change[scanner] = time
+
+            if self.turn_off_delay is not None and last_signal_delay >= self.turn_off_delay:
+                self.values[scanner] = -100
+                self.last_change[scanner] = time
+                self.last_signal[scanner] = time
+
+            elif self.long_delay is not None and last_change_delay >= self.long_delay:
+                self.values[scanner] = self.filters[scanner].filter(-100)
+                self.last_change[scanner] = time
+
+        return dict(self.values)
+
+
+def signal_batches(period=HEARTBEAT_COLLECT_PERIOD_SEC):
+    df = pd.read_csv(SIGNALS_CSV, parse_dates=['when'])
+    df['when'] = df['when'].values.astype('datetime64[ns]').astype('int64') / 1e9
+    df = df.sort_values('when')
+
+    signals = df[['scanner', 'rssi', 'when']].to_dict('records')
+    time = signals[0]['when'] + period
+    end = signals[-1]['when'] + TURN_OFF_DEVICE_SEC + period
+    index = 0
+
+    while time < end:
+        batch = []
+        while index < len(signals) and signals[index]['when'] <= time:
+            batch.append(signals[index])
+            index += 1
+        yield batch, time
+        time += period
+
+
+@pytest.mark.parametrize('params', [
+    dict(kalman=(KALMAN_R, KALMAN_Q), long_delay=LONG_DELAY_PENALTY_SEC, turn_off_delay=TURN_OFF_DEVICE_SEC),
+    dict(kalman=(KALMAN_R, KALMAN_Q), long_delay=20, turn_off_delay=60, silent_scanner_penalty=3),
+    dict(long_delay=20, turn_off_delay=60, silent_scanner_penalty=5),
+])
+def test_heartbeat_generator_parity(params):
+    reference = ReferenceHeartbeatGenerator(**params)
+    generator = HeratbeatGenerator(**params)
+
+    for batch, time in signal_batches():
+        expected = reference.process(batch, time, HEARTBEAT_COLLECT_PERIOD_SEC)
+        actual = generator.process(batch, time, HEARTBEAT_COLLECT_PERIOD_SEC)
+
+        assert list(actual.keys()) == list(expected.keys())
+        assert list(actual.values()) == pytest.approx(list(expected.values()))
+
+
+def test_router_resolves_topics_and_advertisers():
+    router = MessageRouter()
+    phone, tag = object(), object()
+    router.rebuild({'aabbcc': phone, 'tag': tag})
+
+    assert router.route('other/hall', {'uuid': 'AA:BB:CC'}) == (None, None)
+    assert router.route('room_presence/hall', {'uuid': 'AA:BB:CC'}) == ('hall', phone)
+    assert router.route('room_presence/desk', {'uuid': 'ff', 'name': 'tag'}) == ('desk', tag)
+
+    # Unknown advertisers are cached too
+    assert router.route('room_presence/hall', {'uuid': 'ff', 'name': 'watch'}) == ('hall', None)
+    assert router.advertisers[('ff', 'watch')] is None
+    router.trackers['watch'] = object()
+    assert router.route('room_presence/hall', {'uuid': 'ff', 'name': 'watch'}) == ('hall', None)
+
+
+def test_router_cache_is_dropped_when_devices_change():
+    async def run():
+        heartbeat = Heartbeat()
+        phone = SimpleNamespace(id=1, identifier='aabbcc')
+        payload = {'uuid': 'AA:BB:CC'}
+        try:
+            assert heartbeat.router.route('room_presence/hall', payload) == ('hall', None)
+
+            heartbeat.handle_device_added(DeviceAddedEvent(device=phone))
+            _, tracker = heartbeat.router.route('room_presence/hall', payload)
+            assert tracker is heartbeat.device_trackers['aabbcc']
+
+            heartbeat.handle_device_removed(DeviceRemovedEvent(device=phone))
+            assert heartbeat.router.route('room_presence/hall', payload) == ('hall', None)
+        finally:
+            heartbeat.scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_router_caches_are_bounded():
+    cache = {}
+    for key in 'abc':
+        cache_put(cache, key, key.upper(), 2)
+    assert cache == {'b': 'B', 'c': 'C'}
+
+    router = MessageRouter(cache_size=2)
+    for name in ('a', 'b', 'c'):
+        router.route('room_presence/{}'.format(name), {'name': name})
+    assert list(router.advertisers) == [('', 'b'), ('', 'c')]
+    assert list(router.scanners) == ['room_presence/b', 'room_presence/c']
+
+
+class TickingTracker:
+    """
+    Records the ticks it gets, optionally taking `cost` seconds of the clock each
+    """
+    def __init__(self, cost=0.0):
+        self.cost = cost
+        self.ticks = []
+
+    def create_heartbeat(self, timestamp):
+        self.ticks.append(timestamp)
+        clock.source.time += self.cost
+
+
+@pytest.fixture
+def virtual_clock():
+    source = clock.VirtualClock()
+    clock.set_clock(source)
+    yield source
+    clock.set_clock(clock.SystemClock())
+
+
+async def advance(source, until):
+    await asyncio.sleep(0)
+    while source.step(until):
+        await asyncio.sleep(0)
+
+
+def test_scheduler_binds_trackers_to_least_loaded_slots(virtual_clock):
+    async def run():
+        scheduler = HeartbeatScheduler(period=1.0, slots=4)
+        trackers = [TickingTracker() for _ in range(6)]
+        try:
+            for tracker in trackers:
+                scheduler.add(tracker)
+            assert [len(s) for s in scheduler.slots] == [2, 2, 1, 1]
+
+            scheduler.remove(trackers[0])
+            assert trackers[0] not in scheduler.tracker_slots
+            assert [len(s) for s in scheduler.slots] == [1, 2, 1, 1]
+
+            scheduler.add(trackers[0])
+            assert scheduler.tracker_slots[trackers[0]] == 0
+            assert scheduler.stats()['trackers'] == 6
+        finally:
+            scheduler.stop()
+
+    asyncio.run(run())
+
+
+def test_scheduler_ticks_every_tracker_once_per_period(virtual_clock):
+    async def run():
+        scheduler = HeartbeatScheduler(period=1.0, slots=4)
+        trackers = [TickingTracker() for _ in range(6)]
+        try:
+            for tracker in trackers:
+                scheduler.add(tracker)
+            await advance(virtual_clock, 3.0)
+            scheduler.remove(trackers[5])
+            await advance(virtual_clock, 5.0)
+        finally:
+            scheduler.stop()
+
+        for tracker in trackers[:5]:
+            assert np.diff(tracker.ticks).tolist() == [1.0] * 4
+        assert trackers[0].ticks[0] == 0.25 and trackers[3].ticks[0] == 1.0
+        assert len(trackers[5].ticks) == 3
+        assert scheduler.ticks == 20 and scheduler.max_lag == 0
+
+    asyncio.run(run())
+
+
+def test_scheduler_catches_up_when_late(virtual_clock):
+    async def run():
+        scheduler = HeartbeatScheduler(period=1.0, slots=4)
+        slow, tracker = TickingTracker(cost=0.3), TickingTracker()
+        try:
+            scheduler.add(slow)
+            scheduler.add(tracker)
+            await advance(virtual_clock, 2.0)
+        finally:
+            scheduler.stop()
+
+        # The late tick fires at once, the following ones are on time again
+        assert tracker.ticks == pytest.approx([0.55, 1.55])
+        assert scheduler.ticks == 8
+        assert scheduler.max_lag == pytest.approx(0.05)
+        assert scheduler.last_lag == 0
+
+    asyncio.run(run())
+
+
+def test_scheduler_skips_ticks_missed_for_more_than_a_period(virtual_clock):
+    async def run():
+        scheduler = HeartbeatScheduler(period=1.0, slots=4)
+        first, second = TickingTracker(), TickingTracker()
+        try:
+            scheduler.add(first)
+            scheduler.add(second)
+            await advance(virtual_clock, 0.3)
+            # The loop has been blocked for much longer than the period
+            virtual_clock.time = 5.1
+            await advance(virtual_clock, 6.0)
+        finally:
+            scheduler.stop()
+
+        # Instead of a burst of the missed ticks the wheel goes on from now
+        assert first.ticks == pytest.approx([0.25, 5.85])
+        assert second.ticks == pytest.approx([5.1])
+        assert scheduler.ticks == 5
+        assert scheduler.max_lag == pytest.approx(4.6)
+
+    asyncio.run(run())
+
+
+def test_change_detector_compares_values_with_delta_or_quantum():
+    detector = HeartbeatChangeDetector(delta=0.5, quantum=None, max_silence=None)
+    assert detector.is_significant({'hall': -60.0, 'office': -80.0}, 0)
+    assert not detector.is_significant({'hall': -60.4, 'office': -79.6}, 1)
+    assert detector.is_significant({'hall': -60.6, 'office': -80.0}, 2)
+    # Small steps do not add up, they are compared with the last significant heartbeat
+    assert not detector.is_significant({'hall': -61.0, 'office': -80.0}, 3)
+    assert detector.is_significant({'hall': -61.2, 'office': -80.0}, 4)
+
+    detector = HeartbeatChangeDetector(delta=0.5, quantum=2.0, max_silence=None)
+    assert detector.is_significant({'hall': -60.2}, 0)
+    assert not detector.is_significant({'hall': -60.9}, 1)
+    assert detector.is_significant({'hall': -61.1}, 2)
+    assert (detector.significant, detector.skipped) == (2, 1)
+
+
+def test_change_detector_reports_scanner_presence_and_silence_changes():
+    detector = HeartbeatChangeDetector(delta=5, quantum=None, max_silence=30)
+    assert detector.is_significant({'hall': -60.0}, 0)
+    assert detector.is_significant({'hall': -60.0, 'office': -100.0}, 1)
+    assert not detector.is_significant({'hall': -61.0, 'office': -100.0}, 2)
+
+    # The device is out when no scanner hears it and back when any does
+    assert detector.is_significant({'hall': -100.0, 'office': -100.0}, 3)
+    assert not detector.is_significant({'hall': -99.5, 'office': -100.0}, 4)
+    assert detector.is_significant({'hall': -98.0, 'office': -100.0}, 5)
+
+    # Nothing significant for max_silence seconds refreshes the prediction
+    assert not detector.is_significant({'hall': -98.0, 'office': -100.0}, 34)
+    assert detector.is_significant({'hall': -98.0, 'office': -100.0}, 35)
+    assert not detector.is_significant({'hall': -98.0, 'office': -100.0}, 36)
+
+
+def test_tracker_traces_only_the_oldest_signal_of_a_heartbeat():
+    histogram = registry.histograms['signal_dispatch']
+    count = histogram.count
+    tracker = DeviceTracker(SimpleNamespace(id=1, identifier='aa:bb', name='phone'), HeartbeatScheduler())
+    for index in range(5):
+        tracker.process_signal('scanner', {'rssi': -60, 'when': 100.0 + index}, received=metrics_now() - 0.01)
+
+    assert histogram.count == count + 1
+    assert len(tracker.collected_signals) == 5
+    assert tracker.trace.processed is not None
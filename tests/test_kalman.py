@@ -0,0 +1,39 @@
+import numpy as np
+import pytest
+
+from server.constants import KALMAN_Q, KALMAN_R
+from server.kalman import KalmanBank, KalmanRSSI
+
+
+def test_kalman_bank_matches_scalar_filters():
+    rng = np.random.default_rng(42)
+    size = 16
+    bank = KalmanBank(size, R=KALMAN_R, Q=KALMAN_Q)
+    filters = [KalmanRSSI(R=KALMAN_R, Q=KALMAN_Q) for _ in range(size)]
+
+    for _ in range(500):
+        index = rng.choice(size, size=rng.integers(1, size + 1), replace=False)
+        z = rng.integers(-100, -40, size=len(index))
+        result = bank.filter(index, z)
+
+        expected = [filters[i].filter(v) for i, v in zip(index, z)]
+        assert result == pytest.approx(expected)
+
+    assert bank.x == pytest.approx([f.lastMeasurement() for f in filters])
+    assert bank.cov == pytest.approx([f.cov for f in filters])
+
+
+def test_kalman_bank_measurements_and_state():
+    bank = KalmanBank(3, R=KALMAN_R, Q=KALMAN_Q)
+    bank.filter([1], [-70])
+    assert bank.measurements(-100).tolist() == [-100, -70, -100]
+
+    bank.resize(4)
+    bank.set_state([0, 1], -100)
+    assert bank.measurements(-100).tolist() == [-100, -100, -100, -100]
+    assert bank.initialized.tolist() == [True, True, False, False]
+
+    reference = KalmanRSSI(R=KALMAN_R, Q=KALMAN_Q)
+    reference.filter(-70)
+    reference.x = -100
+    assert bank.filter([1], [-60])[0] == pytest.approx(reference.filter(-60))
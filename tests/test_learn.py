@@ -0,0 +1,174 @@
+import asyncio
+from datetime import datetime
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from tortoise import Tortoise
+
+from server.config import MEMORY_TORTOISE_ORM
+from server.constants import KALMAN_Q, KALMAN_R, LONG_DELAY_PENALTY_SEC, TURN_OFF_DEVICE_SEC
+from server.events import DeviceSignalEvent, StartRecordingSignalsEvent, StopRecordingSignalsEvent
+from server.kalman import KalmanBank
+from server.learn import (
+    Learn, SignalWriter, generate_training_data, load_training_signals, session_frequencies, training_frame)
+from server.models import Device, DeviceSignal, LearningSession, Room, Scanner
+
+
+def test_recorded_signals_are_written_in_batches():
+    async def run():
+        await Tortoise.init(MEMORY_TORTOISE_ORM)
+        await Tortoise.generate_schemas()
+        try:
+            device = await Device.create(name='phone', uuid='phone')
+            room = await Room.create(name='kitchen')
+            await Scanner.create(name='hall', uuid='hall')
+            learn = Learn(SignalWriter(max_size=3, interval=60))
+            await learn.handle_start_recording(StartRecordingSignalsEvent(room=room, device=device))
+
+            with mock.patch.object(Scanner, 'filter', wraps=Scanner.filter) as scanner_filter:
+                for i in range(5):
+                    await learn.handle_device_signal(DeviceSignalEvent(
+                        device=device, scanner_uuid='hall', signal={'rssi': -60 - i, 'when': 1700000000 + i}))
+                await learn.handle_device_signal(DeviceSignalEvent(
+                    device=device, scanner_uuid='unknown', signal={'rssi': -60, 'when': 1700000000}))
+                assert scanner_filter.call_count == 2
+
+            assert len(learn.writer.tasks) == 1
+            await asyncio.sleep(0.01)
+            assert await DeviceSignal.all().count() == 3
+            assert learn.writer.stats()['buffered'] == 2
+            assert not learn.writer.tasks
+
+            await learn.handle_stop_recording(StopRecordingSignalsEvent())
+            signals = await DeviceSignal.all().order_by('rssi').values_list('rssi', 'created_at')
+            assert [rssi for rssi, _ in signals] == [-64, -63, -62, -61, -60]
+            assert signals[0][1].timestamp() == 1700000004
+            assert learn.writer.stats()['rows'] == 5
+            assert learn.writer.stats()['batches'] == 2
+
+            # A flush waits for the writes which are still running
+            for _ in range(6):
+                learn.writer.add(DeviceSignal(device=device, room=room, scanner_id=1, rssi=-70, learning_session=None))
+            assert len(learn.writer.tasks) == 2
+            assert await learn.writer.flush() == [] and not learn.writer.tasks
+            assert learn.writer.stats()['rows'] == 11
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def test_training_signals_are_loaded_in_chunks():
+    async def run():
+        await Tortoise.init(MEMORY_TORTOISE_ORM)
+        await Tortoise.generate_schemas()
+        try:
+            device, other = await Device.create(name='phone', uuid='phone'), await Device.create(name='tag', uuid='tag')
+            room = await Room.create(name='kitchen')
+            scanners = [await Scanner.create(name=name, uuid=name) for name in ('hall', 'desk')]
+            session = await LearningSession.create(room=room, device=device)
+            await DeviceSignal.bulk_create([DeviceSignal(
+                device=device if i % 3 else other,
+                room=room,
+                scanner=scanners[i % 2],
+                learning_session=session if i < 20 else None,
+                rssi=-50 - i,
+                created_at=datetime(2021, 11, 8, 12, 0, i),
+            ) for i in range(30)])
+
+            df = await load_training_signals(device.id, chunk_size=4)
+            expected = [i for i in range(30) if i % 3]
+            assert df['rssi'].tolist() == [-50 - i for i in expected]
+            assert df['scanner'].tolist() == [scanners[i % 2].id for i in expected]
+            assert df['room'].unique().tolist() == [room.id]
+            assert df['position'].tolist() == [session.id if i < 20 else -1 for i in expected]
+            assert df['when'].dt.second.tolist() == expected
+            assert len(await load_training_signals(-1)) == 0
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def recorded_signals(seed=0):
+    """
+    Sessions of 40 signals per second in 3 rooms, 2 positions each
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.array([[-60, -80, -90, -95], [-85, -62, -75, -90], [-95, -85, -70, -65]])
+    frames = []
+    for room in range(3):
+        for position in range(2):
+            scanners = rng.integers(0, 4, 40)
+            frames.append(pd.DataFrame({
+                'rssi': np.round(centers[room, scanners] + rng.normal(0, 4, 40)),
+                'scanner': scanners + 10,
+                'room': room + 1,
+                'when': pd.Timestamp('2021-11-08') + pd.to_timedelta(np.arange(40), unit='s'),
+                'position': room * 2 + position,
+            }))
+    return pd.concat(frames, ignore_index=True)
+
+
+def generate_training_data_loop(used_data_df):
+    """
+    The row by row dataset generator `generate_training_data` has replaced
+    """
+    sorted_rooms = sorted(used_data_df['room'].unique())
+    sorted_scanners = sorted(used_data_df['scanner'].unique())
+    session_dur_df = session_frequencies(used_data_df)
+    scanner_slots = dict((s, i) for i, s in enumerate(sorted_scanners))
+    filters = KalmanBank(len(sorted_scanners), R=KALMAN_R, Q=KALMAN_Q)
+    off_signals_history = np.zeros(len(sorted_scanners))
+    delay_signals_history = np.zeros(len(sorted_scanners))
+    result_data = []
+
+    for _ in range(10):
+        for room in np.random.choice(sorted_rooms, len(sorted_rooms), replace=False):
+            room_init = False
+            seconds_passed = 0
+            positions = used_data_df[used_data_df['room'] == room]['position'].unique()
+            for _ in range(3):
+                for position in np.random.choice(positions, len(positions), replace=False):
+                    signals_per_sec = session_dur_df.loc[(room, position), 'frequency']
+                    signals = used_data_df[(used_data_df['room'] == room) & (used_data_df['position'] == position)]
+                    signals = signals.sample(n=min(len(signals), 300), replace=True)
+
+                    for _, row in signals.iterrows():
+                        seconds_passed += 1 / signals_per_sec
+                        slot = scanner_slots[row['scanner']]
+                        off_signals_history[slot] = 0
+                        delay_signals_history[slot] = 0
+                        filters.filter([slot], [row['rssi']])
+                        data_row = np.round(filters.measurements(-100), decimals=1).tolist()
+
+                        off_signals_history += 1
+                        delay_signals_history += 1
+                        turned_off = off_signals_history > (TURN_OFF_DEVICE_SEC / signals_per_sec)
+                        off_signals_history[turned_off] = 0
+                        filters.set_state(np.flatnonzero(turned_off), -100)
+                        delayed = ~turned_off & (delay_signals_history > (LONG_DELAY_PENALTY_SEC / signals_per_sec))
+                        delay_signals_history[delayed] = 0
+                        filters.filter(np.flatnonzero(delayed), np.full(delayed.sum(), -100.0))
+
+                        if room_init:
+                            result_data.append(data_row + [room])
+                        elif seconds_passed > 60:
+                            room_init = True
+
+    return training_frame(pd.DataFrame(columns=sorted_scanners + ['room'], data=result_data))
+
+
+def test_generated_training_data_matches_the_loop():
+    df = recorded_signals()
+    X, y = generate_training_data(df, seed=1)
+    X_again, y_again = generate_training_data(df, seed=1)
+    assert X.equals(X_again) and (y == y_again).all()
+    assert list(X.columns) == [10, 11, 12, 13]
+
+    np.random.seed(1)
+    X_loop, y_loop = generate_training_data_loop(df)
+    assert abs(len(X) - len(X_loop)) < 0.05 * len(X_loop)
+    assert np.abs(X.groupby(y).mean().values - X_loop.groupby(y_loop).mean().values).max() < 2
+    assert np.abs(X.groupby(y).std().values - X_loop.groupby(y_loop).std().values).max() < 2
@@ -0,0 +1,46 @@
+from server.metrics import Histogram, MetricsRegistry, Trace, flatten, registry
+
+
+def test_histogram_quantiles():
+    histogram = Histogram('test', 'Test', buckets=(0.1, 0.2, 0.5))
+    for value in (0.05, 0.15, 0.15, 0.3, 1.0):
+        histogram.observe(value)
+
+    assert histogram.cumulative_counts() == [1, 3, 4, 5]
+    assert histogram.quantile(0.5) == 0.1 + 0.1 * (2.5 - 1) / 2
+    assert histogram.quantile(0.99) == 0.5
+    assert histogram.as_dict()['buckets'][-1] == {'le': None, 'count': 5}
+
+
+def test_collectors_are_flattened():
+    assert list(flatten({'loads': 2, 'models': {7: {'hits': 3}}, 'name': 'x'}, ('registry',), ())) == [
+        ('registry_loads', (('name', 'x'),), 2.0),
+        ('registry_models_hits', (('name', 'x'), ('key', '7')), 3.0),
+    ]
+
+    metrics = MetricsRegistry()
+    metrics.histogram('stage', 'A stage').observe(0.002)
+    metrics.register_collector(
+        'predict', lambda: {'batches': 4, 'caches': {3: {'size': 1, 'hits': 2}, 4: {'size': 2, 'hits': 0}}},
+        'Predictions', counters=('batches', 'hits'))
+    text = metrics.prometheus_text()
+    assert 'mqtt_room_presence_stage_seconds_bucket{le="0.0025"} 1' in text
+    assert 'mqtt_room_presence_stage_seconds_count 1' in text
+    assert '# HELP mqtt_room_presence_predict_batches Predictions\n' in text
+    assert '# TYPE mqtt_room_presence_predict_batches counter\nmqtt_room_presence_predict_batches 4.0\n' in text
+    assert (
+        '# TYPE mqtt_room_presence_predict_caches_size gauge\n'
+        'mqtt_room_presence_predict_caches_size{key="3"} 1.0\n'
+        'mqtt_room_presence_predict_caches_size{key="4"} 2.0\n'
+    ) in text
+    assert '# TYPE mqtt_room_presence_predict_caches_hits counter\n' in text
+
+
+def test_trace_observes_stages():
+    counts = dict((name, h.count) for name, h in registry.histograms.items())
+    trace = Trace(received=10.0).mark('processed', 10.001).mark('heartbeat', 10.5)
+    trace.mark('predicted', 10.502).mark('promoted', 10.503).mark('published', 10.504)
+
+    for name in ('signal_dispatch', 'heartbeat_emission', 'prediction', 'device_state', 'room_publish', 'end_to_end'):
+        assert registry.histograms[name].count == counts[name] + 1
+    assert registry.histograms['end_to_end'].sum >= 0.504 - 1e-9
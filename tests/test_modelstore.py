@@ -0,0 +1,73 @@
+import asyncio
+import os
+import pickle
+import time
+
+import numpy as np
+from tortoise import Tortoise
+
+from server.compiled import compile_estimator
+from server.config import MEMORY_TORTOISE_ORM
+from server.models import PredictionModel
+from server.modelstore import ModelStore, collect_garbage, migrate
+from server.registry import ModelRegistry
+from tests.test_compiled import train
+
+
+def test_model_file_round_trip(tmp_path):
+    estimator, X = train(n_rooms=3, n_scanners=5)
+    compiled = compile_estimator(estimator)
+    store = ModelStore(str(tmp_path))
+
+    name = store.save(compiled)
+    assert store.save(compile_estimator(estimator)) == name
+    assert len(list(tmp_path.iterdir())) == 1
+
+    loaded = store.load(name)
+    assert loaded.classes_.tolist() == compiled.classes_.tolist()
+    assert np.array_equal(loaded.scores(X), estimator.scores(X))
+
+
+def test_migrate_pickled_models(tmp_path):
+    estimator, X = train(n_rooms=3, n_scanners=5)
+    store = ModelStore(str(tmp_path))
+
+    async def run():
+        await Tortoise.init(MEMORY_TORTOISE_ORM)
+        await Tortoise.generate_schemas()
+        try:
+            record = await PredictionModel.create(inputs_hash='1|2', model=pickle.dumps(estimator))
+            assert await migrate(store) == 1
+
+            await record.refresh_from_db()
+            assert record.model is None
+            assert (tmp_path / record.model_file).exists()
+
+            model = await ModelRegistry(store=store).get(record.id)
+            assert np.array_equal(model.estimator.scores(X), estimator.scores(X))
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def test_collect_garbage_keeps_referenced_and_recent_files(tmp_path):
+    store = ModelStore(str(tmp_path))
+    week_ago = time.time() - 7 * 24 * 3600
+    for name in ('used.mrpm', 'unused.mrpm', 'new.mrpm', 'crashed.tmp', 'notes.txt'):
+        (tmp_path / name).write_bytes(b'')
+        if name != 'new.mrpm':
+            os.utime(str(tmp_path / name), (week_ago, week_ago))
+
+    async def run():
+        await Tortoise.init(MEMORY_TORTOISE_ORM)
+        await Tortoise.generate_schemas()
+        try:
+            await PredictionModel.create(inputs_hash='1|2', model_file='used.mrpm')
+            await PredictionModel.create(inputs_hash='1|2', model=b'pickled')
+            return await collect_garbage(store)
+        finally:
+            await Tortoise.close_connections()
+
+    assert asyncio.run(run()) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['new.mrpm', 'notes.txt', 'used.mrpm']
@@ -0,0 +1,70 @@
+import asyncio
+from types import SimpleNamespace
+
+from server.mqtt import IngestStats, collect_batch, decode_batch, enqueue_messages
+
+
+def test_collect_batch_is_bounded_by_size_and_delay():
+    async def run():
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+        for i in range(5):
+            queue.put_nowait(i)
+
+        started = loop.time()
+        assert await collect_batch(queue, max_size=3, max_delay=10) == [0, 1, 2]
+        assert loop.time() - started < 1
+
+        loop.call_later(0.01, queue.put_nowait, 5)
+        loop.call_later(0.2, queue.put_nowait, 6)
+        started = loop.time()
+        assert await collect_batch(queue, max_size=10, max_delay=0.05) == [3, 4, 5]
+        assert 0.04 <= loop.time() - started < 0.2
+        assert await collect_batch(queue, max_size=10, max_delay=0.01) == [6]
+
+    asyncio.run(run())
+
+
+def test_enqueue_drops_messages_over_the_queue_size():
+    async def messages():
+        for i in range(5):
+            yield i
+
+    async def run():
+        stats = IngestStats()
+        queue = asyncio.Queue(3)
+        await enqueue_messages(messages(), queue, stats)
+        assert [message for _, message in await collect_batch(queue, max_delay=0)] == [0, 1, 2]
+        assert stats.dropped == 2
+
+    asyncio.run(run())
+
+
+def test_decode_batch_skips_malformed_payloads():
+    batch = [
+        SimpleNamespace(topic='room_presence/hall', payload=b'{"id": "phone", "rssi": -60}'),
+        SimpleNamespace(topic='room_presence/hall', payload=b'{"id": '),
+        SimpleNamespace(topic='room_presence/desk', payload=b'[1, 2]'),
+        SimpleNamespace(topic='room_presence/desk', payload=b'"phone"'),
+        SimpleNamespace(topic='room_presence/desk', payload=b'{"id": "tag"}'),
+    ]
+    assert decode_batch(batch) == [
+        ('room_presence/hall', {'id': 'phone', 'rssi': -60}),
+        ('room_presence/desk', {'id': 'tag'}),
+    ]
+
+
+def test_ingest_stats():
+    stats = IngestStats(window=1)
+    stats.record_batch(4)
+    assert stats.messages_per_sec == 0
+    stats.window_started -= 2
+    stats.record_batch(2, malformed=1)
+    result = stats.as_dict()
+    assert result['messages'] == 6
+    assert result['batches'] == 2
+    assert result['malformed'] == 1 and result['dropped'] == 0
+    assert result['last_batch_size'] == 2
+    assert result['max_batch_size'] == 4
+    assert result['avg_batch_size'] == 3
+    assert 2 < result['messages_per_sec'] <= 3
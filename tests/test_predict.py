@@ -0,0 +1,106 @@
+import asyncio
+from types import SimpleNamespace
+
+import numpy as np
+
+from server.eventbus import EventBusSubscriber, eventbus, subscribe
+from server.events import HeartbeatEvent, OccupancyEvent, PredictionModelChangedEvent, TopologyChangedEvent
+from server.metrics import Trace
+from server.predict import ModelBinding, Predict, PredictionCache
+
+
+class MissingModels:
+    def __init__(self):
+        self.requested = []
+
+    async def get(self, model_id):
+        self.requested.append(model_id)
+        return None
+
+
+class OccupancyRecorder(EventBusSubscriber):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    @subscribe(OccupancyEvent)
+    def handle_occupancy(self, event):
+        self.events.append(event)
+
+
+def test_model_binding_fills_rows_in_column_order():
+    rooms = [SimpleNamespace(id=1), SimpleNamespace(id=2)]
+    scanners = [SimpleNamespace(uuid='kitchen'), SimpleNamespace(uuid='hall'), SimpleNamespace(uuid='office')]
+    binding = ModelBinding('1.2|3.4.5', '1.2|3.4.5', rooms, scanners)
+
+    assert binding.valid
+    assert binding.rooms_map == {1: rooms[0], 2: rooms[1]}
+    assert binding.create_row({'office': -60, 'kitchen': -75.5, 'garage': -40}).tolist() == [-75.5, -100, -60]
+    assert binding.create_row({}).tolist() == [-100, -100, -100]
+
+
+def test_model_binding_is_invalid_for_other_inputs():
+    binding = ModelBinding('1|3.4', '1.2|3.4', [], [])
+    assert not binding.valid
+
+
+def test_prediction_cache_quantizes_rows_and_evicts_least_recent():
+    cache = PredictionCache(max_size=2, resolution=2.0)
+    first = cache.key(np.array([-70.4, -100]))
+    assert cache.key(np.array([-69.2, -99.5])) == first
+    assert cache.key(np.array([-72.6, -100])) != first
+
+    cache.put(first, {1: 0.9})
+    cache.put(cache.key(np.array([-50, -60])), {2: 0.8})
+    assert cache.get(first) == {1: 0.9}
+    cache.put(cache.key(np.array([-80, -60])), {2: 0.7})
+
+    assert cache.get(cache.key(np.array([-50, -60]))) is None
+    assert cache.get(first) == {1: 0.9}
+    assert cache.stats() == {'size': 2, 'hits': 2, 'misses': 1, 'hit_ratio': 2 / 3}
+
+
+def test_insignificant_heartbeat_repeats_the_last_occupancy():
+    async def run():
+        registry = MissingModels()
+        predict = Predict(registry=registry)
+        recorder = OccupancyRecorder()
+        phone, watch = SimpleNamespace(id=1), SimpleNamespace(id=2)
+        predict.prediction_models.update({1: 10, 2: 20})
+        last = OccupancyEvent(device=phone, room_occupancy=[{'room': 'hall', 'state': True, 'proba': 0.9}], signals={})
+        predict.last_occupancy[1] = last
+        try:
+            heartbeat = HeartbeatEvent(device=phone, signals={'hall': -60}, timestamp=1.0, significant=False)
+            await predict.handle_device_heartbeat(heartbeat._replace(trace=Trace(received=1.0)))
+            [event] = recorder.events
+            assert event.room_occupancy is last.room_occupancy
+            assert event.trace.predicted is not None
+            assert predict.skipped_predictions == 1 and registry.requested == []
+
+            # A significant heartbeat or one without a last result is predicted
+            await predict.handle_device_heartbeat(heartbeat._replace(significant=True))
+            await predict.handle_device_heartbeat(heartbeat._replace(device=watch))
+            assert registry.requested == [10, 20]
+
+            # A device without signals is out, its last result is forgotten
+            await predict.handle_device_heartbeat(heartbeat._replace(signals={}))
+            assert recorder.events[-1].room_occupancy == [] and 1 not in predict.last_occupancy
+        finally:
+            eventbus.remove_instance_subscribers(recorder, recorder._subscribers)
+            eventbus.remove_instance_subscribers(predict, predict._subscribers)
+
+    asyncio.run(run())
+
+
+def test_last_occupancy_is_forgotten_when_models_or_topology_change():
+    predict = Predict(registry=MissingModels())
+    predict.prediction_models.update({1: 10, 2: 20, 3: 10})
+    predict.last_occupancy.update({1: 'phone', 2: 'watch', 3: 'tablet'})
+    try:
+        predict.handle_prediction_model_changed(PredictionModelChangedEvent(model_id=10))
+        assert predict.last_occupancy == {2: 'watch'}
+
+        predict.handle_topology_changed(TopologyChangedEvent())
+        assert predict.last_occupancy == {}
+    finally:
+        eventbus.remove_instance_subscribers(predict, predict._subscribers)
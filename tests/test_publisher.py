@@ -0,0 +1,105 @@
+import asyncio
+
+from server.events import MQTTConnectedEvent, MQTTDisconnectedEvent
+from server.publisher import MQTTPublisher
+
+
+class SlowClient:
+    def __init__(self, delay=0.01, fail=0, failing_topic=None):
+        self.delay = delay
+        self.fail = fail
+        self.failing_topic = failing_topic
+        self.published = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def publish(self, topic, payload=None, qos=0, retain=False):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.fail and self.failing_topic in (None, topic):
+                self.fail -= 1
+                raise ConnectionError('broker is gone')
+            self.published.append((topic, payload, qos, retain))
+        finally:
+            self.in_flight -= 1
+
+
+def test_publisher_coalesces_topics_and_limits_concurrency():
+    async def run():
+        client = SlowClient()
+        publisher = MQTTPublisher(qos=1, retain=True, concurrency=2, rate=0, retry_delay=0.01)
+        publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+
+        for i in range(5):
+            publisher.publish('room/{}'.format(i), 'ON')
+        for payload in ('OFF', 'ON', 'OFF'):
+            publisher.publish('room/0', payload)
+        await publisher.join()
+
+        assert client.max_in_flight == 2
+        assert sorted(client.published) == [
+            ('room/{}'.format(i), payload, 1, True) for i, payload in enumerate(['OFF', 'ON', 'ON', 'ON', 'ON'])]
+        assert publisher.stats()['coalesced'] == 3
+
+        # Flapping back to the published payload publishes nothing
+        publisher.publish('room/1', 'OFF')
+        publisher.publish('room/1', 'ON')
+        await publisher.join()
+        assert len(client.published) == 5
+        assert publisher.stats()['unchanged'] == 1
+
+        # Everything is published again after reconnecting, failures are retried
+        publisher.handle_mqtt_disconnect(MQTTDisconnectedEvent(error=None, reconnect_interval=0))
+        client = SlowClient(fail=1)
+        publisher.publish('room/1', 'ON')
+        publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+        await publisher.join()
+        assert client.published == [('room/1', 'ON', 1, True)]
+        assert publisher.stats()['failed'] == 1
+        publisher.stop()
+
+    asyncio.run(run())
+
+
+def test_publisher_rate_limit():
+    async def run():
+        client = SlowClient(delay=0)
+        publisher = MQTTPublisher(concurrency=10, rate=100)
+        publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for i in range(120):
+            publisher.publish('room/{}'.format(i), 'ON')
+        await publisher.join()
+        publisher.stop()
+        return loop.time() - started
+
+    assert asyncio.run(run()) >= 0.15
+
+
+def test_publisher_backs_off_failing_topics():
+    async def run():
+        client = SlowClient(delay=0, fail=3, failing_topic='room/1')
+        publisher = MQTTPublisher(concurrency=2, rate=0, retry_delay=0.05, max_retry_delay=0.1)
+        publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        publisher.publish('room/1', 'ON')
+        await asyncio.sleep(0.01)
+
+        # Other topics are not held up by the one backing off
+        publisher.publish('room/2', 'ON')
+        await asyncio.sleep(0.01)
+        assert client.published == [('room/2', 'ON', 0, False)]
+        assert publisher.stats()['backing_off'] == 1
+
+        await publisher.join()
+        publisher.stop()
+        assert client.published[-1] == ('room/1', 'ON', 0, False)
+        assert publisher.stats()['failed'] == 3 and publisher.stats()['backing_off'] == 0
+        return loop.time() - started
+
+    # Retried after 0.05, 0.1 and 0.1 seconds instead of right away
+    assert asyncio.run(run()) >= 0.25
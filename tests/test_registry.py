@@ -0,0 +1,54 @@
+import asyncio
+import pickle
+
+from tortoise import Tortoise
+
+from server.config import MEMORY_TORTOISE_ORM
+from server.models import PredictionModel
+from server.registry import ModelRegistry
+
+
+async def create_models(sizes):
+    await Tortoise.init(MEMORY_TORTOISE_ORM)
+    await Tortoise.generate_schemas()
+    return [(await PredictionModel.create(inputs_hash='1|2', model=pickle.dumps(bytes(size)))).id for size in sizes]
+
+
+def test_registry_shares_and_evicts_models():
+    async def run():
+        first, second = await create_models([3000, 3000])
+        registry = ModelRegistry(memory_budget=5000)
+        try:
+            models = await asyncio.gather(registry.get(first), registry.get(first))
+            assert models[0] is models[1]
+            assert registry.loads == 1
+
+            await registry.get(second)
+            assert list(registry.models) == [second]
+            assert registry.evictions == 1
+            assert registry.stats()['models'][second]['size'] > 3000
+            assert await registry.get(-1) is None
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
+
+
+def test_registry_drops_changed_models():
+    async def run():
+        model_id, = await create_models([100])
+        registry = ModelRegistry()
+        try:
+            model = await registry.get(model_id)
+            record = await PredictionModel.get(id=model_id)
+            record.inputs_hash = '1|3'
+            await record.save()
+
+            assert model_id not in registry.models
+            reloaded = await registry.get(model_id)
+            assert reloaded is not model
+            assert reloaded.inputs_hash == '1|3'
+        finally:
+            await Tortoise.close_connections()
+
+    asyncio.run(run())
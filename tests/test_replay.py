@@ -0,0 +1,42 @@
+import asyncio
+import os
+
+import numpy as np
+import pytest
+from tortoise import Tortoise
+
+from server.eventbus import eventbus
+from server.modelstore import ModelStore
+from server.replay import load_signals, replay, setup
+
+SIGNALS = os.path.join(os.path.dirname(__file__), '..', 'signals.csv')
+
+
+@pytest.fixture
+def quiet_eventbus():
+    # Subscribers left by other tests would react to the replayed events too
+    for methods in eventbus.event_method.values():
+        for instances, _ in methods.values():
+            instances.clear()
+    eventbus.dispatch_tables.clear()
+
+
+def test_replay_gives_the_same_timeline_every_time(tmp_path, quiet_eventbus):
+    async def run():
+        np.random.seed(0)
+        datasets = {'signals': load_signals(SIGNALS, max_gap=60).iloc[:400]}
+        store = ModelStore(str(tmp_path))
+        devices, rooms = await setup(datasets, store)
+        try:
+            timelines = []
+            for _ in range(2):
+                recorder, client, _, start = await replay(datasets, devices, rooms, store, tail=30)
+                timelines.append([(round(t - start, 6), topic, payload) for t, topic, payload in client.published])
+            return timelines, recorder.counts
+        finally:
+            await Tortoise.close_connections()
+
+    (first, second), counts = asyncio.run(run())
+    assert counts['heartbeats'] > 0 and counts['occupancy'] > 0
+    assert any(payload == 'ON' for _, _, payload in first)
+    assert first == second
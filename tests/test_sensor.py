@@ -0,0 +1,196 @@
+import asyncio
+import random
+from types import SimpleNamespace
+from unittest import mock
+
+from server import clock, config
+from server.constants import DEVICE_CHANGE_STATE_BEATS, DEVICE_CHANGE_STATE_SECONDS
+from server.events import (
+    DeviceAddedEvent, DeviceRemovedEvent, MQTTConnectedEvent, MQTTDisconnectedEvent, OccupancyEvent, RoomAddedEvent)
+from server.sensor import DeviceStateBank, Sensor, get_room_config_topic, get_room_state_topic
+
+
+class ManualClock(clock.SystemClock):
+    def __init__(self):
+        self.time = 0.0
+
+    def timestamp(self):
+        return self.time
+
+
+class ReferenceDeviceState:
+    """
+    The dict based device state the bank has to stay equivalent to.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.in_rooms = {}
+        self.maybe_in_rooms = None
+
+    async def update_room(self, room_id, room_state):
+        now_timestamp = clock.timestamp()
+        current_maybe_state = self.maybe_in_rooms.get(room_id, {
+            'last_state': room_state,
+            'appeared_at': clock.timestamp(),
+            'appeared_times': 0,
+        })
+        self.maybe_in_rooms[room_id] = current_maybe_state
+        current_maybe_state['appeared_times'] += 1
+
+        # State is different, start measuring the state staleness
+        if current_maybe_state['last_state'] != room_state:
+            self.maybe_in_rooms[room_id] = {
+                'last_state': room_state,
+                'appeared_at': now_timestamp,
+                'appeared_times': 0,
+            }
+
+        # The state is not changed for X seconds – make the state as active
+        elif all([
+            current_maybe_state['last_state'] == room_state,
+            (now_timestamp - current_maybe_state['appeared_at']) >= DEVICE_CHANGE_STATE_SECONDS,
+            current_maybe_state['appeared_times'] >= DEVICE_CHANGE_STATE_BEATS,
+        ]):
+            current_maybe_state['appeared_at'] = now_timestamp
+            current_maybe_state['appeared_times'] = 0
+            self.in_rooms[room_id] = room_state
+
+    async def update(self, room_occupancy):
+        # When the device is not detected in any rooms – clear the state
+        if not room_occupancy or self.maybe_in_rooms is None:
+            self.maybe_in_rooms = {}
+            self.in_rooms = {}
+        else:
+            merged_occupancy = dict((r, False) for r, _ in self.in_rooms.items())
+            merged_occupancy.update(dict((r, False) for r, _ in self.maybe_in_rooms.items()))
+            merged_occupancy.update(dict((o['room'].id, o['state']) for o in room_occupancy))
+            results = (self.update_room(r, s) for r, s in merged_occupancy.items())
+            await asyncio.gather(*results)
+
+    def is_in_room(self, room_id):
+        return self.in_rooms.get(room_id, False)
+
+
+class RecordingClient:
+    def __init__(self):
+        self.published = []
+
+    async def publish(self, topic, payload, qos=0, retain=False):
+        self.published.append((topic, payload))
+
+
+def test_only_rooms_with_changed_devices_are_published():
+    async def run():
+        client = RecordingClient()
+        sensor = Sensor()
+        sensor.publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+        rooms = [SimpleNamespace(id=i, name='Room {}'.format(i)) for i in (1, 2)]
+        devices = [SimpleNamespace(id=i) for i in (1, 2)]
+        for room in rooms:
+            sensor.handle_room_added(RoomAddedEvent(room=room))
+        for device in devices:
+            sensor.handle_device_added(DeviceAddedEvent(device=device))
+        await sensor.publisher.join()
+        client.published.clear()
+
+        async def beat(device, room, beats=12):
+            for _ in range(beats):
+                clock.source.time += 2
+                sensor.handle_device_occupancy(OccupancyEvent(
+                    device=device, room_occupancy=[{'room': room, 'state': True, 'proba': 1.0}], signals={}))
+                sensor.evaluate_occupancy()
+                await sensor.publisher.join()
+
+        await beat(devices[0], rooms[0])
+        assert client.published == [(get_room_state_topic(rooms[0]), 'ON')]
+        assert sensor.active_devices(1) == [devices[0]]
+
+        await beat(devices[1], rooms[0])
+        assert len(client.published) == 1
+        assert sensor.active_devices(1) == devices
+
+        sensor.handle_device_removed(DeviceRemovedEvent(device=devices[0]))
+        await beat(devices[1], rooms[1])
+        assert sorted(client.published[1:]) == [
+            (get_room_state_topic(rooms[0]), 'OFF'),
+            (get_room_state_topic(rooms[1]), 'ON'),
+        ]
+        assert sensor.room_devices == {2: {2: devices[1]}}
+        sensor.publisher.stop()
+
+    clock.set_clock(ManualClock())
+    try:
+        asyncio.run(run())
+    finally:
+        clock.set_clock(clock.SystemClock())
+
+
+def test_device_state_bank_matches_device_states():
+    rng = random.Random(7)
+    rooms = [SimpleNamespace(id=i) for i in range(4)]
+    states = [ReferenceDeviceState(None) for _ in range(6)]
+    bank = DeviceStateBank(len(states), len(rooms))
+    locations = [0] * len(states)
+
+    async def run():
+        promoted = 0
+        for _ in range(1000):
+            clock.source.time += rng.choice([0.5, 1, 2, 5])
+            index = rng.sample(range(len(states)), rng.randint(1, len(states)))
+            for i in index:
+                if rng.random() < 0.03:
+                    locations[i] = rng.randrange(len(rooms))
+            occupancy = [[
+                {'room': r, 'state': (r.id == locations[i]) != (rng.random() < 0.03)}
+                for r in rooms if rng.random() < 0.8
+            ] if rng.random() > 0.01 else [] for i in index]
+
+            observed = [[any(o['room'] is r for o in room_occupancy) for r in rooms] for room_occupancy in occupancy]
+            state = [[any(o['room'] is r and o['state'] for o in room_occupancy) for r in rooms]
+                     for room_occupancy in occupancy]
+            bank.update(index, observed, state, clock.timestamp())
+            for i, room_occupancy in zip(index, occupancy):
+                await states[i].update(room_occupancy)
+
+            assert bank.in_room.tolist() == [[s.is_in_room(r.id) for r in rooms] for s in states]
+            promoted += bank.in_room.sum()
+        assert promoted > 0
+
+    clock.set_clock(ManualClock())
+    try:
+        asyncio.run(run())
+    finally:
+        clock.set_clock(clock.SystemClock())
+
+
+def test_reconnect_reasserts_discovery_configs():
+    async def run():
+        client = RecordingClient()
+        sensor = Sensor()
+        sensor.publisher.handle_mqtt_connect(MQTTConnectedEvent(client=client))
+        rooms = [SimpleNamespace(id=i, name='Room {}'.format(i)) for i in (1, 2)]
+        for room in rooms:
+            sensor.handle_room_added(RoomAddedEvent(room=room))
+        await sensor.publisher.join()
+        assert len(client.published) == 4
+
+        # A retained config is not published again while connected
+        sensor.handle_room_added(RoomAddedEvent(room=rooms[0]))
+        await sensor.publisher.join()
+        assert len(client.published) == 4
+
+        # The broker has restarted without its retained messages
+        sensor.handle_mqtt_disconnect(MQTTDisconnectedEvent(error=None, reconnect_interval=0))
+        sensor.publisher.handle_mqtt_disconnect(MQTTDisconnectedEvent(error=None, reconnect_interval=0))
+        client = RecordingClient()
+        event = MQTTConnectedEvent(client=client)
+        sensor.publisher.handle_mqtt_connect(event)
+        sensor.handle_mqtt_connect(event)
+        await sensor.publisher.join()
+        sensor.publisher.stop()
+
+        assert sorted(topic for topic, _ in client.published) == sorted(
+            [get_room_config_topic(r) for r in rooms] + [get_room_state_topic(r) for r in rooms])
+
+    with mock.patch.object(config, 'MQTT_DISCOVERY_RETAIN', True):
+        asyncio.run(run())
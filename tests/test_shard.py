@@ -0,0 +1,129 @@
+import asyncio
+import multiprocessing
+import os
+import subprocess
+import sys
+import time
+from types import SimpleNamespace
+
+from server.eventbus import EventBusSubscriber, eventbus, subscribe
+from server.events import DeviceAddedEvent, DeviceRemovedEvent, OccupancyEvent, RoomAddedEvent
+from server.shard import Shard, ShardedTracking, shard_for
+
+IDENTIFIERS = ['aabbccddeeff', 'phone', 'watch', 'E2C56DB5-DFFB-48D2-B060-D0F5A71096E0']
+
+
+class OccupancyRecorder(EventBusSubscriber):
+    def __init__(self):
+        super().__init__()
+        self.events = []
+
+    @subscribe(OccupancyEvent)
+    def handle_occupancy(self, event):
+        self.events.append(event)
+
+
+def test_shard_for_is_stable_across_processes():
+    code = 'from server.shard import shard_for; print([shard_for(i, 4) for i in {!r}])'.format(IDENTIFIERS)
+    outputs = set()
+    for seed in ('1', '2'):
+        env = dict(os.environ, PYTHONHASHSEED=seed)
+        outputs.add(subprocess.check_output([sys.executable, '-c', code], env=env, text=True).strip())
+
+    assert outputs == {str([shard_for(i, 4) for i in IDENTIFIERS])}
+    assert set(shard_for('device-{}'.format(i), 4) for i in range(100)) == {0, 1, 2, 3}
+
+
+def test_commands_and_occupancy_round_trip():
+    async def run():
+        tracking = ShardedTracking(workers=2)
+        recorder = OccupancyRecorder()
+        room = SimpleNamespace(id=1, name='Hall')
+        phone = SimpleNamespace(id=7, identifier='aabbccddeeff')
+        shard = tracking.shards[shard_for(phone.identifier, 2)]
+        worker = shard.worker_connection
+        loop = asyncio.get_running_loop()
+        loop.add_reader(shard.connection.fileno(), shard.receive, tracking.handle_worker_message)
+        try:
+            tracking.handle_room_added(RoomAddedEvent(room=room))
+            tracking.handle_device_added(DeviceAddedEvent(device=phone))
+            assert worker.poll(5) and worker.recv() == ('device_added', 7)
+
+            payload = {'uuid': 'AA:BB:CC:DD:EE:FF', 'rssi': -60}
+            tracking.process_message('room_presence/hall', payload, received=10.0)
+            await asyncio.sleep(0)
+            assert worker.poll(5) and worker.recv() == ('messages', [('room_presence/hall', payload)], 10.0)
+
+            # Rooms come back as ids, unknown ones are left out
+            worker.send(('occupancy', 7, [(1, True, 0.9), (2, True, 0.1)], {'hall': -60}, None))
+            for _ in range(500):
+                if recorder.events:
+                    break
+                await asyncio.sleep(0.01)
+            [event] = recorder.events
+            assert event.device is phone and event.signals == {'hall': -60}
+            assert event.room_occupancy == [{'room': room, 'state': True, 'proba': 0.9}]
+
+            tracking.handle_device_removed(DeviceRemovedEvent(device=phone))
+            assert worker.poll(5) and worker.recv() == ('device_removed', 7)
+        finally:
+            await tracking.stop()
+            eventbus.remove_instance_subscribers(tracking, tracking._subscribers)
+            eventbus.remove_instance_subscribers(recorder, recorder._subscribers)
+
+        assert worker.poll(5) and worker.recv() == ('stop',)
+        assert not shard.writer.is_alive()
+
+    asyncio.run(run())
+
+
+def test_commands_are_dropped_when_the_worker_falls_behind():
+    async def run():
+        shard = Shard(0, multiprocessing.get_context('spawn'), queue_size=2)
+        worker = shard.worker_connection
+
+        # Nobody reads the pipe, the writer gets stuck on the large command
+        shard.send(('messages', ['x' * 1000000], None))
+        while shard.commands.qsize():
+            await asyncio.sleep(0.01)
+        for index in range(3):
+            shard.send(('device_added', index))
+        assert shard.stats() == {'queued': 2, 'dropped': 1}
+
+        assert worker.recv()[0] == 'messages'
+        assert worker.recv() == ('device_added', 0)
+        assert worker.recv() == ('device_added', 1)
+        shard.stop()
+        assert worker.recv() == ('stop',)
+        shard.join(5)
+        assert not shard.writer.is_alive()
+
+    asyncio.run(run())
+
+
+def test_stop_does_not_wait_for_a_stuck_worker():
+    async def run():
+        shard = Shard(0, multiprocessing.get_context('spawn'), queue_size=2)
+        worker = shard.worker_connection
+
+        shard.send(('messages', ['x' * 1000000], None))
+        while shard.commands.qsize():
+            await asyncio.sleep(0.01)
+        shard.send(('device_added', 0))
+        shard.send(('device_added', 1))
+
+        # The queued commands make room for the stop commands
+        started = time.monotonic()
+        shard.stop()
+        assert time.monotonic() - started < 0.1
+        assert shard.stats() == {'queued': 2, 'dropped': 2}
+
+        await asyncio.get_running_loop().run_in_executor(None, shard.join, 0.1)
+        assert shard.writer.is_alive()
+
+        assert worker.recv()[0] == 'messages'
+        assert worker.recv() == ('stop',)
+        shard.join(5)
+        assert not shard.writer.is_alive()
+
+    asyncio.run(run())
@@ -0,0 +1,72 @@
+import asyncio
+import threading
+import time
+
+from server.utils import Executor, executors
+
+
+def test_yielding_executor_waits_for_idle_executor():
+    inference = executors['inference'] = Executor('inference', 2)
+    training = Executor('training', 1, yield_to=('inference',))
+    release = threading.Event()
+    order = []
+
+    def predict():
+        release.wait()
+        order.append('predict')
+
+    def train():
+        order.append('train')
+
+    async def run():
+        predictions = asyncio.ensure_future(inference.run(predict))
+        await asyncio.sleep(0.01)
+        trained = asyncio.ensure_future(training.run(train))
+        await asyncio.sleep(0.05)
+
+        assert order == []
+        assert training.stats()['queue_depth'] == 1
+        assert inference.stats()['running'] == 1
+
+        release.set()
+        await asyncio.gather(predictions, trained)
+
+    try:
+        started = time.perf_counter()
+        asyncio.run(run())
+    finally:
+        del executors['inference']
+
+    assert order == ['predict', 'train']
+    stats = training.stats()
+    assert stats['completed'] == 1
+    assert stats['queue_depth'] == 0
+    assert 0.05 <= stats['max_wait_time'] <= time.perf_counter() - started
+
+
+def test_yielding_executor_is_not_starved_by_continuous_inference():
+    inference = executors['inference'] = Executor('inference', 2)
+    training = Executor('training', 1, yield_to=('inference',), max_yield=0.05)
+    stop = threading.Event()
+
+    async def predict_continuously():
+        # Always at least one prediction in flight
+        while not stop.is_set():
+            await asyncio.gather(*(inference.run(time.sleep, 0.005) for _ in range(2)))
+
+    async def run():
+        predictions = [asyncio.ensure_future(predict_continuously()) for _ in range(2)]
+        await asyncio.sleep(0.01)
+        try:
+            return await asyncio.wait_for(training.run(lambda: 'trained'), 2)
+        finally:
+            stop.set()
+            await asyncio.gather(*predictions)
+
+    try:
+        assert asyncio.run(run()) == 'trained'
+    finally:
+        del executors['inference']
+
+    assert training.stats()['yield_timeouts'] == 1
+    assert inference.stats()['completed'] > 4